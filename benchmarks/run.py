@@ -0,0 +1,190 @@
+"""Times syncs of a synthetic account, so changes can be compared against a
+saved baseline.
+
+    python -m benchmarks.run --contacts 100000 --photo-ratio 0.1
+    python -m benchmarks.run --baseline benchmarks/results/baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from gcardvault import Gcardvault
+from gcardvault.gcardvault import GoogleApis
+from .synthetic import SyntheticDataRepo, SyntheticGoogleApis, SyntheticGoogleOAuth2
+from .stand_in_server import StandInServer
+
+
+USER = "bench@example.com"
+MODES = ["export-only", "vault"]
+SCENARIOS = ["first_sync", "resync_no_change", "resync_lost_etags", "resync_churn", "clean_deletions"]
+CHURN_RATIO = 0.01
+DELETE_RATIO = 0.01
+REGRESSION_THRESHOLD = 0.2
+
+dirname = os.path.dirname(__file__)
+results_dir_path = os.path.join(dirname, "results")
+
+
+def run_mode(mode, contacts, vcard_bytes=400, photo_ratio=0.0, parallel=1, seed=0, http=None):
+    """Runs each scenario in turn against one vault, as a single account
+    would see them over successive syncs. Given `http` (StandInServer
+    options), contacts are served over HTTP by a local stand-in server
+    rather than handed straight to the sync."""
+    data_repo = SyntheticDataRepo(contacts, vcard_bytes=vcard_bytes, photo_ratio=photo_ratio, seed=seed)
+    server = StandInServer(data_repo, **http).start() if http is not None else None
+    work_dir = tempfile.mkdtemp(prefix="gcardvault-bench-")
+    try:
+        conf_dir = os.path.join(work_dir, "conf")
+        args = ["-c", conf_dir, "-o", os.path.join(work_dir, "vault"),
+                "--parallel", str(parallel), "--rate-limit", "1000000"]
+        if mode == "export-only":
+            args.append("--export-only")
+
+        results = {}
+        for scenario in SCENARIOS:
+            scenario_args = list(args)
+            if scenario == "resync_lost_etags":
+                # Every contact is downloaded again, and found unchanged
+                for file_path in glob.glob(os.path.join(conf_dir, f"{USER}.etags.db*")):
+                    os.remove(file_path)
+            elif scenario == "resync_churn":
+                data_repo.churn(CHURN_RATIO)
+            elif scenario == "clean_deletions":
+                data_repo.delete(DELETE_RATIO)
+                scenario_args.append("--clean")
+            if server is not None:
+                google_apis = GoogleApis(people_api_url=server.people_api_url, carddav_url=server.carddav_url)
+            else:
+                google_apis = SyntheticGoogleApis(data_repo)
+            results[scenario] = _time_sync(google_apis, scenario_args)
+        return results
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Compares each scenario's time with the baseline's, returning
+    (mode, scenario, secs, baseline_secs, ratio, regressed) for each found
+    in both."""
+    comparisons = []
+    for (mode, scenarios) in results['results'].items():
+        for (scenario, result) in scenarios.items():
+            baseline_result = baseline['results'].get(mode, {}).get(scenario)
+            if not baseline_result or not baseline_result['secs']:
+                continue
+            ratio = result['secs'] / baseline_result['secs']
+            comparisons.append((mode, scenario, result['secs'], baseline_result['secs'],
+                                round(ratio, 3), ratio > 1 + threshold))
+    return comparisons
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.split("\n")[0])
+    parser.add_argument("--contacts", type=int, default=10000, help="Number of contacts (default: 10000)")
+    parser.add_argument("--vcard-bytes", type=int, default=400, help="Size of each vCard, photo aside (default: 400)")
+    parser.add_argument("--photo-ratio", type=float, default=0.0, help="Share of contacts with a photo (default: 0)")
+    parser.add_argument("--parallel", type=int, default=1, help="Passed to --parallel (default: 1)")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma separated (default: {','.join(MODES)})")
+    parser.add_argument("--http", action="store_true", help="Serve contacts from a local HTTP stand-in server")
+    parser.add_argument("--latency", type=float, default=0, help="With --http, seconds to wait before each response")
+    parser.add_argument("--bandwidth", type=int, help="With --http, most bytes per second to send each response at")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data (default: 0)")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="Results file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Also save the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"Slowdown vs. the baseline counted as a regression (default: {REGRESSION_THRESHOLD})")
+    args = parser.parse_args(args)
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"Invalid mode '{mode}', must be one of: {', '.join(MODES)}")
+
+    results = {
+        'parameters': {
+            'contacts': args.contacts,
+            'vcard_bytes': args.vcard_bytes,
+            'photo_ratio': args.photo_ratio,
+            'parallel': args.parallel,
+            'seed': args.seed,
+            'http': args.http,
+            'latency': args.latency,
+            'bandwidth': args.bandwidth,
+        },
+        'python': platform.python_version(),
+        'revision': _get_git_revision(),
+        'created_at': time.time(),
+        'results': {},
+    }
+    http = {'latency_secs': args.latency, 'bytes_per_sec': args.bandwidth} if args.http else None
+    for mode in modes:
+        print(f"Running {mode} with {args.contacts} contact(s)", file=sys.stderr)
+        results['results'][mode] = run_mode(
+            mode, args.contacts, vcard_bytes=args.vcard_bytes, photo_ratio=args.photo_ratio,
+            parallel=args.parallel, seed=args.seed, http=http)
+        for (scenario, result) in results['results'][mode].items():
+            print(f"  {scenario:<18} {result['secs']:>9.3f}s", file=sys.stderr)
+
+    output = args.output or os.path.join(results_dir_path, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    _write_results(output, results)
+    print(f"Results saved to {output}", file=sys.stderr)
+    if args.save_baseline:
+        _write_results(os.path.join(results_dir_path, "baseline.json"), results)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    if baseline['parameters'] != results['parameters']:
+        print("Warning: baseline was run with different parameters", file=sys.stderr)
+
+    regressions = 0
+    for (mode, scenario, secs, baseline_secs, ratio, regressed) in compare(results, baseline, args.threshold):
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{mode:<12} {scenario:<18} {secs:>9.3f}s vs {baseline_secs:>9.3f}s ({ratio:.2f}x){flag}")
+        regressions += regressed
+    return 1 if regressions else 0
+
+
+def _time_sync(google_apis, args):
+    gc = Gcardvault(google_oauth2=SyntheticGoogleOAuth2(), google_apis=google_apis)
+    # Sync output isn't what's being measured
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        gc.run(["sync", USER] + args)
+        secs = time.perf_counter() - start
+    return {
+        'secs': round(secs, 3),
+        'counts': gc._sync_counts,
+        'metrics': gc._metrics.report(),
+    }
+
+
+def _write_results(file_path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+
+
+def _get_git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=dirname, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""Local HTTP stand-in for the People API and Google's CardDAV endpoint,
+serving a SyntheticDataRepo, so gcardvault's own transport code (requests,
+connection pooling, the googleapiclient HTTP layer, retries) can be run end
+to end without network access.
+
+    python -m benchmarks.stand_in_server --contacts 10000 --latency 0.05
+
+then point gcardvault at it with GCARDVAULT_PEOPLE_API_URL and
+GCARDVAULT_CARDDAV_URL (printed on startup). Any bearer token is accepted,
+but gcardvault still needs one in its conf dir. The benchmarks start one of
+their own with --http.
+"""
+
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .synthetic import SyntheticDataRepo, get_contact_list_page, get_report_hrefs, iter_multistatus
+
+
+PEOPLE_LIST_PATH = "/v1/people/me/connections"
+CARDDAV_PATH_PREFIX = "/carddav/v1/principals/"
+BANDWIDTH_CHUNK_SIZE = 16 * 1024
+APIS = ["people", "carddav"]
+
+
+class StandInServer():
+    """Serves the `people/me/connections` listing and CardDAV
+    addressbook-multiget REPORTs on a local port, with faults that can be
+    injected per API:
+      latency_secs: delay before each response
+      bytes_per_sec: cap on how fast each response body is sent
+      inject_errors(): next N requests fail, e.g. a burst of 429s
+      truncate_responses(): next N responses are cut off halfway through
+    """
+
+    def __init__(self, data_repo, host="127.0.0.1", port=0, latency_secs=0, bytes_per_sec=None):
+        self.data_repo = data_repo
+        self.latency_secs = latency_secs
+        self.bytes_per_sec = bytes_per_sec
+        self.requests = {api: 0 for api in APIS}
+        self.connections = 0
+        self._errors = {api: [] for api in APIS}
+        self._truncations = {api: 0 for api in APIS}
+        self._listing = None
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        (host, port) = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def people_api_url(self):
+        return self.url
+
+    @property
+    def carddav_url(self):
+        return f"{self.url}carddav/v1/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stand-in-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def inject_errors(self, api, status, count=1, retry_after=None):
+        with self._lock:
+            self._errors[api].extend([(status, retry_after)] * count)
+
+    def truncate_responses(self, api, count=1):
+        with self._lock:
+            self._truncations[api] += count
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def _next_fault(self, api):
+        with self._lock:
+            self.requests[api] += 1
+            if self._errors[api]:
+                return ("error", self._errors[api].pop(0))
+            if self._truncations[api]:
+                self._truncations[api] -= 1
+                return ("truncate", None)
+            return (None, None)
+
+    def _get_contact_list(self, query):
+        page_token = query.get("pageToken", [None])[0]
+        with self._lock:
+            if page_token is None:
+                # Listing is paged from a snapshot, like the real thing
+                self._listing = list(self.data_repo.records.values())
+            listing = self._listing
+        return json.dumps(get_contact_list_page(self.data_repo, listing, page_token)).encode('utf-8')
+
+    def _get_multistatus(self, request_body):
+        hrefs = get_report_hrefs(request_body)
+        return "".join(iter_multistatus(self.data_repo, hrefs)).encode('utf-8')
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, so connection reuse can be observed
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with server._lock:
+                server.connections += 1
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path != PEOPLE_LIST_PATH:
+                return self._send(404, b"")
+            self._respond("people", "application/json", lambda: server._get_contact_list(parse_qs(url.query)))
+
+        def do_REPORT(self):
+            request_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.path.startswith(CARDDAV_PATH_PREFIX):
+                return self._send(404, b"")
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                return self._send(401, b"")
+            self._respond("carddav", "application/xml; charset=utf-8", lambda: server._get_multistatus(request_body))
+
+        def log_message(self, format, *args):
+            pass
+
+        def _respond(self, api, content_type, get_body):
+            (fault, error) = server._next_fault(api)
+            if server.latency_secs:
+                time.sleep(server.latency_secs)
+
+            if fault == "error":
+                (status, retry_after) = error
+                headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+                body = json.dumps({'error': {'code': status, 'message': "Injected error"}}).encode('utf-8')
+                return self._send(status, body, "application/json", headers)
+
+            status = 207 if api == "carddav" else 200
+            self._send(status, get_body(), content_type, truncate=fault == "truncate")
+
+        def _send(self, status, body, content_type="text/plain", headers={}, truncate=False):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+
+            if truncate:
+                # Promised the whole body, then hang up halfway through it
+                body = body[:len(body) // 2]
+                self.close_connection = True
+            self._write(body)
+            if truncate:
+                self.wfile.flush()
+                self.connection.shutdown(socket.SHUT_RDWR)
+
+        def _write(self, body):
+            if not server.bytes_per_sec:
+                self.wfile.write(body)
+                return
+            for start in range(0, len(body), BANDWIDTH_CHUNK_SIZE):
+                chunk = body[start:start + BANDWIDTH_CHUNK_SIZE]
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                time.sleep(len(chunk) / server.bytes_per_sec)
+
+    return Handler
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.stand_in_server", description=__doc__.split("\n")[0])
+    parser.add_argument("--contacts", type=int, default=1000, help="Number of contacts (default: 1000)")
+    parser.add_argument("--vcard-bytes", type=int, default=400, help="Size of each vCard, photo aside (default: 400)")
+    parser.add_argument("--photo-ratio", type=float, default=0.0, help="Share of contacts with a photo (default: 0)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data (default: 0)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080)")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds to wait before each response")
+    parser.add_argument("--bandwidth", type=int, help="Most bytes per second to send each response at")
+    args = parser.parse_args(args)
+
+    data_repo = SyntheticDataRepo(args.contacts, vcard_bytes=args.vcard_bytes, photo_ratio=args.photo_ratio,
+                                  seed=args.seed)
+    server = StandInServer(data_repo, port=args.port, latency_secs=args.latency, bytes_per_sec=args.bandwidth)
+    server.start()
+    print(f"GCARDVAULT_PEOPLE_API_URL={server.people_api_url}", file=sys.stderr)
+    print(f"GCARDVAULT_CARDDAV_URL={server.carddav_url}", file=sys.stderr)
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
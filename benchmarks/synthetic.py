@@ -0,0 +1,195 @@
+import base64
+import random
+import hashlib
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+from google.oauth2.credentials import Credentials
+from gcardvault.gcardvault import GoogleApis, CONTACT_RESOURCE_PAGE_SIZE
+
+
+FIRST_NAMES = ["Ada", "Alan", "Barbara", "Claude", "Dennis", "Edsger", "Frances", "Grace", "Hedy", "Ivan",
+               "John", "Ken", "Linus", "Margaret", "Niklaus", "Radia", "Sophie", "Tim", "Vint", "Whitfield"]
+LAST_NAMES = ["Allen", "Berners-Lee", "Cerf", "Dijkstra", "Hamilton", "Hopper", "Kay", "Knuth", "Lamarr",
+              "Liskov", "Lovelace", "McCarthy", "Perlman", "Ritchie", "Shannon", "Sutherland", "Thompson",
+              "Torvalds", "Turing", "Wirth"]
+
+MULTISTATUS_CHUNK_SIZE = 64 * 1024
+
+
+class SyntheticDataRepo():
+    """Generates any number of contacts, deterministically for a given
+    seed. vCards are padded out to roughly `vcard_bytes`, and a share of
+    them (`photo_ratio`) carry an inline photo of `photo_bytes`."""
+
+    def __init__(self, count, vcard_bytes=400, photo_ratio=0.0, photo_bytes=8 * 1024, seed=0):
+        self.vcard_bytes = vcard_bytes
+        self.photo_bytes = photo_bytes
+        self._random = random.Random(seed)
+        self._photo_ratio = photo_ratio
+        # Keyed by ID, so lookups don't depend on how many contacts there are
+        self.records = {}
+        for i in range(count):
+            self._add_record(i)
+        self._next_index = count
+
+    def churn(self, ratio):
+        # Content (and so etag) changes for a share of the contacts, with
+        # a few of them renamed
+        changed = self._random.sample(list(self.records), max(1, int(len(self.records) * ratio)))
+        for (i, id) in enumerate(changed):
+            record = self.records[id]
+            record['revision'] += 1
+            if i % 10 == 0:
+                record['last_name'] = self._random.choice(LAST_NAMES)
+        return changed
+
+    def delete(self, ratio):
+        deleted = self._random.sample(list(self.records), max(1, int(len(self.records) * ratio)))
+        for id in deleted:
+            del self.records[id]
+        return deleted
+
+    def vcard(self, record):
+        lines = [
+            "BEGIN:VCARD",
+            "VERSION:3.0",
+            f"N:{record['last_name']};{record['first_name']};;;",
+            f"FN:{record['first_name']} {record['last_name']}",
+            f"UID:{record['id']}",
+            f"TEL;TYPE=CELL:+1-555-{record['index'] % 10000:04d}",
+            f"EMAIL;TYPE=INTERNET:{record['first_name'].lower()}.{record['index']}@example.com",
+            f"REV:2020-07-01T12:00:{record['revision'] % 60:02d}Z",
+        ]
+        padding = self.vcard_bytes - sum(len(line) + 2 for line in lines) - len("NOTE:\r\nEND:VCARD\r\n")
+        if padding > 0:
+            seed = hashlib.sha256(f"{record['id']}:{record['revision']}".encode('utf-8')).hexdigest()
+            lines.append("NOTE:" + (seed * (padding // len(seed) + 1))[:padding])
+        if record['photo']:
+            photo = base64.b64encode(record['photo']).decode('ascii')
+            folded = "\r\n ".join(photo[i:i + 74] for i in range(0, len(photo), 74))
+            lines.append(f"PHOTO;ENCODING=b;TYPE=JPEG:{folded}")
+        lines.append("END:VCARD")
+        return "\r\n".join(lines) + "\r\n"
+
+    def etag(self, record):
+        return f"{record['id']}-{record['revision']}"
+
+    def connection(self, record):
+        # Just the fields gcardvault asks the People API for
+        display_name = f"{record['first_name']} {record['last_name']}"
+        return {
+            'resourceName': f"people/{record['id']}",
+            'metadata': {
+                'sources': [{'type': "CONTACT", 'id': record['id'], 'etag': self.etag(record)}],
+                'objectType': "PERSON",
+            },
+            'names': [{
+                'metadata': {'primary': True, 'source': {'type': "CONTACT", 'id': record['id']}},
+                'displayName': display_name,
+            }],
+        }
+
+    def _add_record(self, index):
+        id = f"{self._random.getrandbits(64):016x}"
+        photo = None
+        if self._random.random() < self._photo_ratio:
+            photo = self._random.randbytes(self.photo_bytes)
+        self.records[id] = {
+            'index': index,
+            'id': id,
+            'first_name': self._random.choice(FIRST_NAMES),
+            'last_name': self._random.choice(LAST_NAMES),
+            'revision': 0,
+            'photo': photo,
+        }
+
+
+class SyntheticGoogleApis(GoogleApis):
+    """Serves a SyntheticDataRepo in place of Google's APIs, doing a constant
+    amount of work per contact so it can stand in for very large accounts.
+    Only the full sync mode is supported."""
+
+    def __init__(self, data_repo):
+        super().__init__()
+        self._repo = data_repo
+        self._listing = None
+
+    def share(self):
+        return self
+
+    def request_contact_list(self, credentials, page_token=None, sync_token=None, request_sync_token=False):
+        if page_token is None:
+            # Listing is paged from a snapshot, like the real thing
+            self._listing = list(self._repo.records.values())
+        self._record_request("people", 0)
+        return get_contact_list_page(self._repo, self._listing, page_token)
+
+    def request_carddav_report(self, credentials, principal, request_body, depth=None):
+        self._record_request("carddav", 0)
+        return self._stream(iter_multistatus(self._repo, get_report_hrefs(request_body)))
+
+    def _stream(self, parts):
+        buffer = []
+        size = 0
+        for part in parts:
+            data = part.encode('utf-8')
+            buffer.append(data)
+            size += len(data)
+            if size >= MULTISTATUS_CHUNK_SIZE:
+                yield self._emit(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield self._emit(buffer)
+
+    def _emit(self, buffer):
+        chunk = b"".join(buffer)
+        self._record_bytes("carddav", len(chunk))
+        return chunk
+
+
+def get_contact_list_page(data_repo, listing, page_token=None):
+    # Page tokens are just offsets into the listing
+    start = int(page_token or 0)
+    end = start + CONTACT_RESOURCE_PAGE_SIZE
+    resource = {
+        'connections': [data_repo.connection(record) for record in listing[start:end]],
+        'totalPeople': len(listing),
+        'totalItems': len(listing),
+    }
+    if end < len(listing):
+        resource['nextPageToken'] = str(end)
+    return resource
+
+
+def get_report_hrefs(request_body):
+    report = ElementTree.fromstring(request_body)
+    return [href.text for href in report.iter("{DAV:}href")]
+
+
+def iter_multistatus(data_repo, hrefs):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+        '<d:multistatus xmlns:d="DAV:" xmlns:card="urn:ietf:params:xml:ns:carddav">'
+    for href in hrefs:
+        record = data_repo.records.get(href.split("/")[-1])
+        if record is None:
+            yield f"<d:response><d:href>{xml_escape(href)}</d:href><d:status>HTTP/1.1 404 Not Found</d:status></d:response>"
+            continue
+        yield (
+            f"<d:response><d:href>{xml_escape(href)}</d:href><d:propstat>"
+            f"<d:status>HTTP/1.1 200 OK</d:status><d:prop>"
+            f"<d:getetag>\"{data_repo.etag(record)}\"</d:getetag>"
+            f"<card:address-data>{xml_escape(data_repo.vcard(record))}</card:address-data>"
+            f"</d:prop></d:propstat></d:response>"
+        )
+    yield "</d:multistatus>"
+
+
+class SyntheticGoogleOAuth2():
+    """Hands out phony credentials without touching the conf dir."""
+
+    def get_credentials(self, token_file_path, client_id, client_secret, scopes, user):
+        return (Credentials(token="phony", client_id=client_id), False)
+
+    def refresh_credentials(self, credentials, token_file_path, margin_secs):
+        return False
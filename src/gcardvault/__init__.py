@@ -1 +1,2 @@
 from .gcardvault import Gcardvault, GcardvaultError
+from .api import sync, sync_async, SyncResult
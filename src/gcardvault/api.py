@@ -0,0 +1,109 @@
+import os
+import time
+from .gcardvault import Gcardvault, GcardvaultError
+
+
+PRINT_ONLY_OPTIONS = ["help", "version"]
+
+
+class SyncResult():
+    """Outcome of a sync run through the library API.
+
+    Counts are of contacts: `updated` were downloaded and written (or
+    packed), `unchanged` were downloaded but found no different from what
+    was on disk, `up_to_date` weren't downloaded at all, and `removed` were
+    deleted from the vault. `commit` is the SHA of the vault commit made,
+    if any, and `metrics` holds the per-phase timings and request metrics
+    also written by --metrics-file."""
+
+    def __init__(self, user, counts, files_written, files_removed, commit, elapsed_secs, metrics):
+        self.user = user
+        self.updated = counts['to_update'] - counts['unchanged']
+        self.unchanged = counts['unchanged']
+        self.up_to_date = counts['up_to_date']
+        self.removed = counts['removed']
+        self.files_written = sorted(files_written)
+        self.files_removed = sorted(files_removed)
+        self.commit = commit
+        self.elapsed_secs = elapsed_secs
+        self.metrics = metrics
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def __repr__(self):
+        return (f"SyncResult(user={self.user!r}, updated={self.updated}, unchanged={self.unchanged}, "
+                f"up_to_date={self.up_to_date}, removed={self.removed}, commit={self.commit!r})")
+
+
+def sync(user, options=None, progress=None, google_oauth2=None, google_apis=None):
+    """Syncs a user's contacts, as 'gcardvault sync' would, and returns a
+    SyncResult. `options` are named after the command-line options, e.g.
+    {'output_dir': "/backups/foo", 'export_only': True, 'parallel': 4}, and
+    validated the same way. Progress messages are passed to `progress`
+    rather than printed (from whichever thread is doing the work).
+
+    The user must already have a saved token in the conf dir (see 'gcardvault
+    login'), since there's no one to prompt for a login. Raises
+    GcardvaultError for invalid options and anything else as it happens.
+
+    A `google_apis` passed in is shared rather than used directly, so it's
+    left open (and its connections pooled) for other syncs."""
+    _check_options(options or {})
+    if google_apis is not None:
+        google_apis = google_apis.share()
+    gc = Gcardvault(google_oauth2=google_oauth2, google_apis=google_apis)
+    gc.progress = progress if progress is not None else _discard
+    if not gc._parse_options(["sync", user] + _get_cli_args(options or {})):
+        raise GcardvaultError("Invalid sync options")
+    gc._make_paths_absolute()
+
+    if not os.path.exists(gc._token_file_path()):
+        raise GcardvaultError(f"No saved credentials, run 'gcardvault login {user}' first")
+
+    start = time.monotonic()
+    gc.sync()
+    return SyncResult(
+        gc.user, gc._sync_counts, gc._files_written, gc._files_removed - gc._files_written,
+        gc._sync_commit, round(time.monotonic() - start, 3), gc._metrics.report())
+
+
+async def sync_async(user, options=None, progress=None, google_oauth2=None, google_apis=None):
+    """Same as sync(), run in a worker thread so it doesn't block the event
+    loop, with `progress` called back on the loop. Any number can be run
+    concurrently, e.g. with asyncio.gather()."""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    if progress is not None:
+        def threadsafe_progress(message):
+            loop.call_soon_threadsafe(progress, message)
+    else:
+        threadsafe_progress = None
+
+    return await asyncio.to_thread(
+        sync, user, options, threadsafe_progress, google_oauth2=google_oauth2, google_apis=google_apis)
+
+
+def _check_options(options):
+    # These print to stdout rather than sync. getopt takes any unambiguous
+    # abbreviation of an option too, e.g. --h for --help.
+    for name in options:
+        opt = name.replace('_', '-')
+        if any(print_only_opt.startswith(opt) for print_only_opt in PRINT_ONLY_OPTIONS):
+            raise GcardvaultError(f"Invalid sync option '{name}'")
+
+
+def _get_cli_args(options):
+    args = []
+    for (name, value) in options.items():
+        opt = f"--{name.replace('_', '-')}"
+        if value is True:
+            args.append(opt)
+        elif value is not False and value is not None:
+            args.extend([opt, str(value)])
+    return args
+
+
+def _discard(message):
+    pass
@@ -0,0 +1,77 @@
+import math
+import threading
+
+
+# Weight given to the latest observation in the moving averages
+SMOOTHING = 0.3
+# Most a batch can grow by from one response to the next
+MAX_GROWTH = 2.0
+
+
+class BatchSizer():
+    """Picks the number of items to request per batch based on how previous
+    batches went. Grows the batch while responses come back within the target
+    time (and size), shrinks it in proportion when they're slower, and halves
+    it outright when a request fails."""
+
+    def __init__(self, initial_size, min_size, max_size, target_secs, target_bytes):
+        self._min_size = min_size
+        self._max_size = max_size
+        self._target_secs = target_secs
+        self._target_bytes = target_bytes
+        self._size = self._clamp(initial_size)
+        self._secs_per_item = None
+        self._bytes_per_item = None
+        self._sizes_used = []
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def record_success(self, count, elapsed_secs, bytes_received):
+        if count <= 0:
+            return
+        with self._lock:
+            self._sizes_used.append(count)
+            self._secs_per_item = self._average(self._secs_per_item, elapsed_secs / count)
+            self._bytes_per_item = self._average(self._bytes_per_item, bytes_received / count)
+
+            # Largest batch expected to stay within both targets
+            fits_target = self._target_secs / max(self._secs_per_item, 1e-6)
+            if self._bytes_per_item > 0:
+                fits_target = min(fits_target, self._target_bytes / self._bytes_per_item)
+
+            if elapsed_secs > self._target_secs:
+                size = min(self._size * self._target_secs / elapsed_secs, fits_target)
+            else:
+                size = min(self._size * MAX_GROWTH, fits_target)
+            self._size = self._clamp(size)
+
+    def record_failure(self, count):
+        with self._lock:
+            self._failures += 1
+            self._size = self._clamp(min(self._size, count) / 2)
+
+    def summary(self):
+        with self._lock:
+            if not self._sizes_used:
+                return None
+            return {
+                'batches': len(self._sizes_used),
+                'min': min(self._sizes_used),
+                'max': max(self._sizes_used),
+                'mean': round(sum(self._sizes_used) / len(self._sizes_used), 1),
+                'final': self._size,
+                'failures': self._failures,
+            }
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return (SMOOTHING * value) + ((1 - SMOOTHING) * average)
+
+    def _clamp(self, size):
+        return int(max(self._min_size, min(self._max_size, math.floor(size))))
@@ -0,0 +1,32 @@
+import threading
+
+
+# Note: google-api-python-client ships a snapshot of every discovery document
+# with the package (and its version is pinned in setup.py), so there's no
+# need to fetch them from Google's discovery service at runtime. Documents are
+# read from the package once per process and reused for every client built.
+# googleapiclient itself is only imported once a client is first built, since
+# it's slow to import and most commands never need one.
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def build_service(service_name, version, credentials, api_endpoint=None):
+    from googleapiclient.discovery import build_from_document
+
+    document = _get_document(service_name, version)
+    client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+    return build_from_document(document, credentials=credentials, client_options=client_options)
+
+
+def _get_document(service_name, version):
+    from googleapiclient.discovery_cache import get_static_doc
+
+    key = (service_name, version)
+    with _documents_lock:
+        if key not in _documents:
+            document = get_static_doc(service_name, version)
+            if document is None:
+                raise RuntimeError(f"No discovery document bundled for '{service_name}' ({version})")
+            _documents[key] = document
+        return _documents[key]
@@ -1,34 +1,107 @@
 import os
+import sqlite3
+from contextlib import closing
 
 
 class ETagManager():
+    """Etags and sync tokens for one user, kept in their own database in the
+    conf dir so syncs for different users sharing it don't trip over each
+    other."""
 
-    def __init__(self, conf_dir):
-        self._etag_cache_file_path = os.path.join(conf_dir, ".etags")
-        self._cache = self._read_cache_file()
+    def __init__(self, conf_dir, user):
+        self._user = user
+        self._etag_db_file_path = os.path.join(conf_dir, f"{user}.etags.db")
+        # Shared by every user, as written by previous versions
+        self._shared_etag_db_file_path = os.path.join(conf_dir, ".etags.db")
+        self._legacy_etag_cache_file_path = os.path.join(conf_dir, ".etags")
+        self._cache = {}
+        self._staged = {}
+        self._sync_tokens = {}
+        self._staged_sync_tokens = {}
 
-    def test_for_change_and_save(self, object_name, etag):
+        self._init_db()
+        (self._cache, self._sync_tokens) = self._read_db()
+
+    def test_for_change(self, object_name, etag):
         key = "_".join(object_name.strip().lower().split())
         value = "_".join(etag.strip().strip('"').split())
 
         if key in self._cache and self._cache[key] == value:
             return False
 
-        self._cache[key] = value
-        self._write_cache_file()
+        # Changes are staged in memory until save() is called, so
+        # etags are only persisted once the objects are persisted
+        self._staged[key] = value
         return True
 
-    def _read_cache_file(self):
+    def get_sync_token(self, name):
+        return self._sync_tokens.get(name)
+
+    def set_sync_token(self, name, token):
+        self._staged_sync_tokens[name] = token
+
+    def save(self):
+        if not self._staged and not self._staged_sync_tokens:
+            return
+
+        with closing(sqlite3.connect(self._etag_db_file_path)) as conn:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO etags (key, value) VALUES (?, ?)",
+                    self._staged.items())
+                for (name, token) in self._staged_sync_tokens.items():
+                    if token:
+                        conn.execute("INSERT OR REPLACE INTO sync_tokens (name, token) VALUES (?, ?)", (name, token))
+                    else:
+                        conn.execute("DELETE FROM sync_tokens WHERE name = ?", (name,))
+
+        self._cache.update(self._staged)
+        self._staged = {}
+        for (name, token) in self._staged_sync_tokens.items():
+            if token:
+                self._sync_tokens[name] = token
+            else:
+                self._sync_tokens.pop(name, None)
+        self._staged_sync_tokens = {}
+
+    def discard(self):
+        self._staged = {}
+        self._staged_sync_tokens = {}
+
+    def _init_db(self):
+        is_new = not os.path.exists(self._etag_db_file_path)
+
+        with closing(sqlite3.connect(self._etag_db_file_path)) as conn:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS etags (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS sync_tokens (name TEXT PRIMARY KEY, token TEXT NOT NULL)")
+                # Seeded from the shared state of previous versions, which is
+                # left in place for any other users still to be migrated.
+                # Which etags were whose wasn't recorded, so all are copied.
+                if is_new and os.path.exists(self._shared_etag_db_file_path):
+                    (etags, sync_tokens) = self._read_db(self._shared_etag_db_file_path)
+                    conn.executemany("INSERT OR REPLACE INTO etags (key, value) VALUES (?, ?)", etags.items())
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO sync_tokens (name, token) VALUES (?, ?)",
+                        [(name, token) for (name, token) in sync_tokens.items()
+                         if name.startswith(f"{self._user}:")])
+                elif is_new and os.path.exists(self._legacy_etag_cache_file_path):
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO etags (key, value) VALUES (?, ?)",
+                        self._read_legacy_cache_file().items())
+
+    def _read_db(self, file_path=None):
+        with closing(sqlite3.connect(file_path or self._etag_db_file_path)) as conn:
+            return (
+                dict(conn.execute("SELECT key, value FROM etags")),
+                dict(conn.execute("SELECT name, token FROM sync_tokens")),
+            )
+
+    def _read_legacy_cache_file(self):
         cache = {}
-        if os.path.exists(self._etag_cache_file_path):
-            with open(self._etag_cache_file_path, 'r') as file:
-                for line in file:
+        with open(self._legacy_etag_cache_file_path, 'r') as file:
+            for line in file:
+                if line.strip():
                     (key, value) = line.split()
                     cache[key] = value
         return cache
-
-    def _write_cache_file(self):
-        with open(self._etag_cache_file_path, 'w') as file:
-            for key in self._cache:
-                value = self._cache[key]
-                print(f"{key}\t{value}", file=file)
@@ -0,0 +1,94 @@
+import os
+import time
+
+# flock where there is one, otherwise (Windows) a lock on the file's first byte
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+LOCK_POLL_INTERVAL = 0.1
+
+
+class LockTimeoutError(Exception):
+
+    def __init__(self, path, holder_pid=None):
+        message = f"{path} is locked"
+        if holder_pid:
+            message += f" by process {holder_pid}"
+        super().__init__(message)
+        self.path = path
+        self.holder_pid = holder_pid
+
+
+class FileLock():
+    """Advisory lock (flock) on a file, held by one process (or one FileLock
+    within a process) at a time. Waits up to `wait_secs` for it to be
+    released, failing straight away with 0. The holder's PID is written to
+    the file, so whoever's left waiting can say who they're waiting on."""
+
+    def __init__(self, path, wait_secs=0):
+        self.path = path
+        self.wait_secs = wait_secs
+        self._file = None
+
+    def acquire(self):
+        file = open(self.path, 'a+')
+        deadline = time.monotonic() + self.wait_secs
+        while True:
+            try:
+                _lock_file(file)
+                break
+            except (BlockingIOError, PermissionError):
+                remaining_secs = deadline - time.monotonic()
+                if remaining_secs <= 0:
+                    holder_pid = self._read_holder_pid(file)
+                    file.close()
+                    raise LockTimeoutError(self.path, holder_pid)
+                time.sleep(min(LOCK_POLL_INTERVAL, remaining_secs))
+
+        file.truncate(0)
+        file.write(f"{os.getpid()}\n")
+        file.flush()
+        self._file = file
+        return self
+
+    def release(self):
+        if self._file is None:
+            return
+        # Left in place, removing it could race with another process opening it
+        self._file.truncate(0)
+        _unlock_file(self._file)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *_):
+        self.release()
+
+    def _read_holder_pid(self, file):
+        try:
+            file.seek(0)
+            return file.read().strip() or None
+        except OSError:
+            # Locked against reading too, on Windows
+            return None
+
+
+def _lock_file(file):
+    if os.name == "nt":
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def _unlock_file(file):
+    if os.name == "nt":
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
@@ -1,15 +1,33 @@
 import os
-import glob
-import requests
+import hashlib
+import json
+import random
+import signal
+import sys
 import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from getopt import gnu_getopt, GetoptError
 from xml.etree import ElementTree
-from googleapiclient.discovery import build
 from dotenv import load_dotenv
 
+from .discovery import build_service
 from .google_oauth2 import GoogleOAuth2
-from .git_vault_repo import GitVaultRepo
 from .etag_manager import ETagManager
+from .file_lock import FileLock, LockTimeoutError
+from .pipeline import Pipeline
+from .batch_sizer import BatchSizer
+from .vault_manifest import VaultManifest
+from .vcard_pack import VCardPackWriter, PACK_STDOUT
+from .metrics import SyncMetrics
+from . import prometheus
+from .rate_limiter import get_rate_limiter, get_backoff_secs, parse_retry_after
+
+# Note: git, requests and googleapiclient are imported by the code that needs
+# them rather than up here. They're slow to import, and there's no reason
+# for --help, --version or a sync in export-only mode to pay for all of them.
 
 
 # Note: OAuth2 auth code flow for "installed applications" assumes the client secret
@@ -33,12 +51,37 @@ OAUTH_SCOPES = [
 # fashion, so these could be subject to change. Risk of that down the road
 # is worth the trade-off of using the People API to discover contact list,
 # so much simpler to work with than implementing the full DAV/CardDAV flow.
-GOOGLE_CARDDAV_ADDRESSBOOK_URI_FORMAT = "https://www.googleapis.com/carddav/v1/principals/{principal}/lists/default/"
+GOOGLE_PEOPLE_API_URL = "https://people.googleapis.com/"
+GOOGLE_CARDDAV_URL = "https://www.googleapis.com/carddav/v1/"
+GOOGLE_CARDDAV_ADDRESSBOOK_URI_FORMAT = "{carddav_url}principals/{principal}/lists/default/"
 GOOGLE_CARDDAV_CONTACT_HREF_FORMAT = "/carddav/v1/principals/{principal}/lists/default/{contact_id}"
 CONTACT_RESOURCE_PAGE_SIZE = 500
+SYNC_ALL_PARALLEL_ACCOUNTS = 4
+WATCH_INTERVAL = 3600
+WATCH_INTERVAL_JITTER = 0.1
+CREDENTIALS_REFRESH_MARGIN = 300
 CARDDAV_REPORT_PAGE_SIZE = 250
-
-COMMANDS = ['sync', 'login', 'authorize', 'noop']
+CARDDAV_BATCH_SIZE_MIN = 10
+CARDDAV_BATCH_SIZE_MAX = 500
+CARDDAV_BATCH_TARGET_SECS = 10
+CARDDAV_BATCH_TARGET_BYTES = 16 * 1024 * 1024
+CARDDAV_BATCH_ATTEMPTS = 3
+CARDDAV_CONNECT_TIMEOUT = 10
+CARDDAV_READ_TIMEOUT = 60
+API_RATE_LIMIT = 5
+API_RATE_LIMITED_STATUSES = [429, 503]
+API_RATE_LIMITED_ATTEMPTS = 6
+CARDDAV_POOL_SIZE = 1
+CARDDAV_STREAM_CHUNK_SIZE = 64 * 1024
+PIPELINE_VCARD_QUEUE_SIZE = 100
+
+COMMANDS = ['sync', 'sync-all', 'watch', 'maintain', 'login', 'authorize', 'noop']
+AUTO_MAINTAIN_LOOSE_OBJECTS = 2000
+AUTO_MAINTAIN_COMMITS = 500
+LOCK_WAIT_SECS = 0
+VAULT_LOCK_FILE_NAME = ".gcardvault.lock"
+VAULT_LAYOUTS = ['flat', 'sharded']
+SYNC_MODES = ['full', 'incremental', 'carddav']
 
 load_dotenv()
 
@@ -54,50 +97,154 @@ class Gcardvault:
         self.user = None
         self.export_only = False
         self.clean = False
+        self.parallel = 1
+        self.sync_mode = "full"
+        self.manifest_file = None
+        self.parallel_accounts = SYNC_ALL_PARALLEL_ACCOUNTS
+        self.interval = WATCH_INTERVAL
+        self.batch_size_min = CARDDAV_BATCH_SIZE_MIN
+        self.batch_size_max = CARDDAV_BATCH_SIZE_MAX
+        self.batch_target_secs = CARDDAV_BATCH_TARGET_SECS
+        self.rate_limit = API_RATE_LIMIT
+        self.rebuild_manifest = False
+        self.layout = None
+        self.pack = None
+        self.auto_maintain = False
+        self.lock_wait = LOCK_WAIT_SECS
+        self.metrics_file = None
+        self.prometheus_file = None
+        self.status_file = None
+        # Called with each progress message in place of printing it
+        self.progress = None
         self.conf_dir = os.getenv("GCARDVAULT_CONF_DIR", os.path.expanduser("~/.gcardvault"))
         self.output_dir = os.getenv("GCARDVAULT_OUTPUT_DIR", os.path.join(os.getcwd(), 'gcardvault'))
         self.client_id = DEFAULT_CLIENT_ID
         self.client_secret = DEFAULT_CLIENT_SECRET
 
         self._repo = None
+        self._etags = None
+        self._log_prefix = ""
+        self._sync_counts = None
+        self._sync_commit = None
+        self._batch_sizer = None
+        self._files_written = set()
+        self._files_removed = set()
+        self._manifest = None
+        self._layout = "flat"
+        self._pack_writer = None
+        self._metrics = SyncMetrics()
+        self._credentials = None
+        self._stop_event = threading.Event()
         self._google_oauth2 = google_oauth2 if google_oauth2 is not None else GoogleOAuth2(
             app_name="gcardvault",
             authorize_command_fn=self._authorize_command,
+            log=self._log,
         )
         self._google_apis = google_apis if google_apis is not None else GoogleApis()
 
     def run(self, cli_args):
         if not self._parse_options(cli_args):
             return
-        getattr(self, self.command)()
+        return getattr(self, self.command.replace("-", "_"))()
 
     def noop(self):
         self._ensure_dirs()
         pass
 
     def sync(self):
-        self._ensure_dirs()
-
-        (credentials, _) = self._google_oauth2.get_credentials(
-            self._token_file_path(), self.client_id, self.client_secret, OAUTH_SCOPES, self.user)
-
-        if not self.export_only:
-            self._repo = GitVaultRepo("gcardvault", self.version(), self.output_dir, [".vcf"])
-
-        contacts = self._get_contacts(credentials)
-
-        if self.clean:
-            self._clean_output_dir(contacts)
+        try:
+            self._sync()
+        finally:
+            self._google_apis.close()
 
-        contacts_to_update = self._filter_contacts_to_update(contacts)
-        if contacts_to_update:
-            vcards = self._get_vcards_for_contacts(credentials, contacts_to_update)
-            self._save_vcards(contacts_to_update, vcards)
-            if self._repo:
-                self._repo.add_all_files()
+    def watch(self):
+        # Stays resident and syncs on an interval, keeping the repo, etags,
+        # credentials and HTTP connections warm between runs
+        self._stop_event.clear()
+        restore_signal_handler = self._handle_stop_signal()
 
-        if self._repo:
-            self._repo.commit("gcardvault sync")
+        status = {'user': self.user, 'runs': 0, 'last_success_at': None, }
+        try:
+            while not self._stop_event.is_set():
+                started_at = time.time()
+                error = None
+                try:
+                    self._sync()
+                    status['last_success_at'] = time.time()
+                except Exception as e:
+                    error = e
+                    self._log(f"Sync failed: {e}")
+
+                delay = self._next_watch_delay()
+                status['runs'] += 1
+                status.update({
+                    'status': "ok" if error is None else "error",
+                    'error': str(error) if error is not None else None,
+                    'started_at': started_at,
+                    'finished_at': time.time(),
+                    'duration_seconds': round(time.time() - started_at, 3),
+                    'counts': self._sync_counts if error is None else None,
+                    'next_run_at': time.time() + delay,
+                })
+                self._write_status_file(status)
+
+                self._log(f"Next sync in {delay:.0f}s")
+                self._stop_event.wait(delay)
+        finally:
+            restore_signal_handler()
+            self._google_apis.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def sync_all(self):
+        if self.pack is not None:
+            raise GcardvaultError("--pack can't be used with sync-all, accounts would share one pack", "pack")
+
+        self._make_paths_absolute()
+        accounts = self._read_manifest_file()
+
+        # All accounts share one pool of HTTP connections, sized so that
+        # every download worker for every account can keep one alive
+        self._google_apis.pool_size = max(self.parallel * self.parallel_accounts, CARDDAV_POOL_SIZE)
+        self._google_apis.rate_limit = self.rate_limit
+
+        results = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_accounts) as executor:
+                futures = {
+                    executor.submit(self._sync_account, user, output_dir): user
+                    for (user, output_dir) in accounts
+                }
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+        finally:
+            self._google_apis.close()
+
+        print("")
+        print("Summary:")
+        failed = 0
+        for (user, _) in accounts:
+            (error, counts, elapsed, _) = results[user]
+            if error is None:
+                print(f"  {user}: OK in {elapsed:.1f}s, "
+                      f"{counts['to_update']} updated ({counts['unchanged']} unchanged after download), "
+                      f"{counts['up_to_date']} up to date, {counts['removed']} removed")
+            else:
+                failed += 1
+                print(f"  {user}: FAILED in {elapsed:.1f}s, {error}")
+        print(f"{len(accounts) - failed} of {len(accounts)} account(s) synced successfully")
+
+        if self.prometheus_file:
+            # One file covering every account
+            last_success_ats = prometheus.read_last_success_timestamps(self.prometheus_file)
+            samples = []
+            for (user, _) in accounts:
+                (error, _, _, gc) = results[user]
+                samples.extend(gc._get_prometheus_samples(error, last_success_ats.get(user)))
+            prometheus.write_metrics_file(self.prometheus_file, samples)
+
+        return 1 if failed else 0
 
     def login(self):
         self._ensure_dirs()
@@ -109,6 +256,325 @@ class Gcardvault:
         self._google_oauth2.authz_and_export_token(
             self.client_id, self.client_secret, OAUTH_SCOPES, self.user)
 
+    def maintain(self):
+        # Don't want GitVaultRepo creating a vault where there wasn't one
+        if not os.path.isdir(os.path.join(self.output_dir, ".git")):
+            raise GcardvaultError(f"No vault found in {self.output_dir}")
+        from .git_vault_repo import GitVaultRepo
+        with self._lock(os.path.join(self.output_dir, VAULT_LOCK_FILE_NAME), "Vault"):
+            repo = GitVaultRepo("gcardvault", self.version(), self.output_dir, [".vcf"], log=self._log)
+            repo.maintain()
+
+    def _sync(self):
+        self._metrics = SyncMetrics()
+        self._google_apis.metrics = self._metrics
+        error = None
+        try:
+            with self._lock_sync():
+                self._run_sync()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._google_apis.metrics = None
+            if self.metrics_file:
+                self._write_metrics_file(error)
+            if self.prometheus_file:
+                last_success_at = prometheus.read_last_success_timestamps(self.prometheus_file).get(self.user)
+                prometheus.write_metrics_file(
+                    self.prometheus_file, self._get_prometheus_samples(error, last_success_at))
+
+    def _run_sync(self):
+        self._ensure_dirs()
+        self._sync_commit = None
+
+        credentials = self._get_credentials()
+
+        if not self.export_only and self._repo is None:
+            from .git_vault_repo import GitVaultRepo
+            self._repo = GitVaultRepo("gcardvault", self.version(), self.output_dir, [".vcf"], log=self._log)
+
+        if self._etags is None:
+            self._etags = ETagManager(self.conf_dir, self.user)
+        else:
+            # Anything left over from a previous (failed) run
+            self._etags.discard()
+
+        # Keep enough connections alive for each download worker
+        self._google_apis.pool_size = max(self.parallel, CARDDAV_POOL_SIZE)
+        self._google_apis.rate_limit = self.rate_limit
+
+        # Exact set of files touched by this run, so only those get staged
+        self._files_written = set()
+        self._files_removed = set()
+
+        if self.pack is not None:
+            self._sync_counts = self._export_pack(credentials)
+            return
+
+        self._manifest = VaultManifest(self.output_dir, ".vcf", rebuild=self.rebuild_manifest, log=self._log)
+        try:
+            self._apply_layout()
+
+            (contacts, deleted_contact_ids, counts) = self._run_sync_pipeline(credentials)
+
+            counts['removed'] = 0
+            if self.clean:
+                with self._metrics.phase("clean"):
+                    counts['removed'] = self._clean_output_dir(contacts, deleted_contact_ids)
+        finally:
+            # Reflects what's on disk, even if the sync didn't finish
+            self._manifest.save()
+
+        self._log_batch_sizes()
+
+        if self._repo:
+            files_removed = self._files_removed - self._files_written
+            with self._metrics.phase("stage_files", len(files_removed) + len(self._files_written)):
+                self._repo.remove_files(files_removed)
+                self._repo.add_files(self._files_written)
+
+        # Only persist etags once the vCards they describe are on disk
+        self._etags.save()
+
+        if self._repo:
+            with self._metrics.phase("commit"):
+                self._sync_commit = self._repo.commit("gcardvault sync")
+            if self.auto_maintain and self._repo.needs_maintenance(AUTO_MAINTAIN_LOOSE_OBJECTS, AUTO_MAINTAIN_COMMITS):
+                with self._metrics.phase("maintain"):
+                    self._repo.maintain()
+
+        self._sync_counts = counts
+
+    def _export_pack(self, credentials):
+        # vCards are streamed straight into the pack as they're downloaded,
+        # nothing is written to the vault and no etags are kept
+        self._pack_writer = VCardPackWriter(self.pack)
+        try:
+            (_, _, counts) = self._run_sync_pipeline(credentials)
+            self._pack_writer.close()
+        except BaseException:
+            self._pack_writer.abort()
+            raise
+        finally:
+            self._etags.discard()
+
+        counts['removed'] = 0
+        self._log_batch_sizes()
+        if self.pack != PACK_STDOUT:
+            self._log(f"Packed {self._pack_writer.count} vCard(s) into {self.pack}")
+        return counts
+
+    def _log_batch_sizes(self):
+        batch_sizes = self._batch_sizer.summary()
+        if batch_sizes:
+            self._log(f"Downloaded vCards in {batch_sizes['batches']} batch(es) sized "
+                      f"{batch_sizes['min']}-{batch_sizes['max']} (mean {batch_sizes['mean']}), "
+                      f"next batch would be {batch_sizes['final']}")
+
+    def _apply_layout(self):
+        # Layout is recorded in the vault, so it only needs to be given once.
+        # Exports have nowhere to record it, so it's read off the files.
+        recorded_layout = self._repo.get_config('layout') if self._repo else None
+        layout = self.layout or recorded_layout or self._get_manifest_layout() or "flat"
+
+        moves = []
+        # Files are only moved when asked to, never for a layout worked out
+        # from what's already there
+        contact_ids = sorted(self._manifest.ids()) if self.layout is not None else []
+        for contact_id in contact_ids:
+            file_name = self._manifest.get_file_name(contact_id)
+            target_file_name = get_vault_file_path(os.path.basename(file_name), contact_id, layout)
+            if file_name != target_file_name:
+                moves.append((contact_id, file_name, target_file_name))
+
+        if moves:
+            self._log(f"Moving {len(moves)} file(s) to {layout} layout")
+            if self._repo:
+                self._repo.move_files([(file_name, target_file_name) for (_, file_name, target_file_name) in moves])
+            else:
+                for (_, file_name, target_file_name) in moves:
+                    target_file_path = os.path.join(self.output_dir, target_file_name)
+                    os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
+                    os.rename(os.path.join(self.output_dir, file_name), target_file_path)
+            for (contact_id, _, target_file_name) in moves:
+                entry = self._manifest.get(contact_id)
+                self._manifest.set(contact_id, target_file_name, entry['etag'], entry['content_hash'],
+                                   entry['size'], entry['mtime_ns'])
+
+        if self._repo and recorded_layout != layout:
+            self._repo.set_config('layout', layout)
+        if self._repo and moves:
+            # Committed on its own, so the renames aren't mixed in with changes
+            self._repo.commit(f"Move vault to {layout} layout")
+
+        self._layout = layout
+
+    def _get_manifest_layout(self):
+        # Sharded if files are in the directories the sharded layout would
+        # put them in, any other directory doesn't count
+        contact_ids = self._manifest.ids()
+        if not contact_ids:
+            return None
+        for contact_id in contact_ids:
+            file_name = self._manifest.get_file_name(contact_id)
+            if file_name == get_vault_file_path(os.path.basename(file_name), contact_id, "sharded"):
+                return "sharded"
+        return "flat"
+
+    def _get_credentials(self):
+        if self._credentials is None:
+            (self._credentials, _) = self._google_oauth2.get_credentials(
+                self._token_file_path(), self.client_id, self.client_secret, OAUTH_SCOPES, self.user)
+        else:
+            # Credentials held over from a previous run, refresh them before
+            # they expire rather than mid-sync
+            self._google_oauth2.refresh_credentials(
+                self._credentials, self._token_file_path(), CREDENTIALS_REFRESH_MARGIN)
+        return self._credentials
+
+    def _next_watch_delay(self):
+        jitter = self.interval * WATCH_INTERVAL_JITTER
+        return max(0, self.interval + random.uniform(-jitter, jitter))
+
+    def _handle_stop_signal(self):
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return lambda: None
+
+        previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        return lambda: signal.signal(signal.SIGTERM, previous_handler)
+
+    def _status_file_path(self):
+        return self.status_file or os.path.join(self.conf_dir, f"{self.user}.status.json")
+
+    def _write_status_file(self, status):
+        self._write_json_file(self._status_file_path(), status)
+
+    def _write_metrics_file(self, error=None):
+        metrics = {
+            'user': self.user,
+            'sync_mode': self.sync_mode,
+            'parallel': self.parallel,
+            'succeeded': error is None,
+            'error': str(error) if error is not None else None,
+            'counts': self._sync_counts if error is None else None,
+            'batch_sizes': self._batch_sizer.summary() if self._batch_sizer else None,
+        }
+        metrics.update(self._metrics.report())
+        self._write_json_file(self.metrics_file, metrics)
+
+    def _get_prometheus_samples(self, error, last_success_at=None):
+        report = self._metrics.report()
+        user = {'user': self.user}
+        samples = [
+            ("gcardvault_last_run_timestamp_seconds", user, report['started_at']),
+            ("gcardvault_last_run_success", user, error is None),
+            ("gcardvault_run_duration_seconds", user, report['elapsed_secs']),
+        ]
+
+        if error is None:
+            last_success_at = report['started_at']
+        if last_success_at is not None:
+            samples.append((prometheus.LAST_SUCCESS_METRIC, user, last_success_at))
+
+        for (phase, phase_metrics) in report['phases'].items():
+            samples.append(("gcardvault_phase_duration_seconds", dict(user, phase=phase), phase_metrics['secs']))
+        if 'commit' in report['phases']:
+            samples.append(("gcardvault_git_commit_duration_seconds", user, report['phases']['commit']['secs']))
+
+        if error is None and self._sync_counts is not None:
+            counts = self._sync_counts
+            if self.pack is not None:
+                total = self._pack_writer.count
+            else:
+                total = len(self._manifest.ids())
+            for (state, count) in [
+                    ("total", total),
+                    ("updated", counts['to_update'] - counts['unchanged']),
+                    ("unchanged", counts['unchanged']),
+                    ("up_to_date", counts['up_to_date']),
+                    ("removed", counts['removed'])]:
+                samples.append(("gcardvault_contacts", dict(user, state=state), count))
+
+        for (api, requests) in report['requests'].items():
+            samples.append(("gcardvault_http_requests", dict(user, api=api), requests['count']))
+            samples.append(("gcardvault_http_received_bytes", dict(user, api=api), requests['bytes']))
+            samples.append(("gcardvault_http_retries", dict(user, api=api), requests['retries']))
+
+        return samples
+
+    def _write_json_file(self, file_path, data):
+        # Written to a temp file and moved into place, so readers never
+        # see a partially written file
+        temp_file_path = f"{file_path}.tmp"
+        with open(temp_file_path, 'w') as file:
+            json.dump(data, file, indent=2)
+        os.replace(temp_file_path, file_path)
+
+    def _read_manifest_file(self):
+        # One account per line, "<user> [<output dir>]", relative output dirs
+        # are relative to the manifest file and default to a subfolder of
+        # the output dir named after the user
+        accounts = []
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_file))
+        try:
+            with open(self.manifest_file, 'r') as file:
+                for line in file:
+                    line = line.split("#")[0].strip()
+                    if not line:
+                        continue
+                    (user, _, output_dir) = line.partition(" ")
+                    user = user.lower()
+                    output_dir = output_dir.strip()
+                    if output_dir:
+                        output_dir = os.path.join(manifest_dir, os.path.expanduser(output_dir))
+                    else:
+                        output_dir = os.path.join(self.output_dir, user)
+                    accounts.append((user, output_dir))
+        except OSError as e:
+            raise GcardvaultError(f"Could not read manifest file: {e}") from e
+
+        users = [user for (user, _) in accounts]
+        if len(set(users)) != len(users):
+            raise GcardvaultError("Manifest file lists the same user more than once")
+
+        return accounts
+
+    def _make_paths_absolute(self):
+        # GitPython changes the process's working directory while it stages
+        # files, so with several syncs in one process a relative path could
+        # resolve into another account's vault
+        self.conf_dir = os.path.abspath(self.conf_dir)
+        self.output_dir = os.path.abspath(self.output_dir)
+        for attr in ['metrics_file', 'prometheus_file', 'status_file']:
+            if getattr(self, attr) is not None:
+                setattr(self, attr, os.path.abspath(getattr(self, attr)))
+        if self.pack is not None and self.pack != PACK_STDOUT:
+            self.pack = os.path.abspath(self.pack)
+
+    def _sync_account(self, user, output_dir):
+        gc = Gcardvault(google_oauth2=self._google_oauth2, google_apis=self._google_apis.share())
+        for attr in ['export_only', 'clean', 'parallel', 'sync_mode', 'conf_dir', 'client_id', 'client_secret',
+                     'batch_size_min', 'batch_size_max', 'batch_target_secs', 'rate_limit', 'rebuild_manifest',
+                     'layout', 'auto_maintain', 'lock_wait']:
+            setattr(gc, attr, getattr(self, attr))
+        gc.command = "sync"
+        gc.user = user
+        gc.output_dir = output_dir
+        gc._log_prefix = f"[{user}] "
+
+        start = time.monotonic()
+        try:
+            # Can't prompt for a login with several accounts syncing at once
+            if not os.path.exists(gc._token_file_path()):
+                raise GcardvaultError(f"No saved credentials, run 'gcardvault login {user}' first")
+            gc.sync()
+            return (None, gc._sync_counts, time.monotonic() - start, gc)
+        except Exception as e:
+            gc._log(f"Sync failed: {e}")
+            return (e, None, time.monotonic() - start, gc)
+
     def usage(self):
         return pathlib.Path(usage_file_path).read_text().strip()
 
@@ -125,6 +591,11 @@ class Gcardvault:
                 ['export-only', 'clean',
                     'conf-dir=', 'output-dir=', 'vault-dir=',
                     'client-id=', 'client-secret=',
+                    'parallel=', 'sync-mode=', 'parallel-accounts=',
+                    'interval=', 'status-file=',
+                    'batch-size-min=', 'batch-size-max=', 'batch-target-secs=',
+                    'rate-limit=', 'rebuild-manifest', 'layout=', 'pack=',
+                    'auto-maintain', 'lock-wait=', 'metrics-file=', 'prometheus-file=',
                     'help', 'version', ]
             )
         except GetoptError as e:
@@ -143,6 +614,42 @@ class Gcardvault:
                 self.client_id = val
             elif opt in ['--client-secret']:
                 self.client_secret = val
+            elif opt in ['--parallel']:
+                self.parallel = self._parse_positive_int(opt, val)
+            elif opt in ['--parallel-accounts']:
+                self.parallel_accounts = self._parse_positive_int(opt, val)
+            elif opt in ['--prometheus-file']:
+                self.prometheus_file = val
+            elif opt in ['--metrics-file']:
+                self.metrics_file = val
+            elif opt in ['--auto-maintain']:
+                self.auto_maintain = True
+            elif opt in ['--lock-wait']:
+                self.lock_wait = self._parse_non_negative_int(opt, val)
+            elif opt in ['--pack']:
+                self.pack = val
+            elif opt in ['--layout']:
+                if val not in VAULT_LAYOUTS:
+                    raise GcardvaultError(f"Invalid layout '{val}', must be one of {', '.join(VAULT_LAYOUTS)}", "layout")
+                self.layout = val
+            elif opt in ['--rebuild-manifest']:
+                self.rebuild_manifest = True
+            elif opt in ['--rate-limit']:
+                self.rate_limit = self._parse_positive_int(opt, val)
+            elif opt in ['--batch-size-min']:
+                self.batch_size_min = self._parse_positive_int(opt, val)
+            elif opt in ['--batch-size-max']:
+                self.batch_size_max = self._parse_positive_int(opt, val)
+            elif opt in ['--batch-target-secs']:
+                self.batch_target_secs = self._parse_positive_int(opt, val)
+            elif opt in ['--interval']:
+                self.interval = self._parse_positive_int(opt, val)
+            elif opt in ['--status-file']:
+                self.status_file = val
+            elif opt in ['--sync-mode']:
+                if val not in SYNC_MODES:
+                    raise GcardvaultError(f"Invalid {opt} argument, must be one of: {', '.join(SYNC_MODES)}", opt)
+                self.sync_mode = val
             elif opt in ['-h', '--help']:
                 show_help = True
             elif opt in ['--version']:
@@ -151,6 +658,15 @@ class Gcardvault:
         if len(opts) == 0 and len(pos_args) == 0:
             show_help = True
 
+        if self.batch_size_min > self.batch_size_max:
+            raise GcardvaultError("--batch-size-min cannot be greater than --batch-size-max", "batch-size-min")
+
+        if self.pack is not None:
+            # Pack holds every contact, so it can't be built from changes alone
+            if self.sync_mode != "full":
+                raise GcardvaultError("--pack can only be used with the full sync mode", "pack")
+            self.export_only = True
+
         if show_help:
             print(self.usage())
             return False
@@ -161,19 +677,51 @@ class Gcardvault:
         if len(pos_args) >= 1:
             self.command = pos_args[0]
         if len(pos_args) >= 2:
-            self.user = pos_args[1].lower().strip()
+            if self.command == "sync-all":
+                self.manifest_file = pos_args[1]
+            else:
+                self.user = pos_args[1].lower().strip()
 
         if self.command is None:
             raise GcardvaultError("<command> argument is required", "command")
         if self.command not in COMMANDS:
             raise GcardvaultError("Invalid <command> argument", "command")
-        if self.user is None:
+        if self.command == "sync-all":
+            if self.manifest_file is None:
+                raise GcardvaultError("<manifest> argument is required", "manifest")
+        elif self.user is None and self.command != "maintain":
             raise GcardvaultError("<user> argument is required", "user")
         if len(pos_args) > 2:
             raise GcardvaultError("Unrecognized arguments")
 
         return True
 
+    def _parse_positive_int(self, opt, val):
+        try:
+            num = int(val)
+        except ValueError:
+            num = 0
+        if num < 1:
+            raise GcardvaultError(f"{opt} must be a positive integer", opt)
+        return num
+
+    def _parse_non_negative_int(self, opt, val):
+        try:
+            num = int(val)
+        except ValueError:
+            num = -1
+        if num < 0:
+            raise GcardvaultError(f"{opt} must be a non-negative integer", opt)
+        return num
+
+    def _log(self, message):
+        if self.progress is not None:
+            self.progress(f"{self._log_prefix}{message}")
+            return
+        # Keep stdout clean when the pack is being written to it
+        file = sys.stderr if self.pack == PACK_STDOUT else sys.stdout
+        print(f"{self._log_prefix}{message}", file=file)
+
     def _ensure_dirs(self):
         for dir in [self.conf_dir, self.output_dir]:
             pathlib.Path(dir).mkdir(parents=True, exist_ok=True)
@@ -184,27 +732,141 @@ class Gcardvault:
             flags = f' --client-id "{client_id}" --client-secret "{client_secret}"'
         return f"gcardvault authorize {email_addr}{flags}"
 
+    @contextmanager
+    def _lock_sync(self):
+        # The user's state (token, etags, sync tokens) and the vault are
+        # locked separately, since either could be shared with another sync
+        self._ensure_dirs()
+        with self._lock(os.path.join(self.conf_dir, f"{self.user}.lock"), f"State for {self.user}"), \
+                self._lock(os.path.join(self.output_dir, VAULT_LOCK_FILE_NAME), "Vault"):
+            yield
+
+    @contextmanager
+    def _lock(self, path, description):
+        try:
+            lock = FileLock(path, self.lock_wait).acquire()
+        except LockTimeoutError as e:
+            holder = f" (process {e.holder_pid})" if e.holder_pid else ""
+            raise GcardvaultError(
+                f"{description} is in use by another gcardvault run{holder}, "
+                f"use --lock-wait to wait for it") from e
+        try:
+            yield
+        finally:
+            lock.release()
+
     def _token_file_path(self):
         return os.path.join(self.conf_dir, f"{self.user}.token.json")
+
+    def _sync_token_name(self, api):
+        return f"{self.user}:{api}"
     
-    def _get_contacts(self, credentials):
+    def _run_sync_pipeline(self, credentials):
+        # Listing, downloading and saving all overlap: stale contacts are
+        # queued for download as soon as each page of contacts is listed,
+        # and vCards are queued to be saved as soon as they're downloaded
+        pipeline = Pipeline()
+        batches = pipeline.queue(maxsize=self.parallel * 2)
+        vcards = pipeline.queue(maxsize=PIPELINE_VCARD_QUEUE_SIZE)
+        listing = {}
+        saving = {'unchanged': 0}
+        self._batch_sizer = BatchSizer(
+            CARDDAV_REPORT_PAGE_SIZE, self.batch_size_min, self.batch_size_max,
+            self.batch_target_secs, CARDDAV_BATCH_TARGET_BYTES)
+
+        pipeline.stage("list", self._list_contacts_to_update, credentials, batches, listing, output=batches)
+        pipeline.stage("download", self._get_vcards_for_contacts, credentials, batches, vcards,
+                       workers=self.parallel, output=vcards)
+        pipeline.stage("save", self._save_vcards, vcards, saving)
+        pipeline.join()
+
+        counts = listing['counts']
+        counts['unchanged'] = saving['unchanged']
+        self._log(f"{counts['unchanged']} contact(s) were unchanged after download")
+
+        return (listing['contacts'], listing['deleted_contact_ids'], counts)
+
+    def _list_contacts_to_update(self, credentials, batches, listing):
+        contacts_to_update = []
+        counts = {'up_to_date': 0, 'to_update': 0}
+
+        def queue_contacts_to_update(contacts):
+            with self._metrics.phase("filter_contacts", len(contacts)):
+                contacts_to_update.extend(self._filter_contacts_to_update(contacts, counts))
+            # Sized according to how the downloads have gone so far
+            while len(contacts_to_update) >= self._batch_sizer.size:
+                size = self._batch_sizer.size
+                batches.put(contacts_to_update[:size])
+                del contacts_to_update[:size]
+
+        # Includes filtering and handing batches on to the downloads
+        with self._metrics.phase("list_contacts"):
+            if self.sync_mode == "carddav":
+                (contacts, deleted_contact_ids) = self._get_contacts_from_carddav(credentials, queue_contacts_to_update)
+            else:
+                (contacts, deleted_contact_ids) = self._get_contacts(credentials, queue_contacts_to_update)
+        self._metrics.add_items("list_contacts", len(contacts))
+
+        if contacts_to_update:
+            batches.put(contacts_to_update)
+
+        self._log(f"{counts['up_to_date']} contact(s) are up to date")
+        self._log(f"{counts['to_update']} contact(s) need to be updated")
+
+        listing['contacts'] = contacts
+        listing['deleted_contact_ids'] = deleted_contact_ids
+        listing['counts'] = counts
+
+    def _get_contacts(self, credentials, on_contacts):
+        sync_token = None
+        if self.sync_mode == "incremental":
+            sync_token = self._etags.get_sync_token(self._sync_token_name("people"))
+
+        try:
+            return self._list_contacts(credentials, sync_token, on_contacts)
+        except SyncTokenExpiredError:
+            self._log("Sync token has expired, listing all contacts")
+            return self._list_contacts(credentials, None, on_contacts)
+
+    def _list_contacts(self, credentials, sync_token, on_contacts):
         contacts = []
+        # Deletions are only reported when listing changes since a sync token,
+        # a full listing leaves it to the caller to diff against what's on disk
+        deleted_contact_ids = [] if sync_token else None
+        request_sync_token = self.sync_mode == "incremental"
+
+        if sync_token:
+            self._log("Listing contacts changed since last sync")
 
         next_page_token = None
         while True:
-            resource = self._google_apis.request_contact_list(credentials, page_token=next_page_token)
-            self._add_contacts_from_resource(contacts, resource)
+            resource = self._google_apis.request_contact_list(
+                credentials, page_token=next_page_token,
+                sync_token=sync_token, request_sync_token=request_sync_token)
+            page_contacts = []
+            self._add_contacts_from_resource(page_contacts, deleted_contact_ids, resource)
+            contacts.extend(page_contacts)
+            on_contacts(page_contacts)
 
             next_page_token = resource.get('nextPageToken')
             if next_page_token is None:
                 break
 
-        return contacts
+        if request_sync_token:
+            # Saved along with the etags, only once the sync succeeds
+            self._etags.set_sync_token(self._sync_token_name("people"), resource.get('nextSyncToken'))
+
+        return (contacts, deleted_contact_ids)
 
-    def _add_contacts_from_resource(self, contacts, resource):
+    def _add_contacts_from_resource(self, contacts, deleted_contact_ids, resource):
         for connection in resource.get('connections', []):
             contact = self._get_contact_from_connection(connection)
-            if contact:
+            if not contact:
+                continue
+            if connection.get('metadata', {}).get('deleted'):
+                if deleted_contact_ids is not None:
+                    deleted_contact_ids.append(contact.id)
+            else:
                 contacts.append(contact)
 
     def _get_contact_from_connection(self, connection):
@@ -226,60 +888,162 @@ class Gcardvault:
         if contact_source:
             id = contact_source['id']
             etag = contact_source['etag']
-            return Contact(id, display_name, self.user, etag)
+            return Contact(id, display_name, self.user, etag, layout=self._layout)
 
         return None
 
-    def _clean_output_dir(self, contacts):
-        contact_ids = [contact.id for contact in contacts]
-        files_on_disk = self._get_vcard_files_on_disk()
-        for contact_id in files_on_disk:
-            if contact_id not in contact_ids:
-                file_name = files_on_disk[contact_id]
+    def _get_contacts_from_carddav(self, credentials, on_contacts):
+        sync_token = self._etags.get_sync_token(self._sync_token_name("carddav"))
+
+        try:
+            (contacts, deleted_contact_ids) = self._sync_carddav_collection(credentials, sync_token)
+        except SyncTokenExpiredError:
+            self._log("Sync token has expired, listing all contacts")
+            (contacts, deleted_contact_ids) = self._sync_carddav_collection(credentials, None)
+
+        on_contacts(contacts)
+        return (contacts, deleted_contact_ids)
+
+    def _sync_carddav_collection(self, credentials, sync_token):
+        ns = {"d": "DAV:", }
+
+        contacts = {}
+        deleted_contact_ids = [] if sync_token else None
+        # Pulls in urllib.request, so only for the sync mode that needs it
+        from xml.sax.saxutils import escape as xml_escape
+
+        addressbook_href = GOOGLE_CARDDAV_CONTACT_HREF_FORMAT.format(principal=self.user, contact_id="")
+
+        if sync_token:
+            self._log("Listing contacts changed since last sync")
+
+        # Server may truncate the results (507 on the collection itself),
+        # in which case the request is repeated with the new sync token
+        truncated = True
+        while truncated:
+            truncated = False
+            request_body = f"""
+<d:sync-collection xmlns:d="{ns['d']}">
+    <d:sync-token>{xml_escape(sync_token or "")}</d:sync-token>
+    <d:sync-level>1</d:sync-level>
+    <d:prop>
+        <d:getetag />
+    </d:prop>
+</d:sync-collection>
+"""
+
+            chunks = self._google_apis.request_carddav_report(credentials, self.user, request_body, depth="0")
+            for response in iter_multistatus(chunks):
+                if response.tag == f"{{{ns['d']}}}sync-token":
+                    sync_token = response.text
+                    continue
+
+                href = response.findtext("d:href", namespaces=ns)
+                if href.rstrip("/") == addressbook_href.rstrip("/"):
+                    truncated = response.findtext("d:status", namespaces=ns) == "HTTP/1.1 507 Insufficient Storage"
+                    continue
+
+                contact_id = href.rstrip("/").split("/")[-1]
+                if response.findtext("d:status", namespaces=ns) == "HTTP/1.1 404 Not Found":
+                    contacts.pop(contact_id, None)
+                    if deleted_contact_ids is not None:
+                        deleted_contact_ids.append(contact_id)
+                    continue
+
+                for propstat in response.findall("d:propstat", namespaces=ns):
+                    if propstat.findtext("d:status", namespaces=ns) == "HTTP/1.1 200 OK":
+                        etag = propstat.findtext("d:prop/d:getetag", namespaces=ns)
+                        if etag:
+                            contacts[contact_id] = self._get_contact_from_carddav(contact_id, etag)
+
+        # Saved along with the etags, only once the sync succeeds
+        self._etags.set_sync_token(self._sync_token_name("carddav"), sync_token)
+
+        return (list(contacts.values()), deleted_contact_ids)
+
+    def _get_contact_from_carddav(self, contact_id, etag):
+        # Name isn't known until the vCard is downloaded, assume the file
+        # name is unchanged until then
+        contact = Contact(contact_id, None, self.user, etag, layout=self._layout)
+        contact.etag_key = f"carddav:{contact_id}"
+        contact.file_name = self._manifest.get_file_name(contact_id, contact.file_name)
+        return contact
+
+    def _clean_output_dir(self, contacts, deleted_contact_ids=None):
+        ids_in_vault = self._manifest.ids()
+        if deleted_contact_ids is None:
+            contact_ids = {contact.id.lower() for contact in contacts}
+            contact_ids_to_remove = sorted(ids_in_vault - contact_ids)
+        else:
+            contact_ids_to_remove = [contact_id.lower() for contact_id in deleted_contact_ids
+                                     if contact_id.lower() in ids_in_vault]
+
+        for contact_id in contact_ids_to_remove:
+            file_name = self._manifest.get_file_name(contact_id)
+            try:
                 os.remove(os.path.join(self.output_dir, file_name))
-                if self._repo:
-                    self._repo.remove_file(file_name)
-                print(f"Removed file '{file_name}'")
+            except FileNotFoundError:
+                pass
+            self._manifest.remove(contact_id)
+            self._files_removed.add(file_name)
+            self._log(f"Removed file '{file_name}'")
+
+        return len(contact_ids_to_remove)
 
-    def _filter_contacts_to_update(self, contacts):
+    def _filter_contacts_to_update(self, contacts, counts):
         contacts_to_update = []
-        contacts_up_to_date = 0
-        etags = ETagManager(self.conf_dir)
 
         for contact in contacts:
-            vcard_file_path = os.path.join(self.output_dir, contact.file_name)
+            if self.pack is None:
+                vcard_file_path = os.path.join(self.output_dir, contact.file_name)
 
-            etag_changed = etags.test_for_change_and_save(contact.id, contact.etag)
-            if os.path.exists(vcard_file_path) and not etag_changed:
-                contacts_up_to_date += 1
-                continue
+                etag_changed = self._etags.test_for_change(contact.etag_key, contact.etag)
+                if os.path.exists(vcard_file_path) and not etag_changed:
+                    counts['up_to_date'] += 1
+                    continue
 
             contacts_to_update.append(contact)
-
-        print(f"{contacts_up_to_date} contact(s) are up to date")
-        print(f"{len(contacts_to_update)} contact(s) need to be updated")
+            counts['to_update'] += 1
 
         return contacts_to_update
 
-    def _get_vcards_for_contacts(self, credentials, contacts):
-        vcards = {}
+    def _get_vcards_for_contacts(self, credentials, batches, vcards):
+        for contacts_in_batch in batches:
+            self._get_vcards_for_contacts_adaptively(credentials, contacts_in_batch, vcards, set())
 
-        print(f"Downloading vCards for {len(contacts)} contact(s)")
+    def _get_vcards_for_contacts_adaptively(self, credentials, contacts, vcards, delivered_hrefs, attempt=1):
+        self._log(f"Downloading vCards for {len(contacts)} contact(s)")
 
-        count = CARDDAV_REPORT_PAGE_SIZE
-        start = 0
-        while start < len(contacts):
-            end = start + count
-            contacts_in_batch = contacts[start:end]
-            self._get_vcards_for_contacts_batch(credentials, contacts_in_batch, vcards)
-            start += count
+        start = time.monotonic()
+        try:
+            bytes_received = self._get_vcards_for_contacts_batch(credentials, contacts, vcards, delivered_hrefs)
+        except TransientApiError as e:
+            self._metrics.add_phase("download_vcards", time.monotonic() - start)
+            # Server errors and timeouts are often down to the response being
+            # too big, so retry what failed in smaller batches
+            self._batch_sizer.record_failure(len(contacts))
+            if attempt >= CARDDAV_BATCH_ATTEMPTS:
+                raise
+            self._metrics.record_retry("carddav")
+            # vCards parsed before the failure have already been handed off
+            # to be saved, so only the rest are downloaded again
+            contacts = [contact for contact in contacts if contact.carddav_href not in delivered_hrefs]
+            size = self._batch_sizer.size
+            self._log(f"Download failed ({e}), retrying in batches of {size}")
+            for start in range(0, len(contacts), size):
+                self._get_vcards_for_contacts_adaptively(
+                    credentials, contacts[start:start + size], vcards, delivered_hrefs, attempt + 1)
+            return
 
-        return vcards
+        elapsed = time.monotonic() - start
+        self._metrics.add_phase("download_vcards", elapsed, len(contacts))
+        self._batch_sizer.record_success(len(contacts), elapsed, bytes_received)
 
-    def _get_vcards_for_contacts_batch(self, credentials, contacts, vcards):
+    def _get_vcards_for_contacts_batch(self, credentials, contacts, vcards, delivered_hrefs):
         ns = {"d": "DAV:", "card": "urn:ietf:params:xml:ns:carddav", }
 
-        carddav_hrefs = [contact.carddav_href for contact in contacts]
+        contacts_by_href = {contact.carddav_href: contact for contact in contacts}
+        carddav_hrefs = list(contacts_by_href.keys())
         carddav_href_xml_nodes = "<d:href>" + "</d:href><d:href>".join(carddav_hrefs) + "</d:href>"
 
         request_body = f"""
@@ -291,64 +1055,191 @@ class Gcardvault:
 </card:addressbook-multiget>
 """
 
-        xml = self._google_apis.request_carddav_report(credentials, self.user, request_body)
-        multistatus = ElementTree.fromstring(xml)
+        # Each vCard is handed off to be saved as soon as its response element
+        # has been parsed, rather than holding the whole batch in memory
+        bytes_received = 0
 
-        for response in multistatus:
+        def count_bytes(chunks):
+            nonlocal bytes_received
+            for chunk in chunks:
+                bytes_received += len(chunk)
+                yield chunk
+
+        chunks = self._google_apis.request_carddav_report(credentials, self.user, request_body)
+        for response in iter_multistatus(count_bytes(chunks)):
             href = response.findtext("d:href", namespaces=ns)
+            contact = contacts_by_href.get(href)
+            if contact is None or href in delivered_hrefs:
+                continue
 
             for propstat in response.findall("d:propstat", namespaces=ns):
                 if propstat.findtext("d:status", namespaces=ns) == "HTTP/1.1 200 OK":
                     vcard = propstat.findtext("d:prop/card:address-data", namespaces=ns)
                     if vcard:
-                        vcards[href] = vcard
+                        vcards.put((contact, vcard))
+                        delivered_hrefs.add(href)
 
         for contact in contacts:
-            if contact.carddav_href not in vcards:
+            if contact.carddav_href not in delivered_hrefs:
                 raise RuntimeError(f"vCard could not be downloaded for contact '{contact.name}'")
 
-    def _save_vcards(self, contacts, vcards):
-        files_on_disk = self._get_vcard_files_on_disk()
-        for contact in contacts:
-            vcard = vcards[contact.carddav_href]
-            target_file_path = os.path.join(self.output_dir, contact.file_name)
-
-            existing_file_name = files_on_disk.get(contact.id)
-            if existing_file_name and existing_file_name != contact.file_name:
-                existing_file_path = os.path.join(self.output_dir, existing_file_name)
+        return bytes_received
+
+    def _save_vcards(self, vcards, counts):
+        for (contact, vcard) in vcards:
+            with self._metrics.phase("save_vcards", 1):
+                if self._pack_writer is not None:
+                    self._pack_writer.write(contact.id, vcard)
+                elif not self._save_vcard(contact, vcard):
+                    counts['unchanged'] += 1
+
+    def _save_vcard(self, contact, vcard):
+        if self.sync_mode == "carddav":
+            # No name from the People API, take it from the vCard itself
+            contact = Contact(contact.id, get_vcard_formatted_name(vcard), contact.principal, contact.etag,
+                              layout=self._layout)
+
+        target_file_path = os.path.join(self.output_dir, contact.file_name)
+        os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
+
+        entry = self._manifest.get(contact.id)
+        if entry and entry['file_name'] != contact.file_name:
+            existing_file_path = os.path.join(self.output_dir, entry['file_name'])
+            if os.path.exists(existing_file_path):
                 os.rename(existing_file_path, target_file_path)
+            self._files_removed.add(entry['file_name'])
+            self._files_written.add(contact.file_name)
+            entry = dict(entry, file_name=contact.file_name)
+
+        # Google bumps etags for changes that don't show up in the vCard, so
+        # leave the file (and its mtime) alone if the content is the same
+        content_hash = hashlib.sha256(vcard.encode('utf-8')).hexdigest()
+        stat = self._get_vcard_file_stat_if_unchanged(contact.file_name, content_hash, entry)
+        if stat:
+            self._manifest.set(contact.id, contact.file_name, contact.etag, content_hash, stat.st_size, stat.st_mtime_ns)
+            if self._repo and self._repo.needs_commit(contact.file_name, vcard.encode('utf-8')):
+                # Left behind uncommitted by an earlier sync that failed
+                self._files_written.add(contact.file_name)
+            self._log(f"Contact '{contact.name}' is unchanged in {contact.file_name}")
+            return False
 
-            with open(target_file_path, 'w') as file:
-                file.write(vcard)
+        with open(target_file_path, 'w', encoding='utf-8', newline='') as file:
+            file.write(vcard)
+        stat = os.stat(target_file_path)
+        self._manifest.set(contact.id, contact.file_name, contact.etag, content_hash, stat.st_size, stat.st_mtime_ns)
+        self._files_written.add(contact.file_name)
 
-            print(f"Saved contact '{contact.name}' to {contact.file_name}")
+        self._log(f"Saved contact '{contact.name}' to {contact.file_name}")
+        return True
 
-    def _get_vcard_files_on_disk(self):
-        files_on_disk = {}
-        files_names = [os.path.basename(file).lower() for file in glob.glob(os.path.join(self.output_dir, "*.vcf"))]
-        for file_name in files_names:
-            file_name_wo_ext = os.path.splitext(file_name)[0]
-            id = file_name_wo_ext.split("_")[-1]
-            files_on_disk[id] = file_name
-        return files_on_disk
+    def _get_vcard_file_stat_if_unchanged(self, file_name, content_hash, entry):
+        file_path = os.path.join(self.output_dir, file_name)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+
+        # Hash in the manifest is only trusted if the file hasn't been
+        # touched since it was written, otherwise hash what's on disk
+        if entry and entry['content_hash'] and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return stat if entry['content_hash'] == content_hash else None
+
+        with open(file_path, 'rb') as file:
+            file_hash = hashlib.sha256(file.read()).hexdigest()
+        return stat if file_hash == content_hash else None
+
+
+def get_vault_file_path(file_name, id, layout):
+    """Path of a contact's file relative to the vault. The sharded layout
+    spreads files across 256 subdirectories keyed by a hash of the ID, so
+    no one directory gets too big."""
+    if layout == "sharded":
+        shard = hashlib.sha1(id.lower().encode('utf-8')).hexdigest()[:2]
+        return f"{shard}/{file_name}"
+    return file_name
+
+
+def iter_multistatus(chunks):
+    """Incrementally parses a DAV multistatus document from an iterable of
+    chunks, yielding each top-level element (e.g. d:response) as soon as it's
+    complete. Elements are discarded once the caller is done with them."""
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    root = None
+    depth = 0
+
+    def read_events():
+        nonlocal root, depth
+        for (event, elem) in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1:
+                    yield elem
+                    root.remove(elem)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from read_events()
+
+    # Raises if the document was truncated
+    parser.close()
+    yield from read_events()
+
+
+def get_vcard_formatted_name(vcard):
+    # Unfold continuation lines (RFC 6350 3.2) before looking for FN
+    lines = vcard.replace("\r\n", "\n").replace("\n ", "").replace("\n\t", "").split("\n")
+    for line in lines:
+        (name, _, value) = line.partition(":")
+        if name.split(";")[0].split(".")[-1].upper() == "FN":
+            value = value.replace("\\n", " ").replace("\\N", " ")
+            for char in [",", ";", "\\"]:
+                value = value.replace(f"\\{char}", char)
+            return value.strip() or None
+    return None
 
 
 class GcardvaultError(ValueError):
     pass
 
 
+class SyncTokenExpiredError(Exception):
+    pass
+
+
+class TransientApiError(Exception):
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimitedError(TransientApiError):
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message, status)
+        self.retry_after = retry_after
+
+
 class Contact():
 
-    def __init__(self, id, name, principal, etag):
+    def __init__(self, id, name, principal, etag, layout="flat"):
         self.id = id
         self.name = name if name else id
         self.principal = principal
         self.etag = etag
+        self.etag_key = id
 
         prefix = "contact"
         if name:
             prefix = "_".join(name.strip().lower().split())
-        self.file_name = f"{prefix}_{id.lower()}.vcf"
+            # Otherwise a name like "AC/DC" would be saved in a subdirectory
+            for sep in {"/", os.sep}:
+                prefix = prefix.replace(sep, "_")
+        self.file_name = get_vault_file_path(f"{prefix}_{id.lower()}.vcf", id, layout)
 
         self.carddav_href = GOOGLE_CARDDAV_CONTACT_HREF_FORMAT.format(
             principal=self.principal,
@@ -358,23 +1249,192 @@ class Contact():
 
 class GoogleApis():
 
-    def request_contact_list(self, credentials, page_token=None):
-        with build('people', 'v1', credentials=credentials) as service:
-            return service.people().connections().list(
-                resourceName="people/me",
-                sources="READ_SOURCE_TYPE_CONTACT",
-                personFields="metadata,names",
-                sortOrder="FIRST_NAME_ASCENDING",
-                pageSize=CONTACT_RESOURCE_PAGE_SIZE,
-                pageToken=page_token,
-            ).execute()
-
-    def request_carddav_report(self, credentials, principal, request_body):
-        url = GOOGLE_CARDDAV_ADDRESSBOOK_URI_FORMAT.format(principal=principal)
+    def __init__(self, pool_size=CARDDAV_POOL_SIZE, rate_limit=API_RATE_LIMIT, people_api_url=None, carddav_url=None):
+        self.pool_size = pool_size
+        self.rate_limit = rate_limit
+        # Can be pointed elsewhere, e.g. at a local stand-in for testing
+        self.people_api_url = people_api_url or os.getenv("GCARDVAULT_PEOPLE_API_URL", GOOGLE_PEOPLE_API_URL)
+        self.carddav_url = carddav_url or os.getenv("GCARDVAULT_CARDDAV_URL", GOOGLE_CARDDAV_URL)
+        self.metrics = None
+        self._shared_from = None
+        self._session = None
+        self._people_service = None
+        self._people_service_credentials = None
+        self._lock = threading.Lock()
+
+    def request_contact_list(self, credentials, page_token=None, sync_token=None, request_sync_token=False):
+        from googleapiclient.errors import HttpError
+
+        service = self._get_people_service(credentials)
+
+        params = {}
+        if request_sync_token:
+            # All requests in a sync (incl. those using the token later)
+            # must have the same parameters, so sort order is left out
+            params["requestSyncToken"] = True
+            if sync_token:
+                params["syncToken"] = sync_token
+        else:
+            params["sortOrder"] = "FIRST_NAME_ASCENDING"
+
+        request = service.people().connections().list(
+            resourceName="people/me",
+            sources="READ_SOURCE_TYPE_CONTACT",
+            personFields="metadata,names",
+            pageSize=CONTACT_RESOURCE_PAGE_SIZE,
+            pageToken=page_token,
+            **params,
+        )
+
+        def execute():
+            try:
+                start = time.monotonic()
+                resource = request.execute()
+                self._record_request("people", time.monotonic() - start)
+                if self.metrics is not None:
+                    # The client hands back the parsed response, so this is the
+                    # size it re-serializes to rather than what came over the wire
+                    self._record_bytes("people", len(json.dumps(resource)))
+                return resource
+            except HttpError as e:
+                if b"EXPIRED_SYNC_TOKEN" in (e.content or b""):
+                    raise SyncTokenExpiredError() from e
+                if e.resp.status in API_RATE_LIMITED_STATUSES:
+                    raise RateLimitedError(
+                        f"People API request failed with HTTP {e.resp.status}", e.resp.status,
+                        parse_retry_after(e.resp.get("retry-after"))) from e
+                raise
+
+        return self._request_with_backoff("people", credentials, execute)
+
+    def request_carddav_report(self, credentials, principal, request_body, depth=None):
+        import requests
+
+        url = GOOGLE_CARDDAV_ADDRESSBOOK_URI_FORMAT.format(carddav_url=self.carddav_url, principal=principal)
         headers = {
             "Authorization": f"Bearer {credentials.token}",
             "Content-Type": "application/xml; charset=utf-8",
         }
-        response = requests.request("REPORT", url, headers=headers, data=request_body)
-        response.raise_for_status()
-        return response.text
+        if depth is not None:
+            headers["Depth"] = depth
+
+        def request():
+            try:
+                start = time.monotonic()
+                # Returns once the headers are in, so this is time to first byte
+                response = self._get_session().request(
+                    "REPORT", url, headers=headers, data=request_body, stream=True,
+                    timeout=(CARDDAV_CONNECT_TIMEOUT, CARDDAV_READ_TIMEOUT))
+                self._record_request("carddav", time.monotonic() - start)
+                return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise TransientApiError(f"CardDAV request failed: {e}") from e
+
+        def request_within_quota():
+            response = request()
+            if response.status_code in API_RATE_LIMITED_STATUSES:
+                response.close()
+                raise RateLimitedError(
+                    f"CardDAV request failed with HTTP {response.status_code}", response.status_code,
+                    parse_retry_after(response.headers.get("Retry-After")))
+            return response
+
+        response = self._request_with_backoff("carddav", credentials, request_within_quota)
+
+        if response.status_code in [403, 409] and b"valid-sync-token" in response.content:
+            response.close()
+            raise SyncTokenExpiredError()
+        if response.status_code >= 500:
+            response.close()
+            raise TransientApiError(f"CardDAV request failed with HTTP {response.status_code}", response.status_code)
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        return self._iter_response_content(response)
+
+    def share(self):
+        # For use by another sync running alongside this one, each gets its
+        # own People client but they all share the same pooled HTTP session
+        shared = GoogleApis(pool_size=self.pool_size, rate_limit=self.rate_limit,
+                            people_api_url=self.people_api_url, carddav_url=self.carddav_url)
+        shared._shared_from = self
+        return shared
+
+    def close(self):
+        with self._lock:
+            if self._people_service is not None:
+                self._people_service.close()
+                self._people_service = None
+                self._people_service_credentials = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _record_request(self, api, latency_secs):
+        if self.metrics is not None:
+            self.metrics.record_request(api, latency_secs)
+
+    def _record_bytes(self, api, bytes_received):
+        if self.metrics is not None:
+            self.metrics.record_bytes(api, bytes_received)
+
+    def _record_retry(self, api):
+        if self.metrics is not None:
+            self.metrics.record_retry(api)
+
+    def _request_with_backoff(self, api, credentials, request):
+        # Shared by every sync in the process using the same client, so they
+        # all slow down together when any one of them hits the quota
+        rate_limiter = get_rate_limiter(api, getattr(credentials, "client_id", None), self.rate_limit)
+        attempt = 0
+        while True:
+            rate_limiter.acquire()
+            try:
+                return request()
+            except RateLimitedError as e:
+                attempt += 1
+                if attempt >= API_RATE_LIMITED_ATTEMPTS:
+                    raise
+                self._record_retry(api)
+                rate_limiter.back_off(get_backoff_secs(attempt, e.retry_after))
+
+    def _iter_response_content(self, response):
+        import requests
+        from requests.exceptions import ChunkedEncodingError
+
+        # Connection goes back to the pool once the body is consumed
+        with response:
+            try:
+                for chunk in response.iter_content(chunk_size=CARDDAV_STREAM_CHUNK_SIZE):
+                    self._record_bytes("carddav", len(chunk))
+                    yield chunk
+            except (requests.ConnectionError, requests.Timeout, ChunkedEncodingError) as e:
+                raise TransientApiError(f"CardDAV response interrupted: {e}") from e
+
+    def _get_people_service(self, credentials):
+        # Built once and reused for every page, rebuilt only if the
+        # credentials change (e.g. a different user)
+        with self._lock:
+            if self._people_service is None or self._people_service_credentials is not credentials:
+                if self._people_service is not None:
+                    self._people_service.close()
+                self._people_service = build_service('people', 'v1', credentials, api_endpoint=self.people_api_url)
+                self._people_service_credentials = credentials
+            return self._people_service
+
+    def _get_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if self._shared_from is not None:
+            return self._shared_from._get_session()
+        with self._lock:
+            if self._session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+                self._session = requests.Session()
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+            return self._session
@@ -1,28 +1,41 @@
 import os
+import hashlib
+import threading
+import time
 from git import Repo, exc
 
 
+# Note: Some GitPython index operations change the process's working
+# directory while they run, so repo operations are serialized across all
+# vaults in case several are being synced at once.
+_git_lock = threading.RLock()
+
+
 class GitVaultRepo():
 
-    def __init__(self, package_name, package_version, dir_path, extensions):
+    def __init__(self, package_name, package_version, dir_path, extensions, log=print):
         self._package_name = package_name
         self._extensions = extensions
+        self._log = log
         self._repo = None
-        
-        try:
-            self._repo = Repo(dir_path)
-        except exc.InvalidGitRepositoryError:
-            self._repo = Repo.init(dir_path)
-            self._repo.config_writer().set_value(self._package_name, 'vault', package_version).release()
-            self._add_gitignore()
-            print(f"Created {self._package_name} repository")
+        self._staged_paths = set()
+        self._committed_blobs = None
+
+        with _git_lock:
+            try:
+                self._repo = Repo(dir_path)
+            except exc.InvalidGitRepositoryError:
+                self._repo = Repo.init(dir_path)
+                self._repo.config_writer().set_value(self._package_name, 'vault', package_version).release()
+                self._add_gitignore()
+                self._log(f"Created {self._package_name} repository")
 
         is_vault = \
             len(self._repo.config_reader().get_value(self._package_name, 'vault', default='')) > 0
         self._msg_prefix = ""
         self._dry_run = False
         if not is_vault:
-            print(f"WARNING: Git repository does not appear to have been "
+            self._log(f"WARNING: Git repository does not appear to have been "
                 f"created by {self._package_name}, no changes will be committed. "
                 f"\nTo enable it as a {self._package_name} vault, run:"
                 f"\n  cd {dir_path}"
@@ -30,39 +43,173 @@ class GitVaultRepo():
             self._dry_run = True
             self._msg_prefix = "[DRY RUN] "
 
-    def add_file(self, file_name):
-        print(f"{self._msg_prefix}Adding {file_name} to {self._package_name} repository")
+    def add_files(self, file_names):
+        file_names = sorted(file_names)
+        if not file_names:
+            return
+        self._log(f"{self._msg_prefix}Adding {len(file_names)} file(s) to {self._package_name} repository")
+        if not self._dry_run:
+            with _git_lock:
+                self._repo.index.add(file_names)
+                self._staged_paths.update(file_names)
+                self._committed_blobs = None
+
+    def remove_files(self, file_names):
+        file_names = sorted(file_names)
+        if not file_names:
+            return
+        self._log(f"{self._msg_prefix}Removing {len(file_names)} file(s) from {self._package_name} repository")
         if not self._dry_run:
-            self._repo.index.add(file_name)
+            with _git_lock:
+                # Files are already gone from disk, only untrack them (and
+                # only those git knows about, e.g. not ones never committed).
+                # The index is re-read on every access, so only read it once.
+                entries = self._repo.index.entries
+                tracked = [file_name for file_name in file_names if (file_name, 0) in entries]
+                if tracked:
+                    self._repo.index.remove(tracked)
+                self._staged_paths.update(file_names)
+                self._committed_blobs = None
 
-    def add_all_files(self):
-        for ext in self._extensions:
-            print(f"{self._msg_prefix}Adding all {ext} files to {self._package_name} repository")
+    def move_files(self, moves):
+        # Done with git mv so history follows the files, grouped by target
+        # directory so it's one git call per directory rather than per file
+        if not moves:
+            return
+        self._log(f"{self._msg_prefix}Moving {len(moves)} file(s) in {self._package_name} repository")
+        with _git_lock:
+            entries = self._repo.index.entries
+            moves_by_dir = {}
+            for (src, dst) in moves:
+                os.makedirs(os.path.join(self._repo.working_dir, os.path.dirname(dst)), exist_ok=True)
+                if self._dry_run or (src, 0) not in entries:
+                    os.rename(os.path.join(self._repo.working_dir, src), os.path.join(self._repo.working_dir, dst))
+                else:
+                    moves_by_dir.setdefault(os.path.dirname(dst) or ".", []).append(src)
+                    self._staged_paths.update([src, dst])
+            for (dst_dir, srcs) in moves_by_dir.items():
+                self._repo.git.mv(*srcs, dst_dir)
+            self._committed_blobs = None
             if not self._dry_run:
-                self._repo.index.add(f'*{ext}')
+                self._allow_subdirs_in_gitignore()
+
+    def get_config(self, name, default=None):
+        # GitPython won't take None as a default, so unset is read as empty
+        value = self._repo.config_reader().get_value(self._package_name, name, default='')
+        return value if value != '' else default
 
-    def remove_file(self, file_name):
-        print(f"{self._msg_prefix}Removing {file_name} from {self._package_name} repository")
+    def set_config(self, name, value):
         if not self._dry_run:
-            self._repo.index.remove([file_name], working_tree=True)
+            with _git_lock:
+                self._repo.config_writer().set_value(self._package_name, name, value).release()
 
     def commit(self, message):
+        # Returns the new commit's SHA, or None if there was nothing to commit
+        commit = None
         if not self._dry_run:
-            changes = self._repo.index.diff(self._repo.head.commit)
+            # Only the paths staged since the last commit can differ from
+            # HEAD, no need to compare the rest of the vault
+            changes = []
+            with _git_lock:
+                if self._staged_paths:
+                    changes = self._repo.index.diff(self._repo.head.commit, paths=sorted(self._staged_paths))
+                    if (changes):
+                        commit = self._repo.index.commit(message)
+                self._staged_paths.clear()
+                self._committed_blobs = None
             if (changes):
-                self._repo.index.commit(message)
-                print(f"Committed {len(changes)} revision(s) to {self._package_name} repository")
+                self._log(f"Committed {len(changes)} revision(s) to {self._package_name} repository")
             else:
-                print(f"No revisions to commit to {self._package_name} repository")
+                self._log(f"No revisions to commit to {self._package_name} repository")
         else:
-            print(f"{self._msg_prefix}Committing revision(s) to {self._package_name} repository")
+            self._log(f"{self._msg_prefix}Committing revision(s) to {self._package_name} repository")
+        return commit.hexsha if commit is not None else None
+
+    def needs_commit(self, file_name, content):
+        # Whether a file with this content isn't committed as is, e.g. it was
+        # written by a sync that failed before it got as far as committing
+        if self._dry_run:
+            return False
+        blob_sha = hashlib.sha1(b"blob %d\0" % len(content) + content).digest()
+        (index_blobs, head_blobs) = self._get_committed_blobs()
+        return index_blobs.get(file_name) != blob_sha or head_blobs.get(file_name) != blob_sha
+
+    def get_stats(self):
+        # Sizes are in KiB, as reported by git
+        with _git_lock:
+            output = self._repo.git.count_objects("-v")
+            commits = int(self._repo.git.rev_list("--count", "HEAD"))
+        stats = {}
+        for line in output.splitlines():
+            (name, _, value) = line.partition(":")
+            stats[name.strip()] = int(value.strip())
+        stats['commits'] = commits
+        return stats
+
+    def needs_maintenance(self, max_loose_objects, max_commits):
+        stats = self.get_stats()
+        maintained_commits = int(self.get_config('maintainedcommits', 0))
+        return stats['count'] >= max_loose_objects or stats['commits'] - maintained_commits >= max_commits
+
+    def maintain(self):
+        if self._dry_run:
+            self._log(f"{self._msg_prefix}Maintaining {self._package_name} repository")
+            return
+
+        before = self.get_stats()
+        start = time.monotonic()
+        with _git_lock:
+            # Packs loose objects and prunes what's unreachable, then writes
+            # the commit-graph so walking history stays quick
+            self._repo.git.gc("--quiet")
+            self._repo.git.commit_graph("write", "--reachable")
+        elapsed = time.monotonic() - start
+        after = self.get_stats()
+        self.set_config('maintainedcommits', after['commits'])
+
+        self._log(f"Maintained {self._package_name} repository in {elapsed:.1f}s")
+        for (label, stats) in [("Before", before), ("After", after)]:
+            self._log(f"  {label}: {stats['count']} loose object(s) ({stats['size']} KiB), "
+                      f"{stats['packs']} pack(s) ({stats['size-pack']} KiB), {stats['commits']} commit(s)")
+
+    def _get_committed_blobs(self):
+        # Blob SHAs by path in the index and in HEAD, read once rather than
+        # per file (GitPython re-reads the whole index on every access) and
+        # kept until the index next changes
+        with _git_lock:
+            if self._committed_blobs is None:
+                index_blobs = {path: entry.binsha for ((path, stage), entry) in self._repo.index.entries.items()
+                               if stage == 0}
+                try:
+                    head_blobs = {item.path: item.binsha for item in self._repo.head.commit.tree.traverse()
+                                  if item.type == 'blob'}
+                except ValueError:
+                    # No commits yet
+                    head_blobs = {}
+                self._committed_blobs = (index_blobs, head_blobs)
+            return self._committed_blobs
 
     def _add_gitignore(self):
         gitignore_path = os.path.join(self._repo.working_dir, ".gitignore")
         with open(gitignore_path, 'w') as file:
             print('*', file=file)
+            print('!*/', file=file)
             print('!.gitignore', file=file)
             for ext in self._extensions:
                 print(f'!*{ext}', file=file)
         self._repo.index.add('.gitignore')
         self._repo.index.commit("Add .gitignore")
+
+    def _allow_subdirs_in_gitignore(self):
+        # Vaults created before files could live in subdirectories ignore
+        # them along with everything else
+        gitignore_path = os.path.join(self._repo.working_dir, ".gitignore")
+        with open(gitignore_path, 'r') as file:
+            lines = file.read().splitlines()
+        if '!*/' in lines:
+            return
+        with open(gitignore_path, 'a') as file:
+            print('!*/', file=file)
+        self._repo.index.add('.gitignore')
+        self._staged_paths.add('.gitignore')
+        self._committed_blobs = None
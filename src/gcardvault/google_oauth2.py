@@ -1,10 +1,12 @@
 import os
 import json
 import webbrowser
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+from datetime import datetime, timedelta, timezone
+
+from .discovery import build_service
+
+# Note: Google's auth libraries are imported where they're used, they're slow
+# to import and most commands only need them once a sync is under way.
 
 
 GOOGLE_AUTH_URI = "https://accounts.google.com/o/oauth2/auth"
@@ -13,11 +15,15 @@ GOOGLE_AUTH_CERTS_URI = "https://www.googleapis.com/oauth2/v1/certs"
 
 
 class GoogleOAuth2():
-    def __init__(self, app_name, authorize_command_fn):
+    def __init__(self, app_name, authorize_command_fn, log=print):
         self.app_name = app_name
         self.authorize_command_fn = authorize_command_fn
+        self._log = log
 
     def get_credentials(self, token_file_path, client_id, client_secret, scopes, email_addr):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+
         credentials = None
         new_authorization = False
 
@@ -27,7 +33,7 @@ class GoogleOAuth2():
         if credentials and credentials.expired and credentials.refresh_token:
             credentials.refresh(Request())
             self._save_credentials(credentials, token_file_path)
-            print(f"Credentials refreshed, token saved to {token_file_path}")
+            self._log(f"Credentials refreshed, token saved to {token_file_path}")
         
         elif not credentials or not credentials.valid:
             credentials = self.authz_and_save_token(token_file_path, client_id, client_secret, scopes, email_addr)
@@ -35,7 +41,24 @@ class GoogleOAuth2():
 
         return (credentials, new_authorization)
 
+    def refresh_credentials(self, credentials, token_file_path, margin_secs):
+        # Refresh if expired or if about to, credentials.expiry is naive UTC
+        if not credentials.refresh_token or not credentials.expiry:
+            return False
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if credentials.expiry - now > timedelta(seconds=margin_secs):
+            return False
+
+        from google.auth.transport.requests import Request
+
+        credentials.refresh(Request())
+        self._save_credentials(credentials, token_file_path)
+        self._log(f"Credentials refreshed, token saved to {token_file_path}")
+        return True
+
     def authz_and_save_token(self, token_file_path, client_id, client_secret, scopes, email_addr):
+        from google.oauth2.credentials import Credentials
+
         if self._check_is_headless():
             print(f'''
 No web browser detected. Google's OAuth2 authorization cannot proceed in headless mode.
@@ -77,7 +100,7 @@ Authorization successful, paste the following into your remote machine --->
         return credentials
 
     def request_user_info(self, credentials):
-        with build('oauth2', 'v2', credentials=credentials) as service:
+        with build_service('oauth2', 'v2', credentials) as service:
             return service.userinfo().get().execute()
 
     def _check_is_headless(self):
@@ -89,6 +112,8 @@ Authorization successful, paste the following into your remote machine --->
             return True
 
     def _run_authz_flow_and_validate_user(self, client_id, client_secret, scopes, email_addr):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_config(
             {
                 'installed': {
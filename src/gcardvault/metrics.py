@@ -0,0 +1,95 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+class SyncMetrics():
+    """Collects timings and counts for a sync. Phases run concurrently in
+    the sync pipeline, so a phase's time is the time spent in it summed
+    across calls (and threads), not a slice of the overall wall time."""
+
+    def __init__(self):
+        self._started_at = time.time()
+        self._start = time.monotonic()
+        self._phases = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, items=0):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - start, items)
+
+    def add_phase(self, name, secs, items=0):
+        with self._lock:
+            phase = self._phases.setdefault(name, {'secs': 0.0, 'calls': 0, 'items': 0})
+            phase['secs'] += secs
+            phase['calls'] += 1
+            phase['items'] += items
+
+    def add_items(self, name, items):
+        with self._lock:
+            phase = self._phases.setdefault(name, {'secs': 0.0, 'calls': 0, 'items': 0})
+            phase['items'] += items
+
+    def record_request(self, api, latency_secs):
+        with self._lock:
+            self._get_requests(api)['latencies'].append(latency_secs)
+
+    def record_bytes(self, api, bytes_received):
+        with self._lock:
+            self._get_requests(api)['bytes'] += bytes_received
+
+    def record_retry(self, api):
+        with self._lock:
+            self._get_requests(api)['retries'] += 1
+
+    def report(self):
+        with self._lock:
+            elapsed_secs = time.monotonic() - self._start
+            return {
+                'started_at': self._started_at,
+                'elapsed_secs': round(elapsed_secs, 3),
+                'phases': {
+                    name: {
+                        'secs': round(phase['secs'], 3),
+                        'calls': phase['calls'],
+                        'items': phase['items'],
+                        'items_per_sec': round(phase['items'] / phase['secs'], 1) if phase['secs'] else None,
+                    }
+                    for (name, phase) in self._phases.items()
+                },
+                'requests': {
+                    api: {
+                        'count': len(requests['latencies']),
+                        'bytes': requests['bytes'],
+                        'retries': requests['retries'],
+                        'bytes_per_sec': round(requests['bytes'] / elapsed_secs) if elapsed_secs else None,
+                        'latency_secs': get_percentiles(requests['latencies']),
+                    }
+                    for (api, requests) in self._requests.items()
+                },
+            }
+
+    def _get_requests(self, api):
+        return self._requests.setdefault(api, {'latencies': [], 'bytes': 0, 'retries': 0})
+
+
+def get_percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    percentiles = {}
+    for percentile in LATENCY_PERCENTILES:
+        # Nearest-rank
+        rank = max(1, math.ceil(percentile / 100 * len(values)))
+        percentiles[f"p{percentile}"] = round(values[rank - 1], 4)
+    percentiles['max'] = round(values[-1], 4)
+    return percentiles
@@ -0,0 +1,108 @@
+import queue
+import threading
+
+
+PIPELINE_POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Pipeline():
+    """Runs stages concurrently in their own threads, connected by bounded
+    queues. If any stage fails, every other stage is stopped at its next
+    queue operation and join() raises the original error."""
+
+    def __init__(self):
+        self._aborted = threading.Event()
+        self._threads = []
+        self._error = None
+        self._lock = threading.Lock()
+
+    def queue(self, maxsize):
+        return PipelineQueue(self, maxsize)
+
+    def stage(self, name, fn, *args, workers=1, output=None):
+        # Output queue is closed when the last worker of the stage finishes,
+        # so the next stage knows there's nothing more coming
+        remaining_workers = [workers]
+
+        def run():
+            try:
+                fn(*args)
+            except PipelineAborted:
+                pass
+            except BaseException as e:
+                self.abort(e)
+            finally:
+                with self._lock:
+                    remaining_workers[0] -= 1
+                    is_last_worker = remaining_workers[0] == 0
+                if is_last_worker and output is not None:
+                    output.close()
+
+        for i in range(workers):
+            thread = threading.Thread(target=run, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def abort(self, error=None):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._aborted.set()
+
+    def check_aborted(self):
+        if self._aborted.is_set():
+            raise PipelineAborted()
+
+    def join(self):
+        try:
+            for thread in self._threads:
+                while thread.is_alive():
+                    thread.join(PIPELINE_POLL_INTERVAL)
+        except BaseException as e:
+            # e.g. KeyboardInterrupt, stop the stages before bailing out
+            self.abort(e)
+            raise
+
+        if self._error is not None:
+            raise self._error
+
+
+class PipelineQueue():
+
+    def __init__(self, pipeline, maxsize):
+        self._pipeline = pipeline
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, item):
+        while True:
+            self._pipeline.check_aborted()
+            try:
+                self._queue.put(item, timeout=PIPELINE_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        try:
+            self.put(_END)
+        except PipelineAborted:
+            pass
+
+    def __iter__(self):
+        while True:
+            self._pipeline.check_aborted()
+            try:
+                item = self._queue.get(timeout=PIPELINE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _END:
+                # Leave it for any other workers reading from this queue
+                self._queue.put_nowait(_END)
+                return
+            yield item
@@ -0,0 +1,72 @@
+import os
+import re
+
+
+LAST_SUCCESS_METRIC = "gcardvault_last_success_timestamp_seconds"
+
+METRICS = {
+    "gcardvault_last_run_timestamp_seconds": ("gauge", "When the last sync started."),
+    "gcardvault_last_run_success": ("gauge", "Whether the last sync succeeded (1) or failed (0)."),
+    LAST_SUCCESS_METRIC: ("gauge", "When the last successful sync started."),
+    "gcardvault_run_duration_seconds": ("gauge", "How long the last sync took."),
+    "gcardvault_phase_duration_seconds": ("gauge", "Time spent in each phase of the last sync."),
+    "gcardvault_contacts": ("gauge", "Contacts in the vault, and those updated or removed by the last sync."),
+    "gcardvault_http_requests": ("gauge", "HTTP requests made to each Google API by the last sync."),
+    "gcardvault_http_received_bytes": ("gauge", "Bytes received from each Google API by the last sync."),
+    "gcardvault_http_retries": ("gauge", "Requests to each Google API retried by the last sync."),
+    "gcardvault_git_commit_duration_seconds": ("gauge", "Time taken to commit the last sync to the vault."),
+}
+
+_LAST_SUCCESS_PATTERN = re.compile(rf'^{LAST_SUCCESS_METRIC}{{user="((?:[^"\\]|\\.)*)"}} (\S+)$')
+
+
+def format_metrics(samples):
+    """Renders (name, labels, value) samples in the Prometheus text format,
+    grouped by metric with the HELP and TYPE for each."""
+    lines = []
+    for name in METRICS:
+        metric_samples = [(labels, value) for (sample_name, labels, value) in samples if sample_name == name]
+        if not metric_samples:
+            continue
+        (metric_type, help_text) = METRICS[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (labels, value) in metric_samples:
+            label_text = ",".join(f'{key}="{_escape(str(val))}"' for (key, val) in labels.items())
+            lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(file_path, samples):
+    # Written to the side and moved into place, so a scrape never sees a
+    # partially written file
+    temp_file_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, 'w', encoding='utf-8') as file:
+        file.write(format_metrics(samples))
+    os.replace(temp_file_path, file_path)
+
+
+def read_last_success_timestamps(file_path):
+    # A failed sync keeps reporting when the last good one was
+    timestamps = {}
+    if not os.path.exists(file_path):
+        return timestamps
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            match = _LAST_SUCCESS_PATTERN.match(line.strip())
+            if match:
+                user = re.sub(r'\\(.)', lambda m: "\n" if m.group(1) == "n" else m.group(1), match.group(1))
+                timestamps[user] = float(match.group(2))
+    return timestamps
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
@@ -0,0 +1,89 @@
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep
+
+
+# Cap on how long to wait between attempts when the server doesn't say
+BACKOFF_BASE_SECS = 1
+BACKOFF_MAX_SECS = 60
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+class RateLimiter():
+    """Token bucket allowing `rate` requests per second, with bursts of up to
+    `burst`. Backing off pauses every caller sharing the bucket, since they're
+    all drawing down the same quota."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._tokens = self.burst
+        self._updated_at = monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            sleep(wait)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            # Tokens earned so far are at the old rate
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self.rate = rate
+            self.burst = burst if burst is not None else max(1, rate)
+            self._tokens = min(self._tokens, self.burst)
+
+    def back_off(self, secs):
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + secs)
+            # Don't let a full bucket burst straight back into the quota
+            self._tokens = 0
+
+
+def get_rate_limiter(api, client_id, rate):
+    # One per API and OAuth2 client, quotas are enforced per project. A sync
+    # asking for a different rate than the last one gets it, for every sync
+    # sharing the bucket.
+    key = (api, client_id)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(rate)
+        elif _rate_limiters[key].rate != rate:
+            _rate_limiters[key].set_rate(rate)
+        return _rate_limiters[key]
+
+
+def get_backoff_secs(attempt, retry_after=None):
+    if retry_after is not None:
+        return retry_after
+    # Exponential with full jitter, so concurrent syncs don't retry in lockstep
+    return random.uniform(0, min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * (2 ** attempt)))
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
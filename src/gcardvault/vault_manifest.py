@@ -0,0 +1,106 @@
+import os
+import glob
+import threading
+
+
+MANIFEST_FILE_NAME = ".manifest.tsv"
+MANIFEST_FIELDS = ["id", "file_name", "etag", "content_hash", "size", "mtime_ns"]
+
+
+class VaultManifest():
+    """Index of the files in a vault keyed by contact ID, kept in the vault
+    itself so a sync doesn't need to list the directory to find them. Each
+    entry records the file name along with the etag and content hash (and
+    size/mtime) the file had when it was last written."""
+
+    def __init__(self, dir_path, extension, rebuild=False, log=print):
+        self._dir_path = dir_path
+        self._extension = extension
+        self._log = log
+        self._file_path = os.path.join(dir_path, MANIFEST_FILE_NAME)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(self._file_path):
+            self._entries = self._read()
+        else:
+            rebuild = True
+        if rebuild:
+            self.rebuild()
+
+    def get(self, id):
+        with self._lock:
+            return self._entries.get(id.lower())
+
+    def get_file_name(self, id, default=None):
+        entry = self.get(id)
+        return entry['file_name'] if entry else default
+
+    def ids(self):
+        with self._lock:
+            return set(self._entries)
+
+    def set(self, id, file_name, etag=None, content_hash=None, size=None, mtime_ns=None):
+        with self._lock:
+            self._entries[id.lower()] = {
+                'id': id.lower(),
+                'file_name': file_name,
+                'etag': etag,
+                'content_hash': content_hash,
+                'size': size,
+                'mtime_ns': mtime_ns,
+            }
+
+    def remove(self, id):
+        with self._lock:
+            self._entries.pop(id.lower(), None)
+
+    def rebuild(self):
+        # Reconcile with what's actually in the directory, keeping what's
+        # known about files that are still where the manifest says they are
+        entries = {}
+        # Files may be in subdirectories, depending on the vault's layout
+        for file_path in glob.glob(os.path.join(self._dir_path, "**", f"*{self._extension}"), recursive=True):
+            file_name = os.path.relpath(file_path, self._dir_path).replace(os.sep, "/")
+            id = os.path.splitext(os.path.basename(file_name))[0].split("_")[-1].lower()
+            entry = self._entries.get(id)
+            if entry is None or entry['file_name'] != file_name:
+                entry = {'id': id, 'file_name': file_name,
+                         'etag': None, 'content_hash': None, 'size': None, 'mtime_ns': None}
+            entries[id] = entry
+
+        with self._lock:
+            added = len(set(entries) - set(self._entries))
+            removed = len(set(self._entries) - set(entries))
+            self._entries = entries
+        self._log(f"Rebuilt vault manifest, {len(entries)} file(s) ({added} added, {removed} removed)")
+
+    def save(self):
+        with self._lock:
+            lines = ["\t".join(MANIFEST_FIELDS)]
+            for id in sorted(self._entries):
+                entry = self._entries[id]
+                lines.append("\t".join(
+                    "" if entry[field] is None else str(entry[field]) for field in MANIFEST_FIELDS))
+
+        # Written to the side and swapped in, so it's never left half written
+        temp_file_path = f"{self._file_path}.tmp"
+        with open(temp_file_path, 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_file_path, self._file_path)
+
+    def _read(self):
+        entries = {}
+        with open(self._file_path, 'r', encoding='utf-8') as file:
+            fields = None
+            for line in file:
+                values = line.rstrip("\n").split("\t")
+                if fields is None:  # first line, load field names
+                    fields = values
+                    continue
+                entry = {field: None for field in MANIFEST_FIELDS}
+                for (field, value) in zip(fields, values):
+                    if value != "":
+                        entry[field] = int(value) if field in ['size', 'mtime_ns'] else value
+                entries[entry['id']] = entry
+        return entries
@@ -0,0 +1,82 @@
+import os
+import sys
+import gzip
+
+
+PACK_STDOUT = "-"
+PACK_INDEX_EXTENSION = ".idx"
+
+
+class VCardPackWriter():
+    """Streams vCards one after another into a single file (or stdout), and
+    writes an index alongside it of where each contact's vCard starts and
+    how long it is. Files ending in .gz have each vCard compressed as its
+    own gzip member, so the whole file is still a valid gzip stream but any
+    one vCard can be decompressed from its offset without the rest."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._compress = path.endswith(".gz")
+        self._offset = 0
+        self._index = []
+
+        if path == PACK_STDOUT:
+            self._file = sys.stdout.buffer
+            self._temp_path = None
+        else:
+            # Written to the side and swapped in once complete
+            self._temp_path = f"{path}.tmp"
+            self._file = open(self._temp_path, 'wb')
+
+    def write(self, id, vcard):
+        data = vcard.encode('utf-8')
+        if not data.endswith(b"\n"):
+            data += b"\r\n"
+        if self._compress:
+            data = gzip.compress(data, mtime=0)
+
+        self._file.write(data)
+        self._index.append((id, self._offset, len(data)))
+        self._offset += len(data)
+        self.count += 1
+
+    def close(self):
+        if self._temp_path is None:
+            self._file.flush()
+            return
+
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+        index_path = f"{self.path}{PACK_INDEX_EXTENSION}"
+        with open(f"{index_path}.tmp", 'w', encoding='utf-8') as file:
+            print("id\toffset\tlength", file=file)
+            for (id, offset, length) in self._index:
+                print(f"{id}\t{offset}\t{length}", file=file)
+        os.replace(f"{index_path}.tmp", index_path)
+
+    def abort(self):
+        if self._temp_path is None:
+            return
+        self._file.close()
+        os.remove(self._temp_path)
+
+
+def read_packed_vcard(path, id):
+    """Reads a single contact's vCard out of a pack using its index."""
+    with open(f"{path}{PACK_INDEX_EXTENSION}", 'r', encoding='utf-8') as file:
+        next(file)  # header
+        for line in file:
+            (entry_id, offset, length) = line.rstrip("\n").split("\t")
+            if entry_id == id:
+                break
+        else:
+            return None
+
+    with open(path, 'rb') as file:
+        file.seek(int(offset))
+        data = file.read(int(length))
+    if path.endswith(".gz"):
+        data = gzip.decompress(data)
+    return data.decode('utf-8')
@@ -0,0 +1,30 @@
+from unittest.mock import patch
+import pytest
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        # Like a real sleep, always takes some time, otherwise waits that
+        # round to less than the clock's resolution would never pass
+        self.now += max(secs, 1e-6)
+
+
+@pytest.fixture
+def rate_limiter_clock():
+    # Rate limiter waits pass instantly
+    clock = FakeClock()
+    # Shared limiters keep time by whichever clock they were made with, so
+    # none are kept from before or after this one
+    with patch("gcardvault.rate_limiter.monotonic", clock.monotonic), \
+            patch("gcardvault.rate_limiter.sleep", clock.sleep), \
+            patch.dict("gcardvault.rate_limiter._rate_limiters", clear=True):
+        yield clock
@@ -6,11 +6,12 @@ import random
 import hashlib
 from xml.etree import ElementTree
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from gcardvault.gcardvault import GoogleApis
+from gcardvault.gcardvault import GoogleApis, SyncTokenExpiredError, TransientApiError
 from jinja2.filters import V
 
 
 CARDDAV_HREF_FMT = "/carddav/v1/principals/foo.bar@gmail.com/lists/default/{id}"
+FAKE_SYNC_TOKEN = "fake-sync-token"
 
 dirname = os.path.dirname(__file__)
 data_dir_path = os.path.join(dirname, "data")
@@ -49,7 +50,7 @@ class FakeDataRecord(dict):
 
     def file_name(self):
         name = f"{self['first_name']} {self['last_name']}"
-        prefix = "_".join(name.strip().split()).lower()
+        prefix = "_".join(name.strip().split()).lower().replace("/", "_")
         id = self['id'].lower()
         return f"{prefix}_{id}.vcf"
 
@@ -81,8 +82,18 @@ END:VCARD
 class FakeGoogleApis(GoogleApis):
 
     def __init__(self, fake_data_repo, cap=None, vcards_allowlist=None):
+        super().__init__()
         self._repo = fake_data_repo
         self._vcards_allowlist = vcards_allowlist
+        self._vcards_omitted = []
+        self.vcards_requested = 0
+        self.sync_token_used = None
+        self.sync_collection_page_size = None
+        self._sync_token_expired = False
+        self._changed_records = {}
+        self._deleted_records = []
+        self._carddav_failures = []
+        self.carddav_batch_sizes = []
 
         self.records = self._repo.list().copy()
         if cap is not None:
@@ -96,12 +107,15 @@ class FakeGoogleApis(GoogleApis):
         )
         self._contact_list_template = self._template_env.get_template("contact_list.json.jinja2")
         self._carrdav_report_template = self._template_env.get_template("carddav_report.xml.jinja2")
+        self._carddav_sync_collection_template = \
+            self._template_env.get_template("carddav_sync_collection.xml.jinja2")
 
     def touch_record(self, idx):
         record = self.records[idx]
         new_record = copy.deepcopy(record)
         new_record["rand"] = random.random()  # add element to dict that changes etag hash
         self.records[idx] = new_record
+        self._changed_records[new_record['id']] = new_record
         return new_record
 
     def change_name(self, idx, first_name, last_name):
@@ -110,48 +124,133 @@ class FakeGoogleApis(GoogleApis):
         new_record["last_name"] = last_name
         return new_record
 
+    def delete_record(self, idx):
+        record = self.records.pop(idx)
+        self.count = len(self.records)
+        self._changed_records.pop(record['id'], None)
+        deleted_record = copy.deepcopy(record)
+        deleted_record["deleted"] = True
+        self._deleted_records.append(deleted_record)
+        return record
+
+    def expire_sync_token(self):
+        self._sync_token_expired = True
+
     def allow_vcards(self, hrefs):
         if self._vcards_allowlist is None:
             self._vcards_allowlist = []
         self._vcards_allowlist.extend(hrefs)
 
-    def request_contact_list(self, credentials, page_token=None):
+    def share(self):
+        return self
+
+    def fail_carddav_requests(self, count, status=503, after=0):
+        # None lets a request through, so failures can start partway in
+        self._carddav_failures.extend([None] * after + [status] * count)
+
+    def omit_vcards(self, hrefs):
+        self._vcards_omitted.extend(hrefs)
+
+    def request_contact_list(self, credentials, page_token=None, sync_token=None, request_sync_token=False):
+        records = self.records
+        if sync_token:
+            if self._sync_token_expired:
+                raise SyncTokenExpiredError()
+            # Fake tracks changes since it was created, regardless of token
+            self.sync_token_used = sync_token
+            records = list(self._changed_records.values()) + self._deleted_records
+
         start = 0
         page_size = 100
         next_page_token = None
         if page_token is not None:
             start = int(page_token)
         end = start + page_size
-        if end < len(self.records):
+        if end < len(records):
             next_page_token = str(end)
 
-        records_to_render = self.records[start:end]
+        records_to_render = records[start:end]
 
         resource = self._contact_list_template.render(
             records=records_to_render,
             next_page_token=next_page_token,
-            total_people=len(self.records),
-            total_items=len(self.records),
+            next_sync_token=FAKE_SYNC_TOKEN if request_sync_token and not next_page_token else None,
+            total_people=len(records),
+            total_items=len(records),
         )
 
+        self._record_request("people", 0.001)
+        self._record_bytes("people", len(resource.encode('utf-8')))
         return json.loads(resource)
 
-    def request_carddav_report(self, credentials, principal, request_body):
+    def request_carddav_report(self, credentials, principal, request_body, depth=None):
         ns = {"d": "DAV:", "card": "urn:ietf:params:xml:ns:carddav", }
 
-        hrefs = []
-        multiget = ElementTree.fromstring(request_body)
-        for href in multiget.findall("d:href", namespaces=ns):
-            hrefs.append(href.text)
+        report = ElementTree.fromstring(request_body)
+        self._record_request("carddav", 0.001)
+        if report.tag == "{DAV:}sync-collection":
+            assert depth == "0"
+            return self._stream(self._render_sync_collection(report.findtext("d:sync-token", namespaces=ns)))
+
+        # Matched on contact ID, so the fake can serve any principal
+        hrefs = {}
+        for href in report.findall("d:href", namespaces=ns):
+            hrefs[href.text.split("/")[-1]] = href.text
 
-        records_to_render = [record for record in self.records if record['href'] in hrefs]
+        status = self._carddav_failures.pop(0) if self._carddav_failures else None
+        if status is not None:
+            raise TransientApiError(f"CardDAV request failed with HTTP {status}", status)
+
+        self.vcards_requested += len(hrefs)
+        self.carddav_batch_sizes.append(len(hrefs))
+
+        records_to_render = [record for record in self.records
+                             if record['id'] in hrefs and record['href'] not in self._vcards_omitted]
 
         if self._vcards_allowlist is not None:
             for record in records_to_render:
                 assert record['href'] in self._vcards_allowlist
 
         resource = self._carrdav_report_template.render(
-            records=records_to_render
+            records=records_to_render,
+            hrefs=hrefs,
         )
 
-        return resource
+        return self._stream(resource)
+
+    def _stream(self, resource, chunk_size=256):
+        content = resource.encode('utf-8')
+        for start in range(0, len(content), chunk_size):
+            chunk = content[start:start + chunk_size]
+            self._record_bytes("carddav", len(chunk))
+            yield chunk
+
+    def _render_sync_collection(self, sync_token):
+        records = self.records
+        deleted_records = []
+        start = 0
+        if sync_token:
+            if self._sync_token_expired:
+                raise SyncTokenExpiredError()
+            # Tokens look like "<FAKE_SYNC_TOKEN>:<offset>", offset being
+            # how far into a truncated listing the client has gotten
+            (token, _, offset) = sync_token.partition(":")
+            if token != FAKE_SYNC_TOKEN or not offset:
+                self.sync_token_used = sync_token
+                records = list(self._changed_records.values())
+                deleted_records = self._deleted_records
+            else:
+                start = int(offset)
+
+        end = len(records)
+        if self.sync_collection_page_size is not None:
+            end = min(end, start + self.sync_collection_page_size)
+        truncated = end < len(records)
+
+        return self._carddav_sync_collection_template.render(
+            records=records[start:end],
+            deleted_records=deleted_records if not truncated else [],
+            truncated=truncated,
+            addressbook_href=CARDDAV_HREF_FMT.format(id=""),
+            sync_token=f"{FAKE_SYNC_TOKEN}:{end}" if truncated else FAKE_SYNC_TOKEN,
+        )
@@ -0,0 +1,170 @@
+import os
+import asyncio
+from pathlib import Path
+from unittest.mock import MagicMock
+import pytest
+from git import Repo
+import gcardvault
+from gcardvault import GcardvaultError, SyncResult
+from .fake_google_apis import FakeDataRepo, FakeGoogleApis
+from .test_gcardvault import _setup_dirs, _get_google_oauth2_mock
+
+
+fake_data_repo = FakeDataRepo()
+
+
+def _setup_token(conf_dir, user="foo.bar@gmail.com"):
+    conf_dir.mkdir(parents=True, exist_ok=True)
+    Path(conf_dir, f"{user}.token.json").write_text("{}")
+
+
+def _sync(conf_dir, output_dir, google_apis, progress=None, **options):
+    return gcardvault.sync(
+        "foo.bar@gmail.com", dict(options, conf_dir=conf_dir, output_dir=output_dir), progress=progress,
+        google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+
+
+def test_sync(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    _setup_token(conf_dir)
+    messages = []
+
+    result = _sync(conf_dir, output_dir, FakeGoogleApis(fake_data_repo, cap=5), progress=messages.append)
+
+    assert isinstance(result, SyncResult)
+    assert (result.updated, result.unchanged, result.up_to_date, result.removed) == (5, 0, 0, 0)
+    assert len(result.files_written) == 5
+    assert result.commit == Repo(output_dir).head.commit.hexsha
+    assert result.elapsed_secs >= 0
+    assert "download_vcards" in result.metrics['phases']
+    assert result.to_dict()['updated'] == 5
+
+    # Progress goes to the callback, nothing printed
+    assert "5 contact(s) need to be updated" in messages
+    assert capsys.readouterr().out == ""
+
+
+def test_sync_no_changes():
+    (conf_dir, output_dir) = _setup_dirs()
+    _setup_token(conf_dir)
+    _sync(conf_dir, output_dir, FakeGoogleApis(fake_data_repo, cap=5))
+
+    result = _sync(conf_dir, output_dir, FakeGoogleApis(fake_data_repo, cap=5))
+
+    assert (result.updated, result.up_to_date) == (0, 5)
+    assert result.commit is None
+    assert result.files_written == []
+
+
+def test_sync_clean():
+    (conf_dir, output_dir) = _setup_dirs()
+    _setup_token(conf_dir)
+    first_result = _sync(conf_dir, output_dir, FakeGoogleApis(fake_data_repo, cap=5), export_only=True)
+
+    result = _sync(conf_dir, output_dir, FakeGoogleApis(fake_data_repo, cap=3), export_only=True, clean=True)
+
+    assert result.removed == 2
+    assert result.commit is None
+    assert len(result.files_removed) == 2
+    assert set(result.files_removed) < set(first_result.files_written)
+    assert not os.path.exists(os.path.join(output_dir, ".git"))
+
+
+@pytest.mark.parametrize("options", [
+    {'parallel': 0}, {'bogus': True}, {'help': True}, {'version': True}, {'h': True}])
+def test_sync_invalid_options(options, capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    _setup_token(conf_dir)
+
+    with pytest.raises(GcardvaultError):
+        _sync(conf_dir, output_dir, FakeGoogleApis(fake_data_repo, cap=5), **options)
+    # Nothing printed, not even usage
+    assert capsys.readouterr().out == ""
+
+
+def test_sync_requires_saved_credentials():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    with pytest.raises(GcardvaultError, match="No saved credentials"):
+        _sync(conf_dir, output_dir, FakeGoogleApis(fake_data_repo, cap=5))
+
+
+def test_sync_async():
+    (conf_dir, _) = _setup_dirs()
+    users = ["foo.bar@gmail.com", "baz.qux@gmail.com"]
+    for user in users:
+        _setup_token(conf_dir, user)
+    messages = []
+
+    async def sync_all():
+        loop = asyncio.get_running_loop()
+
+        def progress(message):
+            # Called back on the event loop's thread
+            assert asyncio.get_running_loop() is loop
+            messages.append(message)
+
+        return await asyncio.gather(*[
+            gcardvault.sync_async(
+                user, {'conf_dir': conf_dir, 'output_dir': f"/tmp/output/{user}", 'export_only': True},
+                progress=progress, google_oauth2=_get_google_oauth2_mock(email=user),
+                google_apis=FakeGoogleApis(fake_data_repo, cap=5))
+            for user in users
+        ])
+
+    results = asyncio.run(sync_all())
+
+    assert [result.user for result in results] == users
+    assert [result.updated for result in results] == [5, 5]
+    assert messages
+
+
+def test_sync_shares_google_apis():
+    (conf_dir, output_dir) = _setup_dirs()
+    _setup_token(conf_dir)
+    google_apis = MagicMock()
+    google_apis.share.return_value = FakeGoogleApis(fake_data_repo, cap=5)
+
+    result = _sync(conf_dir, output_dir, google_apis)
+
+    assert result.updated == 5
+    google_apis.share.assert_called_once()
+    google_apis.close.assert_not_called()
+
+
+def test_sync_credentials_refreshed_progress(monkeypatch, capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    _setup_token(conf_dir)
+    messages = []
+
+    # The saved token had expired, as far as the sync can tell
+    def get_credentials(self, token_file_path, client_id, client_secret, scopes, email_addr):
+        self._log(f"Credentials refreshed, token saved to {token_file_path}")
+        return (MagicMock(token="phony"), False)
+
+    monkeypatch.setattr(gcardvault.gcardvault.GoogleOAuth2, "get_credentials", get_credentials)
+    gcardvault.sync(
+        "foo.bar@gmail.com", {'conf_dir': conf_dir, 'output_dir': output_dir}, progress=messages.append,
+        google_apis=FakeGoogleApis(fake_data_repo, cap=5))
+
+    assert any(message.startswith("Credentials refreshed") for message in messages)
+    assert capsys.readouterr().out == ""
+
+
+def test_sync_relative_dirs(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    _setup_token(conf_dir)
+    monkeypatch.chdir("/tmp")
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3)
+    original_sync = gcardvault.Gcardvault.sync
+    dirs = []
+
+    def sync(self):
+        dirs.append((self.conf_dir, self.output_dir))
+        return original_sync(self)
+
+    monkeypatch.setattr(gcardvault.Gcardvault, "sync", sync)
+    result = _sync("conf", "output", google_apis_fake)
+
+    assert dirs == [(str(conf_dir), str(output_dir))]
+    assert result.updated == 3
@@ -0,0 +1,61 @@
+from gcardvault.batch_sizer import BatchSizer
+
+
+def _batch_sizer(initial_size=100):
+    return BatchSizer(initial_size, min_size=10, max_size=500, target_secs=10, target_bytes=1024 * 1024)
+
+
+def test_grows_while_within_target():
+    sizer = _batch_sizer()
+
+    sizer.record_success(100, elapsed_secs=1, bytes_received=10 * 1024)
+    assert sizer.size == 200
+
+    sizer.record_success(200, elapsed_secs=2, bytes_received=20 * 1024)
+    assert sizer.size == 400
+
+    sizer.record_success(400, elapsed_secs=4, bytes_received=40 * 1024)
+    assert sizer.size == 500
+
+
+def test_shrinks_when_slow():
+    sizer = _batch_sizer()
+
+    sizer.record_success(100, elapsed_secs=20, bytes_received=10 * 1024)
+    assert sizer.size == 50
+
+
+def test_capped_by_target_bytes():
+    sizer = _batch_sizer()
+
+    # 16KB per vCard, so 64 of them fit in the 1MB target
+    sizer.record_success(100, elapsed_secs=1, bytes_received=100 * 16 * 1024)
+    assert sizer.size == 64
+
+
+def test_halves_on_failure_within_bounds():
+    sizer = _batch_sizer()
+
+    sizer.record_failure(100)
+    assert sizer.size == 50
+    sizer.record_failure(50)
+    sizer.record_failure(25)
+    sizer.record_failure(12)
+    assert sizer.size == 10
+
+
+def test_summary():
+    sizer = _batch_sizer()
+    assert sizer.summary() is None
+
+    sizer.record_success(100, elapsed_secs=1, bytes_received=1024)
+    sizer.record_failure(200)
+    sizer.record_success(50, elapsed_secs=1, bytes_received=1024)
+
+    summary = sizer.summary()
+    assert summary['batches'] == 2
+    assert summary['min'] == 50
+    assert summary['max'] == 100
+    assert summary['mean'] == 75
+    assert summary['failures'] == 1
+    assert summary['final'] == sizer.size
@@ -0,0 +1,38 @@
+import pytest
+from benchmarks.run import run_mode, compare
+from benchmarks.synthetic import SyntheticDataRepo
+
+
+def test_synthetic_data_is_deterministic():
+    repo = SyntheticDataRepo(50, vcard_bytes=600, photo_ratio=0.5, photo_bytes=256, seed=1)
+    other_repo = SyntheticDataRepo(50, vcard_bytes=600, photo_ratio=0.5, photo_bytes=256, seed=1)
+    assert list(repo.records) == list(other_repo.records)
+
+    sizes = [len(repo.vcard(record)) for record in repo.records.values() if not record['photo']]
+    assert min(sizes) >= 600 and max(sizes) <= 620
+    assert 0 < sum(1 for record in repo.records.values() if record['photo']) < 50
+
+
+@pytest.mark.parametrize("mode", ["export-only", "vault"])
+def test_run_mode(mode):
+    results = run_mode(mode, 200)
+
+    assert results['first_sync']['counts']['to_update'] == 200
+    assert results['resync_no_change']['counts']['up_to_date'] == 200
+    assert results['resync_no_change']['counts']['to_update'] == 0
+    assert results['resync_lost_etags']['counts']['to_update'] == 200
+    assert results['resync_lost_etags']['counts']['unchanged'] == 200
+    assert results['resync_churn']['counts']['to_update'] == 2
+    assert results['clean_deletions']['counts']['removed'] == 2
+    assert results['first_sync']['metrics']['requests']['carddav']['bytes'] > 0
+
+
+def test_compare():
+    baseline = {'results': {'vault': {'first_sync': {'secs': 10.0}, 'resync_churn': {'secs': 1.0}}}}
+    results = {'results': {'vault': {'first_sync': {'secs': 11.0}, 'resync_churn': {'secs': 1.5},
+                                     'clean_deletions': {'secs': 1.0}}}}
+
+    assert compare(results, baseline, threshold=0.2) == [
+        ("vault", "first_sync", 11.0, 10.0, 1.1, False),
+        ("vault", "resync_churn", 1.5, 1.0, 1.5, True),
+    ]
@@ -0,0 +1,61 @@
+import os
+import threading
+import pytest
+from gcardvault.file_lock import FileLock, LockTimeoutError
+
+
+def test_lock(tmp_path):
+    path = str(tmp_path / "test.lock")
+
+    with FileLock(path):
+        with pytest.raises(LockTimeoutError) as exc_info:
+            FileLock(path).acquire()
+        assert exc_info.value.holder_pid == str(os.getpid())
+
+    # Free again once released
+    with FileLock(path):
+        pass
+
+
+def test_lock_waits(tmp_path):
+    path = str(tmp_path / "test.lock")
+    lock = FileLock(path).acquire()
+    threading.Timer(0.2, lock.release).start()
+
+    with pytest.raises(LockTimeoutError):
+        FileLock(path, wait_secs=0.05).acquire()
+    with FileLock(path, wait_secs=5):
+        pass
+
+
+def test_lock_without_flock(tmp_path, monkeypatch):
+    import gcardvault.file_lock
+
+    # Stands in for msvcrt's byte-range locks, which Windows has in place of flock
+    locked = set()
+
+    class FakeMsvcrt():
+        LK_NBLCK = 2
+        LK_UNLCK = 0
+
+        @staticmethod
+        def locking(fd, mode, nbytes):
+            key = os.fstat(fd).st_ino
+            if mode == FakeMsvcrt.LK_UNLCK:
+                locked.remove(key)
+            elif key in locked:
+                raise PermissionError(13, "Permission denied")
+            else:
+                locked.add(key)
+
+    monkeypatch.setattr(gcardvault.file_lock.os, "name", "nt")
+    monkeypatch.setattr(gcardvault.file_lock, "msvcrt", FakeMsvcrt, raising=False)
+    path = str(tmp_path / "test.lock")
+
+    with FileLock(path):
+        with pytest.raises(LockTimeoutError):
+            FileLock(path).acquire()
+    assert not locked
+
+    with FileLock(path):
+        pass
@@ -1,16 +1,29 @@
 import os
+import io
 import glob
+import gzip
 import re
 import json
+import threading
 from pathlib import Path
 import shutil
+from datetime import datetime, timedelta, timezone
+from xml.etree import ElementTree
 import pytest
 from unittest.mock import MagicMock, patch
-from git import Repo
+from git import Repo, IndexFile
 from gcardvault import Gcardvault, GcardvaultError
-from gcardvault.gcardvault import GoogleOAuth2
+from gcardvault.gcardvault import GoogleOAuth2, GoogleApis, SyncTokenExpiredError, TransientApiError, \
+    RateLimitedError, API_RATE_LIMITED_ATTEMPTS, \
+    get_vcard_formatted_name, get_vault_file_path, iter_multistatus
+from googleapiclient.errors import HttpError
+from gcardvault.discovery import build_service
+from gcardvault.vcard_pack import read_packed_vcard
+from gcardvault.file_lock import FileLock
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery_cache import get_static_doc
 
-from .fake_google_apis import FakeDataRepo, FakeGoogleApis
+from .fake_google_apis import FakeDataRepo, FakeGoogleApis, FAKE_SYNC_TOKEN
 
 
 # Note: Tests are meant to run in a container (see `make test`), so
@@ -31,6 +44,16 @@ fake_data_repo = FakeDataRepo()
         ["badcommand", "foo.bar@gmail.com"],  # bad command
         ["--export-only"],  # valid option with no command
         ["noop"],  # valid command with no user
+        ["noop", "foo.bar@gmail.com", "--parallel", "0"],  # non-positive int
+        ["noop", "foo.bar@gmail.com", "--parallel", "abc"],  # not an int
+        ["noop", "foo.bar@gmail.com", "--sync-mode", "bogus"],  # bad sync mode
+        ["sync-all"],  # no manifest
+        ["sync-all", "/tmp/manifest.txt", "--parallel-accounts", "0"],  # non-positive int
+        ["noop", "foo.bar@gmail.com", "--batch-size-min", "50", "--batch-size-max", "20"],  # min > max
+        ["noop", "foo.bar@gmail.com", "--layout", "bogus"],  # bad layout
+        ["noop", "foo.bar@gmail.com", "--pack", "-", "--sync-mode", "incremental"],  # pack needs full listing
+        ["sync-all", "/tmp/manifest.txt", "--pack", "/tmp/contacts.vcf"],  # pack for many accounts
+        ["noop", "foo.bar@gmail.com", "--lock-wait", "-1"],  # negative int
     ])
 def test_invalid_args(args):
     gc = Gcardvault()
@@ -92,6 +115,40 @@ def test_version(capsys, args):
             {'client_id': "0123456789abcdef"}),
         (["noop", "foo.bar@gmail.com", "--client-secret", "!@#$%^&*"],
             {'client_secret': "!@#$%^&*"}),
+        (["noop", "foo.bar@gmail.com", "--parallel", "4"],
+            {'parallel': 4}),
+        (["noop", "foo.bar@gmail.com", "--sync-mode", "incremental"],
+            {'sync_mode': "incremental"}),
+        (["noop", "foo.bar@gmail.com", "--sync-mode", "carddav"],
+            {'sync_mode': "carddav"}),
+        (["noop", "foo.bar@gmail.com", "--parallel-accounts", "8"],
+            {'parallel_accounts': 8}),
+        (["noop", "foo.bar@gmail.com", "--interval", "600"],
+            {'interval': 600}),
+        (["noop", "foo.bar@gmail.com", "--status-file", "/tmp/status.json"],
+            {'status_file': "/tmp/status.json"}),
+        (["noop", "foo.bar@gmail.com", "--batch-size-min", "5", "--batch-size-max", "50"],
+            {'batch_size_min': 5, 'batch_size_max': 50}),
+        (["noop", "foo.bar@gmail.com", "--rate-limit", "20"],
+            {'rate_limit': 20}),
+        (["noop", "foo.bar@gmail.com", "--layout", "sharded"],
+            {'layout': "sharded"}),
+        (["noop", "foo.bar@gmail.com", "--pack", "/tmp/contacts.vcf"],
+            {'pack': "/tmp/contacts.vcf", 'export_only': True}),
+        (["noop", "foo.bar@gmail.com", "--metrics-file", "/tmp/metrics.json"],
+            {'metrics_file': "/tmp/metrics.json"}),
+        (["noop", "foo.bar@gmail.com", "--prometheus-file", "/tmp/gcardvault.prom"],
+            {'prometheus_file': "/tmp/gcardvault.prom"}),
+        (["noop", "foo.bar@gmail.com", "--auto-maintain"],
+            {'auto_maintain': True}),
+        (["noop", "foo.bar@gmail.com", "--rebuild-manifest"],
+            {'rebuild_manifest': True}),
+        (["noop", "foo.bar@gmail.com", "--batch-target-secs", "30"],
+            {'batch_target_secs': 30}),
+        (["noop", "foo.bar@gmail.com"],
+            {'lock_wait': 0}),
+        (["noop", "foo.bar@gmail.com", "--lock-wait", "30"],
+            {'lock_wait': 30}),
     ])
 def test_arg_parsing(args, expected_properties):
     gc = Gcardvault()
@@ -102,6 +159,16 @@ def test_arg_parsing(args, expected_properties):
         assert actual_value == expected_value
 
 
+def test_arg_parsing_maintain():
+    gc = Gcardvault()
+    # Parsed only, running it would need a vault to exist
+    assert gc._parse_options(["maintain", "-o", "/tmp/output"])
+
+    assert gc.command == "maintain"
+    assert gc.user is None
+    assert gc.output_dir == "/tmp/output"
+
+
 def test_creates_dirs():
     (conf_dir, output_dir) = _setup_dirs()
     gc = Gcardvault()
@@ -123,6 +190,95 @@ def test_sync():
     _assert_vcf_files_match(output_dir, google_apis_fake.count, google_apis_fake.records)
 
 
+def test_sync_parallel(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=25)
+
+    # Small batches, so there are several to download concurrently
+    monkeypatch.setattr("gcardvault.gcardvault.CARDDAV_REPORT_PAGE_SIZE", 4)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--parallel", "3", "--batch-size-min", "4", "-c", conf_dir, "-o", output_dir])
+
+    _assert_vcf_files_match(output_dir, google_apis_fake.count, google_apis_fake.records)
+
+
+def test_sync_parallel_missing_vcard(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=25)
+    google_apis_fake.omit_vcards([google_apis_fake.records[10]["href"]])
+
+    monkeypatch.setattr("gcardvault.gcardvault.CARDDAV_REPORT_PAGE_SIZE", 4)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with pytest.raises(RuntimeError, match="vCard could not be downloaded"):
+        gc.run(["sync", "foo.bar@gmail.com", "--parallel", "3", "--batch-size-min", "4", "-c", conf_dir, "-o", output_dir])
+
+
+def test_sync_shrinks_batches_on_transient_failure(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=40)
+    google_apis_fake.fail_carddav_requests(2)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--batch-size-min", "5", "-c", conf_dir, "-o", output_dir])
+
+    _assert_vcf_files_match(output_dir, google_apis_fake.count, google_apis_fake.records)
+    # Batch of 40 fails and is split in two, the first 20 fails again and is
+    # split into 10s, then the remaining 20 goes through
+    assert google_apis_fake.carddav_batch_sizes == [10, 10, 20]
+    assert "Downloaded vCards in 3 batch(es) sized 10-20" in capsys.readouterr().out
+
+
+def test_sync_gives_up_after_repeated_transient_failures():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=10)
+    google_apis_fake.fail_carddav_requests(10)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with pytest.raises(TransientApiError):
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+
+def test_sync_commits_vcards_left_by_failed_sync():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+    # First two batches go through, the third fails every attempt
+    google_apis_fake.fail_carddav_requests(3, after=2)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with pytest.raises(TransientApiError):
+        gc.run(["sync", "foo.bar@gmail.com", "--batch-size-min", "1", "--batch-size-max", "1",
+                "-c", conf_dir, "-o", output_dir])
+    # Saving may be cut short by the failure, but it gets partway
+    left_behind = len(Repo(output_dir).untracked_files)
+    assert left_behind >= 1
+
+    # Same content gets downloaded again, and must still be committed
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--batch-size-min", "1", "--batch-size-max", "1",
+            "-c", conf_dir, "-o", output_dir])
+
+    assert gc._sync_counts['unchanged'] == left_behind
+    repo = Repo(output_dir)
+    assert repo.untracked_files == []
+    assert not repo.is_dirty()
+    committed = [blob.path for blob in repo.head.commit.tree.traverse() if blob.path.endswith(".vcf")]
+    assert sorted(committed) == sorted(record["file_name"] for record in google_apis_fake.records)
+
+
 def test_clean():
     (conf_dir, output_dir) = _setup_dirs()
 
@@ -145,6 +301,34 @@ def test_clean():
     _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=2)  # 1 additional commit, 2 file removals
 
 
+def test_clean_with_rebuilt_manifest():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    # File dropped into the vault behind the manifest's back is only
+    # noticed once the manifest is rebuilt
+    stray_file_path = os.path.join(output_dir, "stray_contact_c0ffee.vcf")
+    Path(stray_file_path).write_text("BEGIN:VCARD\nEND:VCARD\n")
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--clean", "-c", conf_dir, "-o", output_dir])
+    assert os.path.exists(stray_file_path)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--clean", "--rebuild-manifest", "-c", conf_dir, "-o", output_dir])
+    assert not os.path.exists(stray_file_path)
+    _assert_vcf_files_match(output_dir, google_apis_fake.count, google_apis_fake.records)
+
+
 def test_without_clean():
     (conf_dir, output_dir) = _setup_dirs()
 
@@ -183,6 +367,142 @@ def test_sync_export_only():
     _assert_vcf_files_match(output_dir, google_apis_fake.count)
 
 
+@pytest.mark.parametrize("pack_file_name", ["contacts.vcf", "contacts.vcf.gz"])
+def test_sync_pack(pack_file_name):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=25)
+    pack_path = os.path.join(conf_dir, pack_file_name)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--pack", pack_path, "-c", conf_dir, "-o", output_dir])
+
+    # Nothing written to the vault, everything in the pack
+    _assert_git_repo_state(output_dir, repo_exists=False)
+    _assert_vcf_files_match(output_dir, 0)
+    assert not os.path.exists(f"{pack_path}.tmp")
+
+    opener = gzip.open if pack_path.endswith(".gz") else open
+    with opener(pack_path, 'rb') as file:
+        content = file.read().decode('utf-8')
+    assert content.count("BEGIN:VCARD") == 25
+
+    # Any one vCard can be read straight from its offset
+    for record in [google_apis_fake.records[0], google_apis_fake.records[17]]:
+        assert read_packed_vcard(pack_path, record["id"]) == record["vcard"]
+
+    # Packs everything again on the next run, not only what changed
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--pack", pack_path, "-c", conf_dir, "-o", output_dir])
+    assert gc._sync_counts['to_update'] == 25
+
+
+def test_sync_pack_to_stdout(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with patch("sys.stdout", new=io.TextIOWrapper(io.BytesIO())) as stdout:
+        gc.run(["sync", "foo.bar@gmail.com", "--pack", "-", "-c", conf_dir, "-o", output_dir])
+        stdout.flush()
+        content = stdout.buffer.getvalue().decode('utf-8')
+
+    assert content == "".join(record["vcard"] for record in google_apis_fake.records)
+    assert "3 contact(s) need to be updated" in capsys.readouterr().err
+
+
+def test_sync_metrics_file():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=25)
+    metrics_file_path = os.path.join(conf_dir, "metrics.json")
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--metrics-file", metrics_file_path, "-c", conf_dir, "-o", output_dir])
+
+    with open(metrics_file_path, 'r') as file:
+        metrics = json.load(file)
+
+    assert metrics['succeeded'] is True
+    assert metrics['counts']['to_update'] == 25
+    assert metrics['batch_sizes']['batches'] == 1
+    assert set(metrics['phases']) == {
+        "list_contacts", "filter_contacts", "download_vcards", "save_vcards", "stage_files", "commit"}
+    assert metrics['phases']['list_contacts']['items'] == 25
+    assert metrics['phases']['download_vcards']['items'] == 25
+    assert metrics['phases']['save_vcards']['items'] == 25
+    assert metrics['phases']['stage_files']['items'] == 25
+    assert metrics['requests']['people']['count'] == 1
+    assert metrics['requests']['people']['bytes'] > 0
+    assert metrics['requests']['carddav']['count'] == 1
+    assert metrics['requests']['carddav']['bytes'] > 0
+    assert set(metrics['requests']['carddav']['latency_secs']) == {"p50", "p90", "p99", "max"}
+
+
+def test_sync_metrics_file_on_failure():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+    google_apis_fake.omit_vcards([google_apis_fake.records[2]["href"]])
+    metrics_file_path = os.path.join(conf_dir, "metrics.json")
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with pytest.raises(RuntimeError):
+        gc.run(["sync", "foo.bar@gmail.com", "--metrics-file", metrics_file_path, "-c", conf_dir, "-o", output_dir])
+
+    with open(metrics_file_path, 'r') as file:
+        metrics = json.load(file)
+    assert metrics['succeeded'] is False
+    assert "vCard could not be downloaded" in metrics['error']
+
+
+def test_sync_prometheus_file():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+    prometheus_file_path = os.path.join(conf_dir, "gcardvault.prom")
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--prometheus-file", prometheus_file_path, "-c", conf_dir, "-o", output_dir])
+
+    metrics = _read_prometheus_file(prometheus_file_path)
+    user = 'user="foo.bar@gmail.com"'
+    assert metrics[f'gcardvault_last_run_success{{{user}}}'] == 1
+    assert metrics[f'gcardvault_contacts{{{user},state="total"}}'] == 5
+    assert metrics[f'gcardvault_contacts{{{user},state="updated"}}'] == 5
+    assert metrics[f'gcardvault_contacts{{{user},state="removed"}}'] == 0
+    assert metrics[f'gcardvault_http_requests{{{user},api="people"}}'] == 1
+    assert metrics[f'gcardvault_http_requests{{{user},api="carddav"}}'] == 1
+    assert metrics[f'gcardvault_http_received_bytes{{{user},api="people"}}'] > 0
+    assert metrics[f'gcardvault_http_received_bytes{{{user},api="carddav"}}'] > 0
+    assert metrics[f'gcardvault_http_retries{{{user},api="carddav"}}'] == 0
+    assert f'gcardvault_phase_duration_seconds{{{user},phase="download_vcards"}}' in metrics
+    assert f'gcardvault_git_commit_duration_seconds{{{user}}}' in metrics
+    last_success_at = metrics[f'gcardvault_last_success_timestamp_seconds{{{user}}}']
+
+    # Failed sync still reports when the last successful one was
+    google_apis_fake.touch_record(1)
+    google_apis_fake.omit_vcards([google_apis_fake.records[1]["href"]])
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with pytest.raises(RuntimeError):
+        gc.run(["sync", "foo.bar@gmail.com", "--prometheus-file", prometheus_file_path, "-c", conf_dir, "-o", output_dir])
+
+    metrics = _read_prometheus_file(prometheus_file_path)
+    assert metrics[f'gcardvault_last_run_success{{{user}}}'] == 0
+    assert metrics[f'gcardvault_last_success_timestamp_seconds{{{user}}}'] == last_success_at
+    assert f'gcardvault_contacts{{{user},state="total"}}' not in metrics
+
+
 def test_new_git_repo():
     (conf_dir, output_dir) = _setup_dirs()
     google_apis_fake = FakeGoogleApis(fake_data_repo, cap=0)
@@ -211,6 +531,224 @@ def test_git_commits():
     _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=3)  # initial commit + 1, 3 vcf files
 
 
+def test_git_stages_only_changed_files():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=5)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=5)
+    record = google_apis_fake_2.change_name(2, "Foo", "Bar")
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    with patch.object(IndexFile, "add", autospec=True, side_effect=IndexFile.add) as add_mock:
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    add_mock.assert_called_once()
+    assert add_mock.call_args.args[1] == [record["file_name"]]
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=2)
+
+
+def test_sync_skips_unchanged_vcards():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=5)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    # Etags change for all, but only one vCard's content changes
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=5)
+    for idx in range(4):
+        google_apis_fake_2.touch_record(idx)
+    changed_record = google_apis_fake_2.change_name(4, "Foo", "Bar")
+    unchanged_file_path = os.path.join(output_dir, google_apis_fake_2.records[0]["file_name"])
+    mtime_ns = os.stat(unchanged_file_path).st_mtime_ns
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert gc._sync_counts['to_update'] == 5
+    assert gc._sync_counts['unchanged'] == 4
+    assert os.stat(unchanged_file_path).st_mtime_ns == mtime_ns
+    _assert_vcf_files_match(output_dir, google_apis_fake_2.count, [changed_record])
+
+
+def test_sync_skips_unchanged_vcards_without_stored_hashes():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    # Etag store and manifest lost, so everything is downloaded again, but
+    # the files on disk are compared and none rewritten
+    os.remove(os.path.join(conf_dir, "foo.bar@gmail.com.etags.db"))
+    os.remove(os.path.join(output_dir, ".manifest.tsv"))
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert gc._sync_counts['to_update'] == 5
+    assert gc._sync_counts['unchanged'] == 5
+
+
+def test_sync_sharded_layout():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--layout", "sharded", "-c", conf_dir, "-o", output_dir])
+
+    _assert_sharded_vcf_files_match(output_dir, google_apis_fake.records)
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=5)
+    assert Repo(output_dir).config_reader().get_value("gcardvault", "layout") == "sharded"
+
+    # Layout is remembered, a changed contact is renamed within its shard
+    record = google_apis_fake.change_name(0, "Foo", "Bar")
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    _assert_sharded_vcf_files_match(output_dir, google_apis_fake.records)
+    _assert_vcf_file_content_match(output_dir, _sharded_file_name(record), record["vcard"])
+
+
+def test_sync_export_only_keeps_sharded_layout(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-e", "--layout", "sharded", "-c", conf_dir, "-o", output_dir])
+    _assert_sharded_vcf_files_match(output_dir, google_apis_fake.records)
+    capsys.readouterr()
+
+    # No repo to record the layout in, it's worked out from the files instead
+    record = google_apis_fake.change_name(0, "Foo", "Bar")
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-e", "-c", conf_dir, "-o", output_dir])
+
+    assert "Moving" not in capsys.readouterr().out
+    _assert_vcf_files_match(output_dir, 0)
+    _assert_sharded_vcf_files_match(output_dir, google_apis_fake.records)
+    _assert_vcf_file_content_match(output_dir, _sharded_file_name(record), record["vcard"])
+
+
+def test_sync_export_only_name_with_slash_stays_flat(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+    record = google_apis_fake.change_name(0, "AC/DC", "Band")
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-e", "-c", conf_dir, "-o", output_dir])
+    assert record.file_name().startswith("ac_dc_band_")
+    _assert_vcf_files_match(output_dir, 5, google_apis_fake.records)
+    capsys.readouterr()
+
+    # Not mistaken for a sharded export next time round
+    google_apis_fake.touch_record(1)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-e", "-c", conf_dir, "-o", output_dir])
+
+    assert "Moving" not in capsys.readouterr().out
+    assert gc._sync_counts['to_update'] == 1
+    _assert_vcf_files_match(output_dir, 5, google_apis_fake.records)
+
+
+def test_sync_migrates_flat_vault_to_sharded():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    _assert_vcf_files_match(output_dir, 5, google_apis_fake.records)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--layout", "sharded", "-c", conf_dir, "-o", output_dir])
+
+    _assert_vcf_files_match(output_dir, 0)
+    _assert_sharded_vcf_files_match(output_dir, google_apis_fake.records)
+
+    # One commit of renames, history follows each file
+    repo = Repo(output_dir)
+    commits = list(repo.iter_commits())
+    assert len(commits) == 3
+    assert commits[0].message == "Move vault to sharded layout"
+    file_name = _sharded_file_name(google_apis_fake.records[0])
+    assert len(repo.git.log("--follow", "--format=%H", "--", file_name).split()) == 2
+    assert repo.git.status("--porcelain") == ""
+
+
+def test_maintain(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    capsys.readouterr()
+
+    gc = Gcardvault()
+    assert gc.run(["maintain", "-o", output_dir]) is None
+
+    output = capsys.readouterr().out
+    assert "Maintained gcardvault repository" in output
+    assert re.search(r"Before: [1-9]\d* loose object\(s\)", output)
+    assert "After: 0 loose object(s)" in output
+    assert os.path.exists(os.path.join(output_dir, ".git", "objects", "info", "commit-graph"))
+    assert Repo(output_dir).config_reader().get_value("gcardvault", "maintainedcommits") == 2
+
+
+def test_maintain_without_vault():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcardvault()
+    with pytest.raises(GcardvaultError, match="No vault found"):
+        gc.run(["maintain", "-o", str(output_dir)])
+    assert not os.path.exists(os.path.join(output_dir, ".git"))
+
+
+def test_sync_auto_maintain(monkeypatch, capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+    monkeypatch.setattr("gcardvault.gcardvault.AUTO_MAINTAIN_COMMITS", 3)
+
+    for expect_maintained in [False, True, False]:
+        google_apis_fake.touch_record(0)
+        google_apis_fake.change_name(0, "Foo", f"Bar {expect_maintained}")
+        gc = Gcardvault(
+            google_oauth2=_get_google_oauth2_mock(),
+            google_apis=google_apis_fake)
+        gc.run(["sync", "foo.bar@gmail.com", "--auto-maintain", "-c", conf_dir, "-o", output_dir])
+        assert ("Maintained gcardvault repository" in capsys.readouterr().out) == expect_maintained
+
+
 def test_etags_none_changed():
     (conf_dir, output_dir) = _setup_dirs()
 
@@ -303,6 +841,338 @@ def test_etags_some_added():
     _assert_vcf_files_match(output_dir, google_apis_fake_2.count, google_apis_fake_2.records)
 
 
+def test_etags_not_saved_when_download_fails():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    # Initial request fails partway through, no etags should be saved
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=3)
+    google_apis_fake_1.omit_vcards([google_apis_fake_1.records[2]["href"]])
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    with pytest.raises(RuntimeError):
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    # Second request, all vcards should be requested again
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=3, vcards_allowlist=[])
+    google_apis_fake_2.allow_vcards(record["href"] for record in google_apis_fake_2.records)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    _assert_vcf_files_match(output_dir, google_apis_fake_2.count, google_apis_fake_2.records)
+    assert google_apis_fake_2.vcards_requested == 3
+
+
+def test_sync_aborts_when_download_fails():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    # Last vcard is missing from the response, the sync should abort
+    # without committing anything to the vault
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3)
+    google_apis_fake.omit_vcards([google_apis_fake.records[2]["href"]])
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with pytest.raises(RuntimeError, match="vCard could not be downloaded"):
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    _assert_git_repo_state(output_dir, commit_count=1)  # initial commit
+
+
+def test_sync_pipelined_across_pages(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    # Several pages of contacts and several batches per page
+    google_apis_fake = FakeGoogleApis(fake_data_repo)
+    monkeypatch.setattr("gcardvault.gcardvault.CARDDAV_REPORT_PAGE_SIZE", 30)
+    monkeypatch.setattr("gcardvault.gcardvault.PIPELINE_VCARD_QUEUE_SIZE", 5)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--parallel", "2", "-c", conf_dir, "-o", output_dir])
+
+    _assert_vcf_files_match(output_dir, google_apis_fake.count, google_apis_fake.records)
+    assert google_apis_fake.vcards_requested == google_apis_fake.count
+
+
+def test_iter_multistatus():
+    xml = b'<d:multistatus xmlns:d="DAV:">' \
+        + b''.join(f'<d:response><d:href>/{i}</d:href></d:response>'.encode() for i in range(3)) \
+        + b'<d:sync-token>abc</d:sync-token></d:multistatus>'
+
+    chunks_read = []
+
+    def chunks():
+        for i in range(len(xml)):
+            chunks_read.append(i)
+            yield xml[i:i + 1]
+
+    elements = []
+    for elem in iter_multistatus(chunks()):
+        # Yielded as soon as complete, not once the whole document is read
+        assert len(chunks_read) < len(xml) - 10
+        elements.append((elem.tag, elem.findtext("{DAV:}href") or elem.text))
+
+    assert elements == [
+        ("{DAV:}response", "/0"),
+        ("{DAV:}response", "/1"),
+        ("{DAV:}response", "/2"),
+        ("{DAV:}sync-token", "abc"),
+    ]
+
+
+def test_iter_multistatus_truncated():
+    xml = b'<d:multistatus xmlns:d="DAV:"><d:response><d:href>/0</d:href></d:response><d:resp'
+    with pytest.raises(ElementTree.ParseError):
+        list(iter_multistatus([xml]))
+
+
+def test_etags_migrated_from_legacy_file():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    # Legacy tab-separated etags file, as written by previous versions
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3, vcards_allowlist=[])
+    conf_dir.mkdir(parents=True)
+    output_dir.mkdir(parents=True)
+    with open(os.path.join(conf_dir, ".etags"), 'w') as file:
+        for record in google_apis_fake.records:
+            print(f"{record['id'].lower()}\t{record['etag']}", file=file)
+            Path(output_dir, record["file_name"]).write_text(record["vcard"])
+
+    # Etags should carry over, so no vcards should be requested
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--export-only", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis_fake.vcards_requested == 0
+    assert os.path.exists(os.path.join(conf_dir, "foo.bar@gmail.com.etags.db"))
+
+
+def test_etags_migrated_from_shared_db():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=3)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    gc.run(["sync", "foo.bar@gmail.com", "--export-only", "-c", conf_dir, "-o", output_dir])
+
+    # Shared by all users, as written by previous versions
+    os.rename(os.path.join(conf_dir, "foo.bar@gmail.com.etags.db"), os.path.join(conf_dir, ".etags.db"))
+
+    # Etags should carry over, so no vcards should be requested
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=3, vcards_allowlist=[])
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    gc.run(["sync", "foo.bar@gmail.com", "--export-only", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis_fake_2.vcards_requested == 0
+    assert os.path.exists(os.path.join(conf_dir, "foo.bar@gmail.com.etags.db"))
+    # Left for any other users still to be migrated
+    assert os.path.exists(os.path.join(conf_dir, ".etags.db"))
+
+
+def test_etags_partitioned_per_user():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    for user in ["foo.bar@gmail.com", "baz.qux@gmail.com"]:
+        gc = Gcardvault(
+            google_oauth2=_get_google_oauth2_mock(email=user),
+            google_apis=FakeGoogleApis(fake_data_repo, cap=3))
+        gc.run(["sync", user, "--export-only", "-c", conf_dir, "-o", Path(output_dir, user)])
+        assert gc._sync_counts['to_update'] == 3
+
+    assert os.path.exists(os.path.join(conf_dir, "foo.bar@gmail.com.etags.db"))
+    assert os.path.exists(os.path.join(conf_dir, "baz.qux@gmail.com.etags.db"))
+
+
+@pytest.mark.parametrize("lock_file", ["conf/foo.bar@gmail.com.lock", "output/.gcardvault.lock"])
+def test_sync_fails_fast_when_locked(lock_file):
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    output_dir.mkdir(parents=True)
+
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    with FileLock(os.path.join("/tmp", lock_file)):
+        with pytest.raises(GcardvaultError, match=f"in use by another gcardvault run \\(process {os.getpid()}\\)"):
+            gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis_fake.vcards_requested == 0
+    assert not os.path.exists(os.path.join(output_dir, ".git"))
+
+
+def test_sync_waits_for_lock():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+
+    lock = FileLock(os.path.join(output_dir, ".gcardvault.lock")).acquire()
+    threading.Timer(0.3, lock.release).start()
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=FakeGoogleApis(fake_data_repo, cap=3))
+    gc.run(["sync", "foo.bar@gmail.com", "--lock-wait", "10", "-c", conf_dir, "-o", output_dir])
+
+    assert gc._sync_counts['to_update'] == 3
+
+
+def test_maintain_fails_fast_when_locked():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=FakeGoogleApis(fake_data_repo, cap=3))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    gc = Gcardvault()
+    with FileLock(os.path.join(output_dir, ".gcardvault.lock")):
+        with pytest.raises(GcardvaultError, match="Vault is in use"):
+            gc.run(["maintain", "-o", output_dir])
+
+
+def test_sync_incremental():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    # Initial request, full listing, saves sync token
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=5)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "incremental", "-c", conf_dir, "-o", output_dir])
+    _assert_vcf_files_match(output_dir, google_apis_fake_1.count, google_apis_fake_1.records)
+    assert google_apis_fake_1.sync_token_used is None
+
+    # Second request, one changed and one deleted, only those are listed
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=5, vcards_allowlist=[])
+    record = google_apis_fake_2.touch_record(1)
+    google_apis_fake_2.allow_vcards([record["href"]])
+    deleted_record = google_apis_fake_2.delete_record(3)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "incremental", "--clean", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis_fake_2.sync_token_used == FAKE_SYNC_TOKEN
+    assert google_apis_fake_2.vcards_requested == 1
+    assert not os.path.exists(os.path.join(output_dir, deleted_record["file_name"]))
+    _assert_vcf_files_match(output_dir, google_apis_fake_2.count, google_apis_fake_2.records)
+    _assert_git_repo_state(output_dir, commit_count=3)
+
+
+def test_sync_incremental_expired_token():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=5)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "incremental", "-c", conf_dir, "-o", output_dir])
+
+    # Token expired, should fall back to a full listing and clean
+    # based on it
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=3)
+    google_apis_fake_2.expire_sync_token()
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "incremental", "--clean", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis_fake_2.sync_token_used is None
+    _assert_vcf_files_match(output_dir, google_apis_fake_2.count, google_apis_fake_2.records)
+
+
+def test_sync_carddav():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    # Initial request, full listing over a truncated sync-collection
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=5)
+    google_apis_fake_1.sync_collection_page_size = 2
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "carddav", "-c", conf_dir, "-o", output_dir])
+    _assert_vcf_files_match(output_dir, google_apis_fake_1.count, google_apis_fake_1.records)
+    assert google_apis_fake_1.sync_token_used is None
+
+    # Second request, one renamed and one deleted, only those are synced
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=5, vcards_allowlist=[])
+    old_file_name = google_apis_fake_2.records[1]["file_name"]
+    record = google_apis_fake_2.change_name(1, "Foo", "Bar")
+    google_apis_fake_2.allow_vcards([record["href"]])
+    deleted_record = google_apis_fake_2.delete_record(3)
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "carddav", "--clean", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis_fake_2.sync_token_used == FAKE_SYNC_TOKEN
+    assert google_apis_fake_2.vcards_requested == 1
+    assert not os.path.exists(os.path.join(output_dir, old_file_name))
+    assert not os.path.exists(os.path.join(output_dir, deleted_record["file_name"]))
+    _assert_vcf_files_match(output_dir, google_apis_fake_2.count, google_apis_fake_2.records)
+
+
+def test_sync_carddav_expired_token():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis_fake_1 = FakeGoogleApis(fake_data_repo, cap=5)
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_1)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "carddav", "-c", conf_dir, "-o", output_dir])
+
+    # Token expired, full listing again, but carddav etags are unchanged
+    # so no vcards should be downloaded
+    google_apis_fake_2 = FakeGoogleApis(fake_data_repo, cap=5, vcards_allowlist=[])
+    google_apis_fake_2.expire_sync_token()
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake_2)
+    gc.run(["sync", "foo.bar@gmail.com", "--sync-mode", "carddav", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis_fake_2.sync_token_used is None
+    assert google_apis_fake_2.vcards_requested == 0
+    _assert_vcf_files_match(output_dir, google_apis_fake_2.count, google_apis_fake_2.records)
+
+
+@pytest.mark.parametrize(
+    "vcard, expected_name", [
+        ("BEGIN:VCARD\nVERSION:3.0\nFN:Foo Bar\nEND:VCARD\n", "Foo Bar"),
+        ("BEGIN:VCARD\r\nFN;CHARSET=UTF-8:Foo\r\n  Bar\r\nEND:VCARD\r\n", "Foo Bar"),
+        ("BEGIN:VCARD\nitem1.FN:Bar\\, Foo\nEND:VCARD\n", "Bar, Foo"),
+        ("BEGIN:VCARD\nN:Bar;Foo;;;\nEND:VCARD\n", None),
+    ])
+def test_vcard_formatted_name(vcard, expected_name):
+    assert get_vcard_formatted_name(vcard) == expected_name
+
+
+@patch("gcardvault.gcardvault.build_service")
+def test_google_apis_expired_sync_token(build_mock):
+    error = HttpError(
+        MagicMock(status=400),
+        b'{"error": {"status": "FAILED_PRECONDITION", "details": [{"reason": "EXPIRED_SYNC_TOKEN"}]}}')
+    list_request = build_mock.return_value.people.return_value.connections.return_value.list
+    list_request.return_value.execute.side_effect = error
+
+    google_apis = GoogleApis()
+    with pytest.raises(SyncTokenExpiredError):
+        google_apis.request_contact_list(
+            MagicMock(token="phony"), sync_token="abc", request_sync_token=True)
+
+    assert list_request.call_args.kwargs["syncToken"] == "abc"
+    assert list_request.call_args.kwargs["requestSyncToken"] is True
+    assert "sortOrder" not in list_request.call_args.kwargs
+
+
 def test_sync_name_change():
     (conf_dir, output_dir) = _setup_dirs()
 
@@ -333,6 +1203,319 @@ def test_sync_name_change():
     assert os.path.exists(os.path.join(output_dir, new_file_name))
     _assert_vcf_files_match(output_dir, google_apis_fake_2.count, google_apis_fake_2.records)
 
+    # Rename is committed as the old file removed and the new one added
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=2)
+    tree = Repo(output_dir).head.commit.tree
+    assert new_file_name in tree
+    assert old_file_name not in tree
+
+
+def test_sync_all(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=5)
+    google_apis_fake.close = MagicMock()
+
+    # Two accounts with saved tokens, one without (which fails)
+    conf_dir.mkdir(parents=True)
+    for user in ["foo.bar@gmail.com", "baz.qux@gmail.com"]:
+        Path(conf_dir, f"{user}.token.json").write_text("{}")
+    manifest_file_path = Path(conf_dir, "manifest.txt")
+    manifest_file_path.write_text(f"""
+# Accounts to back up
+foo.bar@gmail.com
+Baz.Qux@gmail.com   {output_dir}/custom
+no.token@gmail.com
+""")
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    prometheus_file_path = Path(conf_dir, "gcardvault.prom")
+    exit_code = gc.run(["sync-all", str(manifest_file_path), "--parallel-accounts", "2",
+                        "--prometheus-file", str(prometheus_file_path), "-c", conf_dir, "-o", output_dir])
+
+    assert exit_code == 1
+    _assert_vcf_files_match(Path(output_dir, "foo.bar@gmail.com"), 5, google_apis_fake.records)
+    _assert_vcf_files_match(Path(output_dir, "custom"), 5, google_apis_fake.records)
+    _assert_git_repo_state(Path(output_dir, "custom"), commit_count=2)
+    assert not Path(output_dir, "no.token@gmail.com", ".git").exists()
+
+    captured = capsys.readouterr()
+    assert "foo.bar@gmail.com: OK" in captured.out
+    assert "baz.qux@gmail.com: OK" in captured.out
+    assert "no.token@gmail.com: FAILED" in captured.out
+    assert "2 of 3 account(s) synced successfully" in captured.out
+    assert "[baz.qux@gmail.com] Saved contact" in captured.out
+
+    # One file for all accounts
+    metrics = _read_prometheus_file(prometheus_file_path)
+    assert metrics['gcardvault_last_run_success{user="foo.bar@gmail.com"}'] == 1
+    assert metrics['gcardvault_last_run_success{user="baz.qux@gmail.com"}'] == 1
+    assert metrics['gcardvault_last_run_success{user="no.token@gmail.com"}'] == 0
+    assert metrics['gcardvault_contacts{user="baz.qux@gmail.com",state="total"}'] == 5
+
+
+def test_sync_all_relative_dirs(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    for user in ["foo.bar@gmail.com", "baz.qux@gmail.com"]:
+        Path(conf_dir, f"{user}.token.json").write_text("{}")
+    Path(conf_dir, "manifest.txt").write_text("foo.bar@gmail.com\nbaz.qux@gmail.com\n")
+
+    # git changes the working directory mid-sync, so paths must not be relative
+    synced = []
+    original_sync_account = Gcardvault._sync_account
+
+    def sync_account(self, user, account_output_dir):
+        synced.append((self.conf_dir, account_output_dir))
+        return original_sync_account(self, user, account_output_dir)
+
+    monkeypatch.setattr(Gcardvault, "_sync_account", sync_account)
+    monkeypatch.chdir("/tmp")
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=FakeGoogleApis(fake_data_repo, cap=3))
+    exit_code = gc.run(["sync-all", "conf/manifest.txt", "-c", "conf", "-o", "output"])
+
+    assert exit_code == 0
+    assert sorted(synced) == [
+        (str(conf_dir), os.path.join(output_dir, "baz.qux@gmail.com")),
+        (str(conf_dir), os.path.join(output_dir, "foo.bar@gmail.com")),
+    ]
+    _assert_vcf_files_match(Path(output_dir, "foo.bar@gmail.com"), 3, FakeGoogleApis(fake_data_repo, cap=3).records)
+
+
+def test_watch(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3)
+    google_apis_fake.close = MagicMock()
+    google_oauth2 = _get_google_oauth2_mock()
+    google_oauth2.refresh_credentials = MagicMock(return_value=False)
+
+    gc = Gcardvault(google_oauth2=google_oauth2, google_apis=google_apis_fake)
+
+    # Second run fails, third run succeeds again, then stop
+    runs = []
+    original_sync = gc._sync
+
+    def sync():
+        runs.append(len(runs))
+        if len(runs) == 2:
+            raise RuntimeError("boom")
+        if len(runs) == 3:
+            gc.stop()
+        original_sync()
+
+    statuses = []
+    original_write_status_file = gc._write_status_file
+
+    def write_status_file(status):
+        original_write_status_file(status)
+        statuses.append(json.loads(Path(conf_dir, "foo.bar@gmail.com.status.json").read_text()))
+
+    monkeypatch.setattr(gc, "_sync", sync)
+    monkeypatch.setattr(gc, "_write_status_file", write_status_file)
+    monkeypatch.setattr(gc, "_next_watch_delay", lambda: 0.01)
+    gc.run(["watch", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert len(runs) == 3
+    assert [status['status'] for status in statuses] == ["ok", "error", "ok"]
+    assert statuses[1]['error'] == "boom"
+    assert statuses[2]['runs'] == 3
+    assert statuses[2]['counts'] == {'up_to_date': 3, 'to_update': 0, 'unchanged': 0, 'removed': 0}
+
+    # Credentials loaded once, refreshed ahead of the later runs
+    assert google_oauth2.get_credentials.call_count == 1
+    assert google_oauth2.refresh_credentials.call_count == 1
+    google_apis_fake.close.assert_called_once()
+    _assert_vcf_files_match(output_dir, google_apis_fake.count, google_apis_fake.records)
+
+
+@pytest.mark.parametrize(
+    "expires_in, refresh_token, expect_refresh", [
+        (3600, "abc", False),
+        (60, "abc", True),
+        (-60, "abc", True),
+        (60, None, False),
+        (None, "abc", False),
+    ])
+def test_refresh_credentials(expires_in, refresh_token, expect_refresh):
+    (conf_dir, _) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    messages = []
+    google_oauth2 = GoogleOAuth2("gcardvault", lambda *args: "", log=messages.append)
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    credentials = MagicMock(
+        refresh_token=refresh_token,
+        expiry=now + timedelta(seconds=expires_in) if expires_in is not None else None)
+    credentials.to_json.return_value = "{}"
+
+    refreshed = google_oauth2.refresh_credentials(credentials, Path(conf_dir, "token.json"), 300)
+
+    assert refreshed == expect_refresh
+    assert credentials.refresh.called == expect_refresh
+    assert len(messages) == (1 if expect_refresh else 0)
+
+
+def test_refresh_credentials_message_kept_off_packed_stdout(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    gc = Gcardvault()
+    gc._parse_options(["sync", "foo.bar@gmail.com", "--pack", "-", "-c", conf_dir, "-o", output_dir])
+
+    credentials = MagicMock(refresh_token="abc", expiry=datetime.now(timezone.utc).replace(tzinfo=None))
+    credentials.to_json.return_value = "{}"
+    conf_dir.mkdir(parents=True)
+    gc._google_oauth2.refresh_credentials(credentials, Path(conf_dir, "token.json"), 300)
+
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert "Credentials refreshed" in captured.err
+
+
+def test_google_apis_share_session():
+    google_apis = GoogleApis()
+    shared = google_apis.share()
+
+    session = google_apis._get_session()
+    assert shared._get_session() is session
+
+    # Closing the shared one leaves the session open for the others
+    shared.close()
+    assert google_apis._get_session() is session
+    google_apis.close()
+    assert google_apis._get_session() is not session
+
+
+def test_sync_closes_google_apis():
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis_fake = FakeGoogleApis(fake_data_repo, cap=3)
+    google_apis_fake.close = MagicMock()
+
+    gc = Gcardvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=google_apis_fake)
+    gc.run(["sync", "foo.bar@gmail.com", "--parallel", "4", "-c", conf_dir, "-o", output_dir])
+
+    google_apis_fake.close.assert_called_once()
+    assert google_apis_fake.pool_size == 4
+
+
+@patch("gcardvault.gcardvault.build_service")
+def test_google_apis_reuses_people_service(build_mock):
+    google_apis = GoogleApis()
+    credentials = MagicMock(token="phony")
+
+    google_apis.request_contact_list(credentials)
+    google_apis.request_contact_list(credentials, page_token="abc")
+    assert build_mock.call_count == 1
+
+    service = build_mock.return_value
+    google_apis.close()
+    service.close.assert_called_once()
+
+
+@patch("httplib2.Http.request", side_effect=AssertionError("No HTTP requests expected"))
+@patch("googleapiclient.discovery_cache.get_static_doc", wraps=get_static_doc)
+def test_discovery_documents_are_static(get_static_doc_mock, _):
+    credentials = Credentials(token="phony")
+
+    for _ in range(2):
+        with build_service('people', 'v1', credentials) as service:
+            assert service.people().connections() is not None
+        with build_service('oauth2', 'v2', credentials) as service:
+            assert service.userinfo() is not None
+
+    # Read from the package at most once per document, never fetched
+    assert get_static_doc_mock.call_count <= 2
+
+
+@patch("requests.Session.request")
+def test_google_apis_carddav_invalid_sync_token(request_mock):
+    request_mock.return_value = MagicMock(
+        status_code=403,
+        content=b'<d:error xmlns:d="DAV:"><d:valid-sync-token/></d:error>')
+
+    google_apis = GoogleApis()
+    with pytest.raises(SyncTokenExpiredError):
+        google_apis.request_carddav_report(
+            MagicMock(token="phony"), "foo.bar@gmail.com", "<xml/>", depth="0")
+
+    assert request_mock.call_args.kwargs["headers"]["Depth"] == "0"
+
+
+@patch("requests.Session.request")
+def test_google_apis_carddav_server_error_is_transient(request_mock):
+    request_mock.return_value = MagicMock(status_code=500)
+
+    google_apis = GoogleApis()
+    with pytest.raises(TransientApiError) as exc_info:
+        google_apis.request_carddav_report(MagicMock(token="phony"), "foo.bar@gmail.com", "<xml/>")
+
+    assert exc_info.value.status == 500
+    assert "timeout" in request_mock.call_args.kwargs
+
+
+@patch("requests.Session.request")
+def test_google_apis_carddav_backs_off_when_rate_limited(request_mock, rate_limiter_clock):
+    request_mock.side_effect = [
+        MagicMock(status_code=429, headers={"Retry-After": "7"}),
+        MagicMock(status_code=503, headers={}),
+        MagicMock(status_code=207),
+    ]
+
+    google_apis = GoogleApis()
+    google_apis.request_carddav_report(MagicMock(token="phony", client_id="backs-off"), "foo.bar@gmail.com", "<xml/>")
+
+    assert request_mock.call_count == 3
+    # Waits as long as the server asked for the first time around
+    assert rate_limiter_clock.sleeps[0] == pytest.approx(7)
+
+
+@patch("requests.Session.request")
+def test_google_apis_carddav_gives_up_when_rate_limited(request_mock, rate_limiter_clock):
+    request_mock.return_value = MagicMock(status_code=429, headers={})
+
+    google_apis = GoogleApis()
+    with pytest.raises(RateLimitedError):
+        google_apis.request_carddav_report(MagicMock(token="phony", client_id="gives-up"), "foo.bar@gmail.com", "<xml/>")
+
+    assert request_mock.call_count == API_RATE_LIMITED_ATTEMPTS
+
+
+def test_google_apis_people_backs_off_when_rate_limited(rate_limiter_clock):
+    google_apis = GoogleApis()
+    request = google_apis._get_people_service = MagicMock()
+    execute = request.return_value.people.return_value.connections.return_value.list.return_value.execute
+    execute.side_effect = [
+        HttpError(MagicMock(status=429, get=lambda key: "3"), b"RESOURCE_EXHAUSTED"),
+        {"connections": []},
+    ]
+
+    resource = google_apis.request_contact_list(MagicMock(client_id="people-backs-off"))
+
+    assert resource == {"connections": []}
+    assert execute.call_count == 2
+    assert rate_limiter_clock.sleeps[0] == pytest.approx(3)
+
+
+@patch("requests.Session.request")
+def test_google_apis_reuses_session(request_mock):
+    request_mock.return_value = MagicMock(status_code=207)
+    google_apis = GoogleApis(pool_size=4)
+    credentials = MagicMock(token="phony")
+
+    google_apis.request_carddav_report(credentials, "foo.bar@gmail.com", "<xml/>")
+    session = google_apis._get_session()
+    google_apis.request_carddav_report(credentials, "foo.bar@gmail.com", "<xml/>")
+
+    assert request_mock.call_count == 2
+    assert google_apis._get_session() is session
+    assert session.get_adapter("https://www.googleapis.com/")._pool_maxsize == 4
+
+    google_apis.close()
+    assert google_apis._get_session() is not session
+
 
 def _assert_vcf_files_match(output_dir, count, records_to_validate=[]):
     actual_files = [os.path.basename(f) for f in glob.glob(os.path.join(output_dir, "*.vcf"))]
@@ -377,6 +1560,26 @@ def _read_file(dir_path, file_name):
     return Path(dir_path, file_name).read_text()
 
 
+def _sharded_file_name(record):
+    return get_vault_file_path(record["file_name"], record["id"], "sharded")
+
+
+def _assert_sharded_vcf_files_match(output_dir, records):
+    actual_files = sorted(
+        os.path.relpath(f, output_dir) for f in glob.glob(os.path.join(output_dir, "*", "*.vcf")))
+    assert actual_files == sorted(_sharded_file_name(record) for record in records)
+
+
+def _read_prometheus_file(file_path):
+    metrics = {}
+    with open(file_path, 'r') as file:
+        for line in file:
+            if not line.startswith("#"):
+                (name, value) = line.rsplit(" ", 1)
+                metrics[name] = float(value)
+    return metrics
+
+
 def _assert_git_repo_state(output_dir, repo_exists=True, commit_count=None, last_commit_file_count=None):
     assert os.path.exists(os.path.join(output_dir, ".git")) == repo_exists
     if commit_count is not None or last_commit_file_count is not None:
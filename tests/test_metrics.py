@@ -0,0 +1,30 @@
+from gcardvault.metrics import SyncMetrics, get_percentiles
+
+
+def test_percentiles():
+    assert get_percentiles([]) is None
+    assert get_percentiles([0.5]) == {'p50': 0.5, 'p90': 0.5, 'p99': 0.5, 'max': 0.5}
+
+    percentiles = get_percentiles([i / 100 for i in range(100, 0, -1)])
+    assert percentiles == {'p50': 0.5, 'p90': 0.9, 'p99': 0.99, 'max': 1.0}
+
+
+def test_report():
+    metrics = SyncMetrics()
+
+    with metrics.phase("save_vcards", 2):
+        pass
+    metrics.add_phase("save_vcards", 1.0, 3)
+    metrics.add_items("list_contacts", 10)
+    metrics.record_request("carddav", 0.2)
+    metrics.record_request("carddav", 0.4)
+    metrics.record_bytes("carddav", 1024)
+
+    report = metrics.report()
+    assert report['phases']['save_vcards']['calls'] == 2
+    assert report['phases']['save_vcards']['items'] == 5
+    assert report['phases']['save_vcards']['secs'] >= 1.0
+    assert report['phases']['list_contacts'] == {'secs': 0.0, 'calls': 0, 'items': 10, 'items_per_sec': None}
+    assert report['requests']['carddav']['count'] == 2
+    assert report['requests']['carddav']['bytes'] == 1024
+    assert report['requests']['carddav']['latency_secs']['max'] == 0.4
@@ -0,0 +1,56 @@
+import threading
+import pytest
+from gcardvault.pipeline import Pipeline
+
+
+def test_pipeline():
+    pipeline = Pipeline()
+    numbers = pipeline.queue(maxsize=2)
+    squares = pipeline.queue(maxsize=2)
+    results = []
+
+    def produce():
+        for i in range(20):
+            numbers.put(i)
+
+    def square():
+        for i in numbers:
+            squares.put(i * i)
+
+    def collect():
+        for i in squares:
+            results.append(i)
+
+    pipeline.stage("produce", produce, output=numbers)
+    pipeline.stage("square", square, workers=3, output=squares)
+    pipeline.stage("collect", collect)
+    pipeline.join()
+
+    assert sorted(results) == [i * i for i in range(20)]
+
+
+def test_pipeline_aborts_on_error():
+    pipeline = Pipeline()
+    numbers = pipeline.queue(maxsize=1)
+    produced = []
+    consumer_started = threading.Event()
+
+    def produce():
+        # Blocks on the full queue until the pipeline is aborted
+        for i in range(1000):
+            numbers.put(i)
+            produced.append(i)
+
+    def consume():
+        for i in numbers:
+            consumer_started.set()
+            raise ValueError("boom")
+
+    pipeline.stage("produce", produce, output=numbers)
+    pipeline.stage("consume", consume)
+
+    with pytest.raises(ValueError, match="boom"):
+        pipeline.join()
+
+    assert consumer_started.is_set()
+    assert len(produced) < 1000
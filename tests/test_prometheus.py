@@ -0,0 +1,41 @@
+import os
+from gcardvault.prometheus import format_metrics, write_metrics_file, read_last_success_timestamps, \
+    LAST_SUCCESS_METRIC
+
+
+def test_format_metrics():
+    text = format_metrics([
+        ("gcardvault_http_requests", {'user': "foo.bar@gmail.com", 'api': "people"}, 2),
+        ("gcardvault_last_run_success", {'user': "foo.bar@gmail.com"}, True),
+        ("gcardvault_http_requests", {'user': "foo.bar@gmail.com", 'api': "carddav"}, 5),
+        ("gcardvault_run_duration_seconds", {'user': 'odd"user\\'}, 1.5),
+    ])
+
+    assert text == """\
+# HELP gcardvault_last_run_success Whether the last sync succeeded (1) or failed (0).
+# TYPE gcardvault_last_run_success gauge
+gcardvault_last_run_success{user="foo.bar@gmail.com"} 1
+# HELP gcardvault_run_duration_seconds How long the last sync took.
+# TYPE gcardvault_run_duration_seconds gauge
+gcardvault_run_duration_seconds{user="odd\\"user\\\\"} 1.5
+# HELP gcardvault_http_requests HTTP requests made to each Google API by the last sync.
+# TYPE gcardvault_http_requests gauge
+gcardvault_http_requests{user="foo.bar@gmail.com",api="people"} 2
+gcardvault_http_requests{user="foo.bar@gmail.com",api="carddav"} 5
+"""
+
+
+def test_last_success_timestamps_read_back():
+    file_path = "/tmp/gcardvault_test_prometheus.prom"
+    write_metrics_file(file_path, [
+        (LAST_SUCCESS_METRIC, {'user': "foo.bar@gmail.com"}, 1700000000.25),
+        (LAST_SUCCESS_METRIC, {'user': 'odd"user'}, 1700000001.0),
+        ("gcardvault_last_run_success", {'user': "foo.bar@gmail.com"}, False),
+    ])
+
+    assert read_last_success_timestamps(file_path) == {
+        "foo.bar@gmail.com": 1700000000.25,
+        'odd"user': 1700000001.0,
+    }
+    assert read_last_success_timestamps("/tmp/gcardvault_test_missing.prom") == {}
+    os.remove(file_path)
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import pytest
+from gcardvault.rate_limiter import RateLimiter, get_rate_limiter, get_backoff_secs, parse_retry_after, \
+    BACKOFF_MAX_SECS
+
+
+def test_allows_burst_then_limits_rate(rate_limiter_clock):
+    rate_limiter = RateLimiter(rate=2, burst=4)
+
+    for _ in range(4):
+        rate_limiter.acquire()
+    assert rate_limiter_clock.now == 1000.0
+
+    for _ in range(4):
+        rate_limiter.acquire()
+    assert rate_limiter_clock.now == pytest.approx(1002.0)
+
+
+def test_back_off_pauses_callers(rate_limiter_clock):
+    rate_limiter = RateLimiter(rate=10)
+
+    rate_limiter.back_off(30)
+    rate_limiter.acquire()
+    assert rate_limiter_clock.now == pytest.approx(1030.0)
+
+
+def test_shared_per_api_and_client():
+    assert get_rate_limiter("carddav", "client-a", 5) is get_rate_limiter("carddav", "client-a", 5)
+    assert get_rate_limiter("carddav", "client-a", 5) is not get_rate_limiter("carddav", "client-b", 5)
+    assert get_rate_limiter("carddav", "client-a", 5) is not get_rate_limiter("people", "client-a", 5)
+
+
+def test_shared_takes_latest_rate(rate_limiter_clock):
+    rate_limiter = get_rate_limiter("carddav", "client-a", 5)
+    assert get_rate_limiter("carddav", "client-a", 2) is rate_limiter
+    assert (rate_limiter.rate, rate_limiter.burst) == (2, 2)
+
+    for _ in range(4):
+        rate_limiter.acquire()
+    assert rate_limiter_clock.now == pytest.approx(1001.0)
+
+
+def test_backoff_secs():
+    assert get_backoff_secs(1, retry_after=12) == 12
+    for attempt in range(1, 10):
+        assert 0 <= get_backoff_secs(attempt) <= min(BACKOFF_MAX_SECS, 2 ** attempt)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("bogus") is None
+
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=60)
+    assert parse_retry_after(format_datetime(retry_at, usegmt=True)) == pytest.approx(60, abs=2)
@@ -0,0 +1,124 @@
+import pytest
+from gcardvault import Gcardvault
+from gcardvault.gcardvault import GoogleApis, RateLimitedError
+from benchmarks.synthetic import SyntheticDataRepo, SyntheticGoogleOAuth2
+from benchmarks.stand_in_server import StandInServer
+from .test_gcardvault import _setup_dirs
+
+
+@pytest.fixture
+def server():
+    with StandInServer(SyntheticDataRepo(120, seed=2)) as server:
+        yield server
+
+
+def _sync(server, *args, google_apis=None, export_only=True):
+    (conf_dir, output_dir) = _setup_dirs()
+    google_apis = google_apis or GoogleApis(people_api_url=server.people_api_url, carddav_url=server.carddav_url)
+    gc = Gcardvault(google_oauth2=SyntheticGoogleOAuth2(), google_apis=google_apis)
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir,
+            "--rate-limit", "1000", "--batch-size-min", "10", "--batch-size-max", "10"]
+           + (["--export-only"] if export_only else []) + list(args))
+    return gc
+
+
+def test_sync(server):
+    gc = _sync(server)
+
+    assert gc._sync_counts['to_update'] == 120
+    assert server.requests == {'people': 1, 'carddav': 12}
+    report = gc._metrics.report()
+    assert report['requests']['people']['bytes'] > 0
+    assert report['requests']['carddav']['count'] == 12
+    assert report['requests']['carddav']['bytes'] > 0
+
+
+def test_sync_reuses_connections(server):
+    _sync(server)
+
+    # One for the People API, one for every CardDAV batch
+    assert server.connections == 2
+
+
+def test_sync_pooled_connections(server):
+    gc = _sync(server, "--parallel", "4")
+
+    assert gc._sync_counts['to_update'] == 120
+    assert server.connections <= 5
+
+
+def test_sync_base_urls_from_env(server, monkeypatch):
+    monkeypatch.setenv("GCARDVAULT_PEOPLE_API_URL", server.people_api_url)
+    monkeypatch.setenv("GCARDVAULT_CARDDAV_URL", server.carddav_url)
+
+    gc = _sync(server, google_apis=GoogleApis())
+
+    assert gc._sync_counts['to_update'] == 120
+
+
+@pytest.mark.parametrize("api", ["people", "carddav"])
+@pytest.mark.parametrize("status", [429, 503])
+def test_sync_backs_off_when_rate_limited(server, api, status, rate_limiter_clock):
+    server.inject_errors(api, status, count=2, retry_after=3)
+
+    gc = _sync(server)
+
+    assert gc._sync_counts['to_update'] == 120
+    assert gc._metrics.report()['requests'][api]['retries'] == 2
+    assert rate_limiter_clock.sleeps[:2] == [pytest.approx(3), pytest.approx(3)]
+
+
+def test_sync_gives_up_when_rate_limited(server, rate_limiter_clock):
+    server.inject_errors("carddav", 429, count=100, retry_after=0)
+
+    with pytest.raises(RateLimitedError):
+        _sync(server)
+
+
+def test_sync_retries_truncated_response(server):
+    server.truncate_responses("carddav", count=2)
+
+    gc = _sync(server)
+
+    assert gc._sync_counts['to_update'] == 120
+    assert gc._sync_counts['unchanged'] == 0
+    assert gc._metrics.report()['requests']['carddav']['retries'] == 2
+    assert server.requests['carddav'] == 14
+
+
+@pytest.mark.parametrize("export_only", [True, False])
+def test_sync_retries_only_what_was_cut_off(export_only):
+    # Big enough vCards that a response cut off halfway has some whole ones
+    with StandInServer(SyntheticDataRepo(120, vcard_bytes=20000, seed=2)) as server:
+        server.truncate_responses("carddav", count=1)
+        gc = _sync(server, export_only=export_only)
+
+    assert gc._sync_counts['to_update'] == 120
+    assert gc._sync_counts['unchanged'] == 0
+    assert gc._metrics.report()['requests']['carddav']['retries'] == 1
+    assert len(gc._files_written) == 120
+
+
+def test_sync_pack_retries_only_what_was_cut_off():
+    pack_path = "/tmp/output/contacts.vcf"
+    with StandInServer(SyntheticDataRepo(120, vcard_bytes=20000, seed=2)) as server:
+        server.truncate_responses("carddav", count=1)
+        gc = _sync(server, "--pack", pack_path)
+
+    assert gc._metrics.report()['requests']['carddav']['retries'] == 1
+    with open(pack_path, 'rb') as file:
+        assert file.read().count(b"BEGIN:VCARD") == 120
+    with open(f"{pack_path}.idx", 'r', encoding='utf-8') as file:
+        ids = [line.split("\t")[0] for line in file.read().splitlines()[1:]]
+    assert len(ids) == len(set(ids)) == 120
+
+
+def test_latency_and_bandwidth(server):
+    server.latency_secs = 0.05
+    server.bytes_per_sec = 512 * 1024
+
+    gc = _sync(server, "--batch-size-max", "60")
+
+    report = gc._metrics.report()
+    assert report['requests']['people']['latency_secs']['max'] >= 0.05
+    assert report['requests']['carddav']['latency_secs']['max'] >= 0.05
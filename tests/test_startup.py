@@ -0,0 +1,53 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import pytest
+
+
+# Slow to import, and only needed once a sync gets going
+HEAVY_MODULES = ["git", "requests", "googleapiclient", "google_auth_oauthlib", "google.auth", "httplib2"]
+# On top of the interpreter's own startup
+STARTUP_BUDGET_SECS = 0.25
+
+dirname = os.path.dirname(__file__)
+src_dir_path = os.path.join(dirname, "..", "src")
+
+
+def _run_python(code):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([src_dir_path] + sys.path))
+    return subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+
+
+def _time_python(code, runs=3):
+    # Best of a few, the first run may be compiling bytecode
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        _run_python(code)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@pytest.mark.parametrize("args", [["--version"], ["--help"], ["noop", "foo.bar@gmail.com"]])
+def test_no_heavy_imports(args, tmp_path):
+    args = args + (["-c", str(tmp_path / "conf"), "-o", str(tmp_path / "output")] if args[0] == "noop" else [])
+    result = _run_python(f"""
+import sys, json, io, contextlib
+from gcardvault import Gcardvault
+with contextlib.redirect_stdout(io.StringIO()):
+    Gcardvault().run({args!r})
+print(json.dumps(sorted(sys.modules)))
+""")
+
+    modules = json.loads(result.stdout)
+    assert [module for module in HEAVY_MODULES if module in modules] == []
+
+
+def test_startup_time():
+    baseline = _time_python("pass")
+    startup = _time_python("from gcardvault import Gcardvault; Gcardvault().run(['--version'])")
+
+    assert startup - baseline < STARTUP_BUDGET_SECS, \
+        f"'gcardvault --version' took {startup - baseline:.3f}s to start up, over budget"
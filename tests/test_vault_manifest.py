@@ -0,0 +1,65 @@
+import os
+import shutil
+from pathlib import Path
+from gcardvault.vault_manifest import VaultManifest, MANIFEST_FILE_NAME
+
+
+def _setup_dir():
+    dir_path = os.path.join("/tmp", "gcardvault_test", "vault_manifest")
+    shutil.rmtree(dir_path, ignore_errors=True)
+    os.makedirs(dir_path)
+    return dir_path
+
+
+def test_built_from_directory():
+    dir_path = _setup_dir()
+    Path(dir_path, "foo_bar_abc123.vcf").write_text("")
+    Path(dir_path, "baz_def456.vcf").write_text("")
+    Path(dir_path, "notes.txt").write_text("")
+
+    manifest = VaultManifest(dir_path, ".vcf", log=lambda msg: None)
+
+    assert manifest.ids() == {"abc123", "def456"}
+    assert manifest.get_file_name("ABC123") == "foo_bar_abc123.vcf"
+    assert manifest.get_file_name("missing", "default.vcf") == "default.vcf"
+
+
+def test_saved_and_read_back():
+    dir_path = _setup_dir()
+
+    manifest = VaultManifest(dir_path, ".vcf", log=lambda msg: None)
+    manifest.set("abc123", "foo_bar_abc123.vcf", '"etag"', "0123abcd", 42, 1700000000000000000)
+    manifest.set("def456", "baz_def456.vcf")
+    manifest.save()
+    manifest.remove("def456")
+
+    assert os.path.exists(os.path.join(dir_path, MANIFEST_FILE_NAME))
+    manifest = VaultManifest(dir_path, ".vcf", log=lambda msg: None)
+    assert manifest.ids() == {"abc123", "def456"}
+    assert manifest.get("abc123") == {
+        'id': "abc123",
+        'file_name': "foo_bar_abc123.vcf",
+        'etag': '"etag"',
+        'content_hash': "0123abcd",
+        'size': 42,
+        'mtime_ns': 1700000000000000000,
+    }
+    assert manifest.get("def456")['content_hash'] is None
+
+
+def test_rebuild_reconciles_with_directory():
+    dir_path = _setup_dir()
+    Path(dir_path, "foo_bar_abc123.vcf").write_text("")
+    Path(dir_path, "baz_def456.vcf").write_text("")
+
+    manifest = VaultManifest(dir_path, ".vcf", log=lambda msg: None)
+    manifest.set("abc123", "foo_bar_abc123.vcf", content_hash="0123abcd")
+    manifest.save()
+
+    os.remove(os.path.join(dir_path, "baz_def456.vcf"))
+    Path(dir_path, "qux_789aaa.vcf").write_text("")
+
+    manifest = VaultManifest(dir_path, ".vcf", rebuild=True, log=lambda msg: None)
+    assert manifest.ids() == {"abc123", "789aaa"}
+    # Entry for a file that's still in place is kept as is
+    assert manifest.get("abc123")['content_hash'] == "0123abcd"